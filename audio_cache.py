@@ -0,0 +1,188 @@
+"""Content-addressed on-disk cache of Opus audio for frequently played tracks"""
+import asyncio
+import hashlib
+import json
+import os
+from collections import Counter, OrderedDict
+
+from config import Config
+from json_saver import JSONSaver
+
+
+def file_digest(path):
+    """SHA-256 of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class AudioCache:
+    """Opus files for hot tracks, stored once under the hash of their contents
+
+    A track is downloaded after it has been played min_plays times. Files
+    are written to a temporary name and renamed into place, each track has
+    at most one fill running, and the least recently played files are
+    deleted once the directory grows past max_bytes.
+    """
+
+    def __init__(self, directory=None, max_bytes=None, min_plays=None, workers=None):
+        self.directory = directory or Config.AUDIO_CACHE_DIR
+        self.max_bytes = max_bytes or Config.AUDIO_CACHE_MAX_BYTES
+        self.min_plays = min_plays or Config.AUDIO_CACHE_MIN_PLAYS
+        self.tracks = {}              # track key -> digest
+        self.files = OrderedDict()    # digest -> size in bytes, least recently played first
+        self.plays = Counter()        # track key -> plays counted towards caching
+        self.size = 0
+        self.hits = 0
+        self.fills = 0
+        self.pending = {}             # track key -> fill Task
+        self._limit = asyncio.Semaphore(workers or Config.AUDIO_CACHE_FILL_WORKERS)
+        self._saver = JSONSaver(self.index_path, self._snapshot, 'audio cache index')
+        self._load()
+
+    @property
+    def index_path(self):
+        return os.path.join(self.directory, 'index.json')
+
+    def file_path(self, digest):
+        # Two-character fan-out keeps directories small
+        return os.path.join(self.directory, digest[:2], f'{digest}.opus')
+
+    def _load(self):
+        try:
+            with open(self.index_path, encoding='utf-8') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return
+        for digest, size in index.get('files', {}).items():
+            # Files deleted behind our back are simply forgotten
+            if os.path.exists(self.file_path(digest)):
+                self.files[digest] = size
+                self.size += size
+        self.tracks = {key: digest for key, digest in index.get('tracks', {}).items()
+                       if digest in self.files}
+        self.plays.update(index.get('plays', {}))
+
+    def has(self, track):
+        """Whether a track's audio is cached, without counting it as a hit"""
+        return track.key in self.tracks
+
+    def path(self, track):
+        """Local file for a track, or None if it isn't cached"""
+        digest = self.tracks.get(track.key)
+        if digest is None:
+            return None
+        path = self.file_path(digest)
+        if not os.path.exists(path):
+            self._forget(digest)
+            return None
+        self.files.move_to_end(digest)
+        self.hits += 1
+        return path
+
+    def record_play(self, track):
+        """Count a play, and start caching the track once it is popular enough"""
+        key = track.key
+        if key in self.tracks:
+            return
+        self.plays[key] += 1
+        if len(self.plays) > Config.AUDIO_CACHE_TRACKED_PLAYS:
+            # Keep the counts bounded, the rarely played tracks go first
+            for rare, _ in self.plays.most_common()[Config.AUDIO_CACHE_TRACKED_PLAYS // 2:]:
+                del self.plays[rare]
+        if self.plays[key] < self.min_plays or key in self.pending:
+            return
+        if not track.stream_fresh() or not track.duration or track.duration > Config.AUDIO_CACHE_MAX_DURATION:
+            return
+        task = asyncio.create_task(self._fill(track))
+        self.pending[key] = task
+        task.add_done_callback(lambda _: self.pending.pop(key, None))
+
+    async def _fill(self, track):
+        async with self._limit:
+            os.makedirs(self.directory, exist_ok=True)
+            temporary = os.path.join(self.directory, f'.{hashlib.sha256(track.key.encode()).hexdigest()}.part')
+            try:
+                await self._download(track, temporary)
+                digest = await asyncio.to_thread(file_digest, temporary)
+                path = self.file_path(digest)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                size = os.path.getsize(temporary)
+                # Identical audio fetched under another key lands on the same file
+                os.replace(temporary, path)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f'Audio cache fill failed for {track.key}: {e}')
+                return
+            finally:
+                if os.path.exists(temporary):
+                    os.remove(temporary)
+        if digest not in self.files:
+            self.size += size
+        self.files[digest] = size
+        self.files.move_to_end(digest)
+        self.tracks[track.key] = digest
+        self.plays.pop(track.key, None)
+        self.fills += 1
+        self._evict()
+        self._saver.schedule()
+
+    async def _download(self, track, destination):
+        # Opus streams are copied as they are, anything else is encoded once here
+        codec = ['-c:a', 'copy'] if track.codec in ('opus', 'libopus') else ['-c:a', 'libopus', '-b:a', '128k']
+        process = await asyncio.create_subprocess_exec(
+            'ffmpeg', '-nostdin', '-hide_banner', '-loglevel', 'error',
+            '-reconnect', '1', '-reconnect_streamed', '1', '-reconnect_delay_max', '5',
+            '-i', track.stream_url, '-vn', '-sn', '-dn', '-map_metadata', '-1',
+            *codec, '-f', 'opus', '-y', destination,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            _, stderr = await asyncio.wait_for(process.communicate(), Config.AUDIO_CACHE_FILL_TIMEOUT)
+        except BaseException:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            raise
+        if process.returncode != 0:
+            raise RuntimeError(stderr.decode(errors='replace').strip() or 'ffmpeg failed')
+
+    def _evict(self):
+        while self.size > self.max_bytes and len(self.files) > 1:
+            digest = next(iter(self.files))
+            try:
+                os.remove(self.file_path(digest))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f'Could not evict {digest} from the audio cache: {e}')
+                break
+            self._forget(digest)
+
+    def _forget(self, digest):
+        self.size -= self.files.pop(digest, 0)
+        for key in [key for key, value in self.tracks.items() if value == digest]:
+            del self.tracks[key]
+
+    def _snapshot(self):
+        return {'files': dict(self.files), 'tracks': dict(self.tracks), 'plays': dict(self.plays)}
+
+    def stats(self):
+        return {
+            'files': len(self.files),
+            'tracks': len(self.tracks),
+            'bytes': self.size,
+            'hits': self.hits,
+            'fills': self.fills,
+            'filling': len(self.pending),
+        }
+
+    def close(self):
+        for task in self.pending.values():
+            task.cancel()
+        self._saver.save()
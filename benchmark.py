@@ -0,0 +1,563 @@
+"""Offline load test for the bot's command handlers
+
+Runs ask, analyze, play, queue and skip against a local stand-in Ollama
+server, a stub extractor and fake voice connections, for N guilds at
+once, then reports latency percentiles, throughput and event-loop lag
+per command. No Discord, Ollama or YouTube access is needed.
+
+    python benchmark.py --guilds 20 --rounds 5 --output results.json
+    python benchmark.py --baseline results.json
+"""
+import argparse
+import asyncio
+import hashlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+from config import Config
+
+COMMANDS = ('play', 'queue', 'ask', 'analyze', 'skip')
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+# Stand-in backends
+
+class FakeOllamaServer:
+    """Local /api/generate that streams synthetic tokens at a fixed rate
+
+    Holds max_loaded models in memory like a GPU would, evicting the least
+    recently used one and charging load_time whenever a request needs a
+    model that isn't loaded. /api/ps and /api/tags report that state. Also
+    serves a test JPEG at /image.jpg for !analyze.
+    """
+
+    def __init__(self, latency=0.2, token_rate=50, tokens=60, load_time=0.0, max_loaded=1):
+        self.latency = latency        # seconds before the first token
+        self.token_rate = token_rate  # tokens per second after that
+        self.tokens = tokens          # tokens per answer
+        self.load_time = load_time    # seconds to load a model that isn't resident
+        self.max_loaded = max_loaded
+        self.installed = [Config.CHAT_MODEL, Config.VISION_MODEL]
+        self.loaded = []              # least recently used first
+        self.requests = 0
+        self.loads = 0
+        self.url = None
+        self._runner = None
+        self._loading = asyncio.Lock()
+        self._image = _test_image()
+
+    async def start(self):
+        from aiohttp import web
+        app = web.Application()
+        app.router.add_post('/api/generate', self.generate)
+        app.router.add_get('/api/ps', self.ps)
+        app.router.add_get('/api/tags', self.tags)
+        app.router.add_get('/image.jpg', self.image)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f'http://127.0.0.1:{port}'
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def generate(self, request):
+        from aiohttp import web
+        payload = await request.json()
+        self.requests += 1
+        response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        await response.prepare(request)
+        await self._load(payload['model'])
+        await asyncio.sleep(self.latency)
+        started = time.perf_counter()
+        for i in range(self.tokens):
+            chunk = {'model': payload['model'], 'response': f'token{i} ', 'done': False}
+            await response.write(json.dumps(chunk).encode() + b'\n')
+            await asyncio.sleep(1 / self.token_rate)
+        final = {
+            'model': payload['model'], 'response': '', 'done': True,
+            'context': list(range(64)), 'eval_count': self.tokens,
+            'eval_duration': int((time.perf_counter() - started) * 1e9),
+        }
+        await response.write(json.dumps(final).encode() + b'\n')
+        await response.write_eof()
+        return response
+
+    async def _load(self, model):
+        async with self._loading:
+            if model in self.loaded:
+                self.loaded.remove(model)
+            else:
+                self.loads += 1
+                await asyncio.sleep(self.load_time)
+                del self.loaded[:len(self.loaded) - self.max_loaded + 1]
+            self.loaded.append(model)
+
+    async def ps(self, request):
+        from aiohttp import web
+        return web.json_response({'models': [{'name': model} for model in self.loaded]})
+
+    async def tags(self, request):
+        from aiohttp import web
+        return web.json_response({'models': [{'name': model} for model in self.installed]})
+
+    async def image(self, request):
+        from aiohttp import web
+        return web.Response(body=self._image, content_type='image/jpeg')
+
+
+def _test_image():
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.new('RGB', (1280, 720), (30, 120, 200)).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+class StubExtractionEngine:
+    """Drop-in for ExtractionEngine that makes up track metadata"""
+
+    def __init__(self, latency=0.05, duration=5):
+        self.latency = latency
+        self.duration = duration
+        self.queued = 0
+        self.running = 0
+        self.calls = 0
+
+    async def extract(self, query, guild_id=None, user_id=None, process=True, overrides=None,
+                      timeout=None):
+        self.calls += 1
+        self.running += 1
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self.running -= 1
+        video_id = hashlib.sha1(query.encode()).hexdigest()[:11]
+        return {
+            'id': video_id,
+            'extractor_key': 'Youtube',
+            'title': f'Synthetic track {video_id}',
+            'webpage_url': f'https://www.youtube.com/watch?v={video_id}',
+            'duration': self.duration,
+            'uploader': 'Benchmark',
+            'url': f'https://stream.invalid/{video_id}?expire={int(time.time()) + 21600}',
+            'acodec': 'opus',
+            'abr': 128,
+            'ext': 'webm',
+        }
+
+    def cancel(self, guild_id):
+        pass
+
+    def shutdown(self):
+        pass
+
+
+class FakeAudioSource:
+    """Stands in for FFmpegOpusAudio without spawning FFmpeg"""
+
+    def __init__(self, url, codec=None, bitrate=None, **kwargs):
+        self.url = url
+
+    @classmethod
+    async def probe(cls, url, **kwargs):
+        return 'opus', 128
+
+    def is_opus(self):
+        return True
+
+    def read(self):
+        return b''
+
+    def cleanup(self):
+        pass
+
+
+class FakeVoiceClient:
+    """Plays a source for a fixed time and then calls its after-callback"""
+
+    def __init__(self, loop, duration):
+        self.loop = loop
+        self.duration = duration
+        self.source = None
+        self._after = None
+        self._timer = None
+        self._paused = False
+
+    def play(self, source, after=None):
+        self.source = source
+        self._after = after
+        self._paused = False
+        self._timer = self.loop.call_later(self.duration, self._finish)
+
+    def _finish(self):
+        after, self._after = self._after, None
+        self.source = None
+        self._timer = None
+        if after is not None:
+            after(None)
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._finish()
+
+    def is_playing(self):
+        return self.source is not None and not self._paused
+
+    def is_paused(self):
+        return self.source is not None and self._paused
+
+    def pause(self):
+        self._paused = True
+
+    def resume(self):
+        self._paused = False
+
+    async def disconnect(self):
+        self.stop()
+
+
+class FakeMessage:
+    def __init__(self, channel, content=None, **kwargs):
+        self.channel = channel
+        self.content = content
+
+    async def edit(self, content=None, **kwargs):
+        self.content = content
+
+    async def delete(self):
+        pass
+
+
+class FakeChannel:
+    def __init__(self, channel_id):
+        self.id = channel_id
+        self.name = f'channel-{channel_id}'
+        self.sent = 0
+
+    async def send(self, content=None, **kwargs):
+        self.sent += 1
+        return FakeMessage(self, content, **kwargs)
+
+
+class _Typing:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+class FakeContext:
+    """Just enough of commands.Context for the command handlers"""
+
+    def __init__(self, bot, guild, channel, author, attachments=()):
+        self.bot = bot
+        self.guild = guild
+        self.channel = channel
+        self.author = author
+        self.message = SimpleNamespace(id=time.monotonic_ns(), attachments=list(attachments), author=author)
+
+    @property
+    def voice_client(self):
+        return self.guild.voice_client
+
+    async def send(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+    async def reply(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+    def typing(self):
+        return _Typing()
+
+    async def invoke(self, command, *args, **kwargs):
+        return await command.callback(command.cog, self, *args, **kwargs)
+
+
+# Measurement
+
+class LoopLagMonitor:
+    """Samples how late the event loop wakes up, per command in flight"""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.active = dict.fromkeys(COMMANDS, 0)
+        self.samples = {name: [] for name in COMMANDS}
+        self.all_samples = []
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - started - self.interval)
+            self.all_samples.append(lag)
+            for name, count in self.active.items():
+                if count:
+                    self.samples[name].append(lag)
+
+
+class Recorder:
+    def __init__(self, lag):
+        self.lag = lag
+        self.latencies = {name: [] for name in COMMANDS}
+        self.errors = {name: 0 for name in COMMANDS}
+
+    async def run(self, name, coroutine):
+        self.lag.active[name] += 1
+        started = time.perf_counter()
+        try:
+            await coroutine
+        except Exception as e:
+            self.errors[name] += 1
+            print(f'{name} failed: {e!r}', file=sys.stderr)
+        finally:
+            self.latencies[name].append(time.perf_counter() - started)
+            self.lag.active[name] -= 1
+
+
+# Driver
+
+def configure(directory, args):
+    """Point every on-disk cache at a scratch directory before the bot is imported"""
+    Config.RESPONSE_CACHE_ENABLED = args.response_cache
+    Config.RESPONSE_CACHE_PATH = os.path.join(directory, 'responses.sqlite3')
+    Config.LOUDNESS_NORMALIZATION = False
+    Config.LOUDNESS_CACHE_PATH = os.path.join(directory, 'loudness.json')
+    Config.AUDIO_CACHE_ENABLED = False
+    Config.SEARCH_INDEX_PATH = os.path.join(directory, 'search_index.jsonl')
+    Config.METRICS_ENABLED = False
+    Config.STATE_BACKEND = 'memory'
+    # The fake server always has the models loaded
+    Config.MODEL_WARMUP = False
+    Config.OLLAMA_HEALTH_INTERVAL = 1
+    Config.STREAM_EDIT_INTERVAL = args.edit_interval
+
+
+async def guild_session(index, args, bot, music, recorder, server_url):
+    import ollama_bot as app
+    guild = SimpleNamespace(id=10_000 + index, name=f'guild-{index}', voice_client=None)
+    guild.voice_client = FakeVoiceClient(asyncio.get_running_loop(), args.track_seconds)
+    channel = FakeChannel(20_000 + index)
+    author = SimpleNamespace(id=30_000 + index, name=f'user{index}', display_name=f'user{index}',
+                             mention=f'<@{30_000 + index}>', bot=False,
+                             voice=SimpleNamespace(channel=SimpleNamespace(name='voice')))
+    image = SimpleNamespace(url=f'{server_url}/image.jpg', content_type='image/jpeg',
+                            filename='image.jpg', size=0)
+
+    def context(attachments=()):
+        return FakeContext(bot, guild, channel, author, attachments)
+
+    for round_number in range(args.rounds):
+        for song in range(args.songs):
+            query = f'benchmark song g{index} r{round_number} s{song}'
+            await recorder.run('play', music.play.callback(music, context(), query=query))
+        await recorder.run('queue', music.queue.callback(music, context()))
+        await recorder.run('ask', app.ask.callback(context(), question=f'Question {round_number} from guild {index}?'))
+        await recorder.run('analyze', app.analyze.callback(context([image]), prompt='What is this?'))
+        await recorder.run('skip', music.skip.callback(music, context()))
+
+
+async def run_benchmark(args):
+    import discord
+    import ollama_bot as app
+    import player
+
+    from ollama_pool import OllamaPool
+
+    servers = [FakeOllamaServer(args.ollama_latency, args.token_rate, args.tokens, args.load_time)
+               for _ in range(args.hosts)]
+    for server in servers:
+        await server.start()
+    pins = {}
+    if args.pin and len(servers) > 1:
+        pins = {Config.CHAT_MODEL: [servers[0].url], Config.VISION_MODEL: [servers[-1].url]}
+    app.ollama_client = OllamaPool([server.url for server in servers], pins)
+    app.ollama_client.start()
+    app.extraction_engine = StubExtractionEngine(args.extract_latency, args.track_seconds)
+    discord.FFmpegOpusAudio = FakeAudioSource
+    player.discord.FFmpegOpusAudio = FakeAudioSource
+    await player.search_index.load_async()
+
+    loop = asyncio.get_running_loop()
+    bot = SimpleNamespace(loop=loop, voice_clients=[], get_cog=lambda name: None,
+                          dispatch=lambda event, *args: None)
+    music = app.Music(bot)
+    bot.get_cog = lambda name: music if name == 'Music' else None
+
+    lag = LoopLagMonitor()
+    recorder = Recorder(lag)
+    lag.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        guild_session(index, args, bot, music, recorder, servers[0].url) for index in range(args.guilds)
+    ))
+    elapsed = time.perf_counter() - started
+    await lag.stop()
+
+    for guild_id in list(music.players):
+        await music.destroy_player(guild_id)
+    await app.ollama_client.close()
+    await app.image_fetcher.close()
+    for server in servers:
+        await server.stop()
+    return report(args, recorder, lag, elapsed, servers)
+
+
+def _ms(value):
+    return None if value is None else round(value * 1000, 2)
+
+
+def report(args, recorder, lag, elapsed, servers):
+    results = {
+        'settings': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline', 'tolerance', 'min_delta')},
+        'elapsed_seconds': round(elapsed, 3),
+        'ollama_requests': sum(server.requests for server in servers),
+        'ollama_model_loads': sum(server.loads for server in servers),
+        'loop_lag_ms': {
+            'p50': _ms(percentile(lag.all_samples, 0.5)),
+            'p99': _ms(percentile(lag.all_samples, 0.99)),
+            'max': _ms(max(lag.all_samples, default=None)),
+        },
+        'commands': {},
+    }
+    for name in COMMANDS:
+        latencies = recorder.latencies[name]
+        lags = lag.samples[name]
+        results['commands'][name] = {
+            'count': len(latencies),
+            'errors': recorder.errors[name],
+            'throughput_per_second': round(len(latencies) / elapsed, 3) if elapsed else None,
+            'p50_ms': _ms(percentile(latencies, 0.5)),
+            'p95_ms': _ms(percentile(latencies, 0.95)),
+            'p99_ms': _ms(percentile(latencies, 0.99)),
+            'loop_lag_p99_ms': _ms(percentile(lags, 0.99)),
+            'loop_lag_max_ms': _ms(max(lags, default=None)),
+        }
+    return results
+
+
+def print_table(results, baseline=None):
+    header = f"{'command':<10}{'count':>7}{'err':>5}{'ops/s':>9}{'p50':>10}{'p95':>10}{'p99':>10}{'lag p99':>10}"
+    print(header)
+    print('-' * len(header))
+    for name, stats in results['commands'].items():
+        row = (f"{name:<10}{stats['count']:>7}{stats['errors']:>5}{stats['throughput_per_second']:>9}"
+               f"{_fmt(stats['p50_ms']):>10}{_fmt(stats['p95_ms']):>10}{_fmt(stats['p99_ms']):>10}"
+               f"{_fmt(stats['loop_lag_p99_ms']):>10}")
+        if baseline and name in baseline['commands']:
+            row += f"   p95 {_change(baseline['commands'][name]['p95_ms'], stats['p95_ms'])}"
+        print(row)
+    lag = results['loop_lag_ms']
+    print(f"\n{results['elapsed_seconds']}s total, loop lag p50 {_fmt(lag['p50'])} / "
+          f"p99 {_fmt(lag['p99'])} / max {_fmt(lag['max'])} ms, "
+          f"{results['ollama_requests']} Ollama requests, {results['ollama_model_loads']} model loads")
+
+
+def _fmt(value):
+    return '-' if value is None else f'{value:.1f}'
+
+
+def _change(before, after):
+    if not before or after is None:
+        return 'n/a'
+    return f'{(after - before) / before * 100:+.1f}%'
+
+
+def regressions(results, baseline, tolerance, min_delta_ms):
+    """Commands whose p95 latency grew by more than tolerance (a fraction)
+
+    Growth below min_delta_ms is ignored so sub-millisecond commands don't
+    fail the run on noise.
+    """
+    found = []
+    for name, stats in results['commands'].items():
+        before = baseline.get('commands', {}).get(name, {}).get('p95_ms')
+        after = stats['p95_ms']
+        if before is None or after is None:
+            continue
+        if after > before * (1 + tolerance) and after - before > min_delta_ms:
+            found.append(name)
+    return found
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--guilds', type=int, default=10, help='guilds driven concurrently')
+    parser.add_argument('--rounds', type=int, default=3, help='command rounds per guild')
+    parser.add_argument('--songs', type=int, default=3, help='!play calls per round')
+    parser.add_argument('--ollama-latency', type=float, default=0.2, help='seconds to first token')
+    parser.add_argument('--token-rate', type=float, default=50, help='tokens per second')
+    parser.add_argument('--tokens', type=int, default=60, help='tokens per answer')
+    parser.add_argument('--load-time', type=float, default=0.0,
+                        help='seconds for a fake Ollama host to load a model that isn\'t resident')
+    parser.add_argument('--hosts', type=int, default=1, help='fake Ollama hosts behind the pool')
+    parser.add_argument('--pin', action='store_true',
+                        help='pin chat to the first host and vision to the last')
+    parser.add_argument('--extract-latency', type=float, default=0.05, help='seconds per extraction')
+    parser.add_argument('--track-seconds', type=float, default=5, help='length of synthetic tracks')
+    parser.add_argument('--edit-interval', type=float, default=Config.STREAM_EDIT_INTERVAL,
+                        help='seconds between streaming reply edits')
+    parser.add_argument('--response-cache', action='store_true', help='keep the response cache on')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--baseline', help='earlier JSON results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed p95 growth over the baseline before failing (fraction)')
+    parser.add_argument('--min-delta', type=float, default=5,
+                        help='p95 growth in ms below which a command never counts as regressed')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory(prefix='bot-benchmark-') as directory:
+        configure(directory, args)
+        results = asyncio.run(run_benchmark(args))
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+    if baseline and baseline.get('settings') != results['settings']:
+        print('Note: the baseline was run with different settings\n')
+    print_table(results, baseline)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+    if baseline:
+        slower = regressions(results, baseline, args.tolerance, args.min_delta)
+        if slower:
+            print(f"\nRegressed beyond {args.tolerance:.0%}: {', '.join(slower)}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,5 @@
 """Bot configuration settings"""
+import os
 
 class Config:
     # Bot settings
@@ -46,6 +47,47 @@ class Config:
     LEAVE_ON_EMPTY_DELAY = 30  # seconds
     LEAVE_ON_FINISH = True
     LEAVE_ON_FINISH_DELAY = 30  # seconds
+    TRACK_CACHE_SIZE = 5000           # Resolved tracks kept in memory
+    TRACK_CACHE_TTL = 24 * 60 * 60    # seconds before metadata is extracted again
+    STREAM_URL_TTL = 60 * 60          # Assumed lifetime of stream URLs without an expiry
+    STREAM_URL_MARGIN = 5 * 60        # Re-resolve streams expiring within this many seconds
+    LOOKAHEAD_TRACKS = 2              # Upcoming tracks resolved and probed in the background
+    LOOKAHEAD_SPAWN_LEAD = 15         # seconds before the current song ends to start FFmpeg for the next
+    EXTRACTOR_WORKERS = None          # yt-dlp worker processes (None = up to 4, one per core)
+    EXTRACTOR_TIMEOUT = 30            # seconds allowed for one lookup
+    EXTRACTOR_SOCKET_TIMEOUT = 15     # seconds yt-dlp waits on a stalled connection
+    PLAYLIST_MAX_TRACKS = 500         # Playlist entries loaded per !play
+    PLAYLIST_PAGE_SIZE = 100          # Entries fetched per background lookup
+    PLAYLIST_REQUIRE_LIST_URL = True  # watch?v=...&list=... links play just the one video
+    MAX_QUEUE_LENGTH = 5000           # Songs per guild queue
+    QUEUE_BLOCK_SIZE = 64             # Tracks per block in the queue structure
+    QUEUE_SHUFFLE_HISTORY = 3         # Shuffles that !unshuffle can undo
+    QUEUE_PAGE_SIZE = 10              # Songs per !queue page
+    TRANSCODE_BITRATE = 128           # kbps when a stream has to be re-encoded to Opus
+    STREAM_SAMPLE_INTERVAL = 10       # seconds between FFmpeg CPU samples
+    STREAM_CPU_BUDGET = 0.8           # Share of the host's CPU voice streams may use
+    LOUDNESS_NORMALIZATION = True     # Even out loudness between songs (EBU R128)
+    LOUDNESS_TARGET = -16             # LUFS
+    LOUDNESS_MAX_GAIN = 12            # dB, largest boost or cut applied to a song
+    LOUDNESS_MAX_DURATION = 1800      # seconds, longer songs aren't analysed
+    LOUDNESS_ANALYSIS_WORKERS = 1     # Concurrent analysis FFmpeg processes
+    LOUDNESS_ANALYSIS_TIMEOUT = 300   # seconds
+    LOUDNESS_CACHE_PATH = 'cache/loudness.json'
+    LOUDNESS_CACHE_SIZE = 50000       # Songs whose gain is remembered
+    AUDIO_CACHE_ENABLED = False       # Keep local Opus copies of frequently played songs
+    AUDIO_CACHE_DIR = 'cache/audio'
+    AUDIO_CACHE_MAX_BYTES = 2 * 1024 ** 3
+    AUDIO_CACHE_MIN_PLAYS = 3         # Plays before a song is stored
+    AUDIO_CACHE_TRACKED_PLAYS = 20000 # Songs whose play counts are remembered
+    AUDIO_CACHE_MAX_DURATION = 900    # seconds, longer songs always stream
+    AUDIO_CACHE_FILL_WORKERS = 2      # Concurrent downloads
+    AUDIO_CACHE_FILL_TIMEOUT = 600    # seconds
+    SEARCH_INDEX_PATH = 'cache/search_index.jsonl'
+    SEARCH_INDEX_THRESHOLD = 0.85     # Share of the query's trigrams a local match needs
+    SEARCH_INDEX_MIN_QUERY = 3        # Shorter queries always search remotely
+    SEARCH_INDEX_WORD_MATCH = 0.6     # Share of each query word's trigrams a match needs
+    SEARCH_INDEX_MAX_TRACKS = 50000
+    SEARCH_INDEX_MAX_ALIASES = 5      # Past queries remembered per song
 
     # AI Model settings
     CHAT_MODEL = "llama3.2:latest"
@@ -57,6 +99,104 @@ class Config:
     TOP_K = 40              # Increased for vocabulary variety
     MAX_TOKENS = 2048       # Maximum output length
 
+    # Ollama connection settings
+    OLLAMA_HOST = os.getenv('OLLAMA_HOST', 'http://localhost:11434')
+    OLLAMA_POOL_SIZE = 16            # Max pooled HTTP connections to Ollama
+    OLLAMA_KEEPALIVE_TIMEOUT = 60    # seconds an idle connection is kept open
+    OLLAMA_CONNECT_TIMEOUT = 10      # seconds
+    OLLAMA_READ_TIMEOUT = 300        # seconds without a token before giving up
+
+    # Ollama hosts, comma separated. Requests go to a host that already has the model loaded.
+    OLLAMA_HOSTS = [host.strip() for host in os.getenv('OLLAMA_HOSTS', OLLAMA_HOST).split(',') if host.strip()]
+    # Optional subsets of OLLAMA_HOSTS reserved for each model, so they don't evict each other
+    OLLAMA_CHAT_HOSTS = [host.strip() for host in os.getenv('OLLAMA_CHAT_HOSTS', '').split(',') if host.strip()]
+    OLLAMA_VISION_HOSTS = [host.strip() for host in os.getenv('OLLAMA_VISION_HOSTS', '').split(',') if host.strip()]
+    OLLAMA_HEALTH_INTERVAL = 15      # seconds between host health/residency checks
+    OLLAMA_HEALTH_TIMEOUT = 5        # seconds before a health check counts as failed
+
+    # Conversation memory
+    CHAT_KEEP_ALIVE = '30m'                  # How long Ollama keeps the chat model loaded
+    CONVERSATION_TOKEN_BUDGET = 3000         # Summarize older turns past this many tokens
+    CONVERSATION_KEEP_TURNS = 4              # Recent turns always kept verbatim
+    CONVERSATION_MAX_CHANNELS = 2000         # Conversations kept in memory
+    CONVERSATION_MAX_TOTAL_TOKENS = 4000000  # Token cap across all conversations
+
+    # Image analysis
+    VISION_KEEP_ALIVE = '10m'              # How long Ollama keeps the vision model loaded
+    VISION_MAX_DIMENSION = 672             # Longest side sent to llava (its largest input tile)
+    VISION_JPEG_QUALITY = 90
+    IMAGE_MAX_BYTES = 10 * 1024 * 1024     # 10MB download limit
+    IMAGE_MAX_ATTACHMENTS = 4              # Images analyzed per message
+    IMAGE_POOL_SIZE = 8
+    IMAGE_DOWNLOAD_TIMEOUT = 30            # seconds
+
+    # Inference scheduling, limits are per healthy Ollama host
+    INFERENCE_MODEL_CONCURRENCY = {
+        CHAT_MODEL: 2,
+        VISION_MODEL: 1,
+    }
+    INFERENCE_DEFAULT_CONCURRENCY = 1   # For models not listed above
+    INFERENCE_MAX_ACTIVE = 3            # Generations running at once on each Ollama host
+    INFERENCE_LANE_WEIGHTS = {          # Share of admissions per lane under contention
+        'text': 3,
+        'vision': 1,
+    }
+    INFERENCE_MAX_QUEUE_DEPTH = 20      # Requests waiting per lane before rejecting
+    INFERENCE_QUEUE_TIMEOUT = 120       # seconds a request may wait in line
+
+    # Response cache settings
+    RESPONSE_CACHE_ENABLED = True
+    RESPONSE_CACHE_PATH = 'cache/responses.sqlite3'   # Set to None for memory only
+    RESPONSE_CACHE_TTL = 24 * 60 * 60                 # seconds
+    RESPONSE_CACHE_MEMORY_ENTRIES = 512
+    RESPONSE_CACHE_MEMORY_BYTES = 4 * 1024 * 1024
+    RESPONSE_CACHE_DISK_BYTES = 64 * 1024 * 1024
+    RESPONSE_CACHE_MAX_TEMPERATURE = 1.0              # Don't cache above this temperature
+
+    # Metrics endpoint (Prometheus text format at /metrics)
+    METRICS_ENABLED = os.getenv('METRICS_ENABLED', '').lower() in ('1', 'true', 'yes')
+    METRICS_HOST = '127.0.0.1'
+    METRICS_PORT = 9108
+
+    # Event loop stall detector
+    STALL_DETECTOR_ENABLED = True
+    STALL_THRESHOLD = 0.1            # seconds a heartbeat may be late before it counts as a stall
+    STALL_CHECK_INTERVAL = 0.05      # seconds between heartbeats
+    STALL_STACK_DEPTH = 12           # Frames kept per call site
+    STALL_REPORT_TOP = 10
+
+    # Rock Paper Scissors
+    RPS_GAME_TTL = 300                       # seconds a challenge or game lasts without a move
+    RPS_MAX_GAMES = 1000                     # games running at once across all servers
+
+    # State store (queues and games that survive a restart)
+    STATE_BACKEND = 'sqlite'                 # 'sqlite', or 'memory' to keep nothing on disk
+    STATE_DB_PATH = 'cache/state.sqlite3'
+    STATE_FLUSH_INTERVAL = 1.0               # seconds changes are batched before being written
+    STATE_CHECKPOINT_INTERVAL = 15           # seconds between saves of the playback position
+    STATE_MAX_AGE = 7 * 24 * 3600            # saved state older than this is ignored and deleted
+
+    # Idle reclamation
+    RECLAIM_INTERVAL = 60            # seconds between sweeps for idle players, FFmpeg processes and models
+    GUILD_IDLE_TIMEOUT = 10 * 60     # seconds a guild without a voice connection keeps its player in memory
+    MODEL_IDLE_UNLOAD = {            # seconds unused before the bot unloads a model, None leaves it to keep_alive
+        CHAT_MODEL: 15 * 60,
+        VISION_MODEL: 5 * 60,
+    }
+
+    # Startup
+    MODEL_WARMUP = True              # Pull and preload the models in the background at startup
+    MODEL_WARMUP_RETRY = 30          # seconds before retrying a failed pull/load
+    MODEL_READY_TIMEOUT = 120        # seconds a command waits for a model still warming up
+
+    # Discord message settings
+    DISCORD_MESSAGE_LIMIT = 2000
+    STREAM_EDIT_INTERVAL = 1.0       # seconds between edits of a streaming reply
+    OUTBOUND_BURST = 5               # messages per channel per window (Discord's limit is 5 per 5s)
+    OUTBOUND_WINDOW = 5.0            # seconds
+    OUTBOUND_NOTICE_DELAY = 0.5      # seconds announcements wait so a burst merges into one message
+    OUTBOUND_NOTICE_LINES = 10       # lines shown in a merged announcement
+
     # Emoji mappings
     EMOJIS = {
         'back': '⏪',
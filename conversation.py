@@ -0,0 +1,182 @@
+"""Per-channel conversation memory built on Ollama's returned context"""
+import asyncio
+import time
+from array import array
+from collections import OrderedDict, deque
+
+from config import Config
+
+
+def estimate_tokens(text):
+    """Rough token count, good enough for budgeting"""
+    return len(text) // 4 + 1
+
+
+class Turn:
+    __slots__ = ('question', 'answer', 'tokens')
+
+    def __init__(self, question, answer):
+        self.question = question
+        self.answer = answer
+        self.tokens = estimate_tokens(question) + estimate_tokens(answer)
+
+
+class Conversation:
+    """Rolling history of one channel
+
+    While Ollama's context array is held, only the new turn is sent and
+    evaluated. When the context is dropped (after summarizing, or a cache
+    hit that returned no context) the prompt is rebuilt once from the
+    summary and the most recent turns.
+    """
+
+    def __init__(self, channel_id):
+        self.channel_id = channel_id
+        self.context = None
+        self.summary = ''
+        self.turns = deque()
+        self.turn_tokens = 0        # Sum of the turns' tokens, kept up to date
+        self.last_used = time.monotonic()
+        self.summarizing = False
+
+    @property
+    def tokens(self):
+        """Approximate memory held by this conversation, in tokens"""
+        held = len(self.context) if self.context is not None else 0
+        return held + estimate_tokens(self.summary) + self.turn_tokens
+
+    @property
+    def context_tokens(self):
+        if self.context is not None:
+            return len(self.context)
+        return estimate_tokens(self.summary) + self.turn_tokens
+
+    def request(self, question):
+        """Build the prompt and generate() arguments for a new turn"""
+        kwargs = {'keep_alive': Config.CHAT_KEEP_ALIVE}
+        if self.context is not None:
+            # The persona is already part of the context, just add the new turn
+            kwargs['context'] = list(self.context)
+            return question, kwargs
+
+        kwargs['system'] = Config.BOT_PERSONALITY
+        if not self.summary and not self.turns:
+            return question, kwargs
+
+        lines = []
+        if self.summary:
+            lines.append(f"Summary of the earlier conversation: {self.summary}\n")
+        for turn in self.turns:
+            lines.append(f"User: {turn.question}")
+            lines.append(f"{Config.BOT_NAME}: {turn.answer}")
+        lines.append(f"User: {question}")
+        return "\n".join(lines), kwargs
+
+    def record(self, question, answer, context=None):
+        """Store a finished turn and the context Ollama returned for it"""
+        turn = Turn(question, answer)
+        self.turns.append(turn)
+        self.turn_tokens += turn.tokens
+        self.context = array('l', context) if context else None
+        self.last_used = time.monotonic()
+
+    def needs_summary(self):
+        return (not self.summarizing
+                and len(self.turns) > Config.CONVERSATION_KEEP_TURNS
+                and self.context_tokens > Config.CONVERSATION_TOKEN_BUDGET)
+
+    def older_turns(self):
+        """Turns that fall outside the verbatim window"""
+        keep = Config.CONVERSATION_KEEP_TURNS
+        return list(self.turns)[:max(0, len(self.turns) - keep)]
+
+    def compact(self, summary, summarized):
+        """Replace summarized turns with the new summary"""
+        for _ in range(summarized):
+            if self.turns:
+                self.turn_tokens -= self.turns.popleft().tokens
+        self.summary = summary
+        # The old context still holds the full history, drop it so the next
+        # turn is prefilled from the compact form
+        self.context = None
+
+
+class ConversationStore:
+    """Conversations keyed by channel, bounded in count and total tokens"""
+
+    def __init__(self, summarize=None, max_conversations=None, max_tokens=None):
+        self.summarize = summarize
+        self.max_conversations = max_conversations or Config.CONVERSATION_MAX_CHANNELS
+        self.max_tokens = max_tokens or Config.CONVERSATION_MAX_TOTAL_TOKENS
+        self._conversations = OrderedDict()
+        self._tokens = 0            # Running total of every held conversation's tokens
+        self._tasks = set()
+
+    def __len__(self):
+        return len(self._conversations)
+
+    def get(self, channel_id):
+        """Conversation for channel_id, created on first use"""
+        conversation = self._conversations.get(channel_id)
+        if conversation is None:
+            conversation = self._conversations[channel_id] = Conversation(channel_id)
+            self._tokens += conversation.tokens
+            while len(self._conversations) > self.max_conversations:
+                self._drop_oldest()
+        else:
+            self._conversations.move_to_end(channel_id)
+        return conversation
+
+    def forget(self, channel_id):
+        conversation = self._conversations.pop(channel_id, None)
+        if conversation is None:
+            return False
+        self._tokens -= conversation.tokens
+        return True
+
+    def total_tokens(self):
+        return self._tokens
+
+    def _held(self, conversation):
+        return self._conversations.get(conversation.channel_id) is conversation
+
+    def _drop_oldest(self):
+        _, conversation = self._conversations.popitem(last=False)
+        self._tokens -= conversation.tokens
+
+    def record(self, conversation, question, answer, context=None):
+        """Record a turn, then summarize and evict as needed"""
+        before = conversation.tokens
+        conversation.record(question, answer, context)
+        if self._held(conversation):
+            self._tokens += conversation.tokens - before
+        if conversation.needs_summary() and self.summarize is not None:
+            conversation.summarizing = True
+            task = asyncio.create_task(self._summarize(conversation))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        self._evict()
+
+    def _evict(self):
+        """Drop least recently used conversations until within limits"""
+        while len(self._conversations) > 1 and (
+                len(self._conversations) > self.max_conversations or self._tokens > self.max_tokens):
+            self._drop_oldest()
+
+    async def _summarize(self, conversation):
+        older = conversation.older_turns()
+        try:
+            transcript = "\n".join(
+                f"User: {turn.question}\n{Config.BOT_NAME}: {turn.answer}" for turn in older
+            )
+            if conversation.summary:
+                transcript = f"Earlier summary: {conversation.summary}\n\n{transcript}"
+            summary = await self.summarize(transcript)
+            before = conversation.tokens
+            conversation.compact(summary.strip(), len(older))
+            if self._held(conversation):
+                self._tokens += conversation.tokens - before
+        except Exception as e:
+            print(f"Error summarizing conversation in channel {conversation.channel_id}: {e}")
+        finally:
+            conversation.summarizing = False
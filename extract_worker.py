@@ -0,0 +1,30 @@
+"""Entry point of the extraction worker processes
+
+Imports nothing but yt-dlp, so a worker doesn't load any of the bot.
+"""
+
+# One YoutubeDL per worker process, created by the pool initializer
+ytdl = None
+
+
+def init(options):
+    global ytdl
+    import yt_dlp as youtube_dl
+    youtube_dl.utils.bug_reports_message = lambda *args, **kwargs: ''
+    ytdl = youtube_dl.YoutubeDL(options)
+
+
+def extract(query, process=True, overrides=None):
+    params = ytdl.params
+    # Keys the worker didn't have are removed again, not left as None:
+    # yt-dlp reads e.g. params.get('playliststart', 1) and None breaks it
+    saved = {key: params[key] for key in overrides or {} if key in params}
+    params.update(overrides or {})
+    try:
+        info = ytdl.extract_info(query, download=False, process=process)
+        # Plain JSON types only, so the result pickles back to the bot process
+        return ytdl.sanitize_info(info)
+    finally:
+        for key in overrides or {}:
+            params.pop(key, None)
+        params.update(saved)
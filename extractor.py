@@ -0,0 +1,147 @@
+"""yt-dlp extraction on a bounded process pool"""
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+import extract_worker
+import metrics
+from config import Config
+from inference_scheduler import FairQueue
+
+
+class ExtractionError(Exception):
+    """Raised when a lookup is dropped before it finishes"""
+
+
+class ExtractionTimeoutError(ExtractionError):
+    """Raised when an extraction takes longer than allowed"""
+
+
+class _Job:
+    __slots__ = ('query', 'process', 'overrides', 'guild_id', 'user_id', 'future', 'started')
+
+    def __init__(self, query, process, overrides, guild_id, user_id, future):
+        self.query = query
+        self.process = process
+        self.overrides = overrides
+        self.guild_id = guild_id
+        self.user_id = user_id
+        self.future = future
+        self.started = None
+
+    @property
+    def kind(self):
+        return 'flat' if self.overrides and self.overrides.get('extract_flat') else 'full'
+
+
+class ExtractionEngine:
+    """Runs extract_info in worker processes, shared fairly between guilds
+
+    At most `workers` extractions run at once. Waiting jobs are queued per
+    guild and served round-robin. A job whose caller gives up (timeout or
+    cancellation) is dropped if it hasn't started; if it has, its slot is
+    held until the worker finishes so the pool is never oversubscribed.
+    """
+
+    def __init__(self, options, workers=None, timeout=None):
+        self.options = dict(options)
+        self.workers = workers or Config.EXTRACTOR_WORKERS or min(4, os.cpu_count() or 1)
+        self.timeout = timeout or Config.EXTRACTOR_TIMEOUT
+        self.running = 0
+        self._queue = FairQueue()
+        self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                # Forking a process that is running an event loop and voice
+                # threads is unsafe, start clean interpreters instead
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=extract_worker.init,
+                initargs=(self.options,)
+            )
+        return self._executor
+
+    @property
+    def queued(self):
+        return len(self._queue)
+
+    async def extract(self, query, guild_id=None, user_id=None, process=True, overrides=None,
+                      timeout=None):
+        """Extract info for query in a worker process
+
+        overrides are YoutubeDL params applied for this job only.
+        """
+        job = _Job(query, process, overrides, guild_id, user_id,
+                   asyncio.get_running_loop().create_future())
+        self._queue.push(guild_id, user_id, job)
+        self._dispatch()
+        try:
+            return await asyncio.wait_for(asyncio.shield(job.future), timeout or self.timeout)
+        except asyncio.TimeoutError:
+            self._abandon(job)
+            metrics.EXTRACT_FAILURES.labels('timeout').inc()
+            raise ExtractionTimeoutError(f"Timed out looking up '{query}'") from None
+        except asyncio.CancelledError:
+            self._abandon(job)
+            raise
+
+    def cancel(self, guild_id):
+        """Drop every queued job for a guild, failing them with ExtractionError"""
+        for job in [job for job in self._queue.order() if job.guild_id == guild_id]:
+            # Not CancelledError: the callers' own tasks weren't cancelled
+            self._abandon(job, ExtractionError(f"Lookup of '{job.query}' was cancelled"))
+
+    def _abandon(self, job, error=None):
+        if not job.future.done():
+            if error is None:
+                job.future.cancel()
+            else:
+                job.future.set_exception(error)
+        self._queue.remove(job.guild_id, job.user_id, job)
+
+    def _dispatch(self):
+        while self.running < self.workers and len(self._queue):
+            job = self._queue.pop()
+            if job.future.done():
+                continue
+            try:
+                future = self._get_executor().submit(extract_worker.extract, job.query, job.process, job.overrides)
+            except (BrokenProcessPool, RuntimeError) as e:
+                self._executor = None
+                job.future.set_exception(e)
+                continue
+            self.running += 1
+            job.started = time.perf_counter()
+            asyncio.wrap_future(future).add_done_callback(partial(self._finished, job))
+
+    def _finished(self, job, future):
+        self.running -= 1
+        metrics.EXTRACT_SECONDS.labels(job.kind).observe(time.perf_counter() - job.started)
+        if future.cancelled():
+            # The pool was shut down before the job started
+            if not job.future.done():
+                job.future.set_exception(ExtractionError(f"Lookup of '{job.query}' was cancelled"))
+        elif future.exception() is not None:
+            error = future.exception()
+            if isinstance(error, BrokenProcessPool):
+                # A worker died, start a fresh pool for the next job
+                self._executor = None
+                metrics.EXTRACT_FAILURES.labels('worker_died').inc()
+            else:
+                metrics.EXTRACT_FAILURES.labels('error').inc()
+            if not job.future.done():
+                job.future.set_exception(error)
+        elif not job.future.done():
+            job.future.set_result(future.result())
+        self._dispatch()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,91 @@
+"""Image download and preprocessing for the vision model"""
+import asyncio
+import base64
+import hashlib
+import io
+
+import aiohttp
+
+from config import Config
+
+
+class ImageError(Exception):
+    """Raised when an image can't be downloaded or decoded"""
+
+
+class PreparedImage:
+    """A downscaled image ready to send to Ollama"""
+    __slots__ = ('digest', 'data', 'size', 'original_size')
+
+    def __init__(self, digest, data, size, original_size):
+        self.digest = digest
+        self.data = data                    # base64 encoded JPEG
+        self.size = size                    # (width, height) sent to the model
+        self.original_size = original_size
+
+
+def prepare_image(raw, max_dimension=None):
+    """Decode raw image bytes and downscale to the vision model's input size"""
+    # Pillow is only needed once someone analyzes an image
+    from PIL import Image, ImageOps
+
+    max_dimension = max_dimension or Config.VISION_MAX_DIMENSION
+    digest = hashlib.sha256(raw).hexdigest()
+    try:
+        with Image.open(io.BytesIO(raw)) as image:
+            # Animated formats: the first frame is all llava looks at
+            image.seek(0)
+            image = ImageOps.exif_transpose(image)
+            original_size = image.size
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+            output = io.BytesIO()
+            image.save(output, format='JPEG', quality=Config.VISION_JPEG_QUALITY)
+    except (OSError, SyntaxError, ValueError) as e:
+        raise ImageError(f"Couldn't read that image ({e})") from e
+    data = base64.b64encode(output.getvalue()).decode('ascii')
+    return PreparedImage(digest, data, image.size, original_size)
+
+
+class ImageFetcher:
+    """Downloads images over a shared connection pool"""
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes or Config.IMAGE_MAX_BYTES
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=Config.IMAGE_POOL_SIZE)
+            timeout = aiohttp.ClientTimeout(total=Config.IMAGE_DOWNLOAD_TIMEOUT)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self._session
+
+    async def download(self, url):
+        """Download url, enforcing the byte limit while the data arrives"""
+        limit_mb = self.max_bytes // (1024 * 1024)
+        async with self._get_session().get(url) as response:
+            if response.status != 200:
+                raise ImageError("Failed to download image")
+            if response.content_length is not None and response.content_length > self.max_bytes:
+                raise ImageError(f"Image too large (max {limit_mb}MB)")
+            buffer = bytearray()
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                buffer += chunk
+                if len(buffer) > self.max_bytes:
+                    raise ImageError(f"Image too large (max {limit_mb}MB)")
+            return bytes(buffer)
+
+    async def fetch(self, url):
+        """Download and prepare an image without blocking the event loop"""
+        raw = await self.download(url)
+        return await asyncio.to_thread(prepare_image, raw)
+
+    async def fetch_all(self, urls):
+        """Fetch several images concurrently, returning images or exceptions in order"""
+        return await asyncio.gather(*(self.fetch(url) for url in urls), return_exceptions=True)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
@@ -0,0 +1,210 @@
+"""Admission control and fair queuing for Ollama inference"""
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+from config import Config
+
+
+class QueueFullError(Exception):
+    """Raised when an inference lane has no room for another request"""
+
+    def __init__(self, lane, position):
+        self.lane = lane
+        self.position = position
+        super().__init__(
+            f"I'm swamped right now - you'd be #{position} in line. Try again in a bit!"
+        )
+
+
+class QueueTimeoutError(Exception):
+    """Raised when a request waits in line longer than allowed"""
+
+
+class _Waiter:
+    __slots__ = ('model', 'guild_id', 'user_id', 'future')
+
+    def __init__(self, model, guild_id, user_id, future):
+        self.model = model
+        self.guild_id = guild_id
+        self.user_id = user_id
+        self.future = future
+
+
+class FairQueue:
+    """Round-robin queue across guilds, and across users within each guild"""
+
+    def __init__(self):
+        # guild_id -> OrderedDict(user_id -> deque of items)
+        self._guilds = OrderedDict()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def push(self, guild_id, user_id, item):
+        users = self._guilds.setdefault(guild_id, OrderedDict())
+        users.setdefault(user_id, deque()).append(item)
+        self._size += 1
+
+    def pop(self, predicate=None):
+        """Remove and return the next item in fair order that satisfies predicate"""
+        for guild_id, users in self._guilds.items():
+            for user_id, items in users.items():
+                if predicate is not None and not predicate(items[0]):
+                    continue
+                item = items.popleft()
+                self._size -= 1
+                # Served users and guilds move to the back of the rotation
+                if items:
+                    users.move_to_end(user_id)
+                else:
+                    del users[user_id]
+                if users:
+                    self._guilds.move_to_end(guild_id)
+                else:
+                    del self._guilds[guild_id]
+                return item
+        return None
+
+    def remove(self, guild_id, user_id, item):
+        users = self._guilds.get(guild_id)
+        if not users or user_id not in users:
+            return False
+        items = users[user_id]
+        try:
+            items.remove(item)
+        except ValueError:
+            return False
+        self._size -= 1
+        if not items:
+            del users[user_id]
+            if not users:
+                del self._guilds[guild_id]
+        return True
+
+    def order(self):
+        """Yield queued items in the order they would be served"""
+        guilds = deque(
+            deque(deque(items) for items in users.values())
+            for users in self._guilds.values()
+        )
+        while guilds:
+            users = guilds.popleft()
+            items = users.popleft()
+            yield items.popleft()
+            if items:
+                users.append(items)
+            if users:
+                guilds.append(users)
+
+    def position(self, item):
+        """1-based position of item in serving order"""
+        for index, queued in enumerate(self.order(), 1):
+            if queued is item:
+                return index
+        return None
+
+
+class InferenceScheduler:
+    """Bounds concurrent Ollama work per model and shares it fairly between guilds
+
+    Requests are placed into lanes (e.g. text and vision). Each lane is a
+    FairQueue, lanes are served by weighted round-robin, and every model has
+    its own concurrency limit on top of an overall cap. Both limits are per
+    Ollama host: hosts(model) says how many healthy hosts can run a model,
+    or any model when it is None, and the limits scale with it.
+    """
+
+    def __init__(self, model_limits=None, lane_weights=None, max_active=None,
+                 max_queue_depth=None, queue_timeout=None, hosts=None):
+        self.model_limits = dict(model_limits or Config.INFERENCE_MODEL_CONCURRENCY)
+        self.lane_weights = dict(lane_weights or Config.INFERENCE_LANE_WEIGHTS)
+        self.max_active = max_active or Config.INFERENCE_MAX_ACTIVE
+        self.max_queue_depth = max_queue_depth or Config.INFERENCE_MAX_QUEUE_DEPTH
+        self.queue_timeout = queue_timeout if queue_timeout is not None else Config.INFERENCE_QUEUE_TIMEOUT
+        self.hosts = hosts or (lambda model=None: 1)
+        self.lanes = {lane: FairQueue() for lane in self.lane_weights}
+        self.active = {}
+        self._active_total = 0
+        self._credits = dict(self.lane_weights)
+
+    def _limit(self, model):
+        return self.model_limits.get(model, Config.INFERENCE_DEFAULT_CONCURRENCY) * self.hosts(model)
+
+    def _has_room(self):
+        return self._active_total < self.max_active * self.hosts()
+
+    def _has_capacity(self, model):
+        return self.active.get(model, 0) < self._limit(model)
+
+    def _start(self, model):
+        self.active[model] = self.active.get(model, 0) + 1
+        self._active_total += 1
+
+    def _release(self, model):
+        self.active[model] -= 1
+        self._active_total -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        """Admit queued requests while there is spare capacity"""
+        while self._has_room():
+            eligible = [
+                lane for lane, queue in self.lanes.items()
+                if len(queue) and any(self._has_capacity(w.model) for w in queue.order())
+            ]
+            if not eligible:
+                return
+            # Weighted round-robin between lanes
+            if all(self._credits[lane] <= 0 for lane in eligible):
+                self._credits = dict(self.lane_weights)
+            lane = max(eligible, key=lambda name: self._credits[name])
+            self._credits[lane] -= 1
+
+            waiter = self.lanes[lane].pop(lambda w: self._has_capacity(w.model))
+            if waiter.future.done():
+                continue
+            self._start(waiter.model)
+            waiter.future.set_result(None)
+
+    def queue_depth(self, lane=None):
+        if lane is not None:
+            return len(self.lanes[lane])
+        return sum(len(queue) for queue in self.lanes.values())
+
+    @asynccontextmanager
+    async def slot(self, lane, model, guild_id=None, user_id=None, on_queued=None):
+        """Hold an inference slot for model, waiting fairly in lane if needed
+
+        on_queued is awaited with the caller's position when it has to wait.
+        """
+        queue = self.lanes[lane]
+        if not len(queue) and self._has_capacity(model) and self._has_room():
+            self._start(model)
+        else:
+            if len(queue) >= self.max_queue_depth:
+                raise QueueFullError(lane, len(queue) + 1)
+            waiter = _Waiter(model, guild_id, user_id, asyncio.get_running_loop().create_future())
+            queue.push(guild_id, user_id, waiter)
+            self._dispatch()
+            try:
+                if on_queued is not None and not waiter.future.done():
+                    await on_queued(queue.position(waiter))
+                await asyncio.wait_for(asyncio.shield(waiter.future), self.queue_timeout)
+            except BaseException as e:
+                if waiter.future.done() and not waiter.future.cancelled():
+                    # Admitted just as we gave up, hand the slot back
+                    self._release(model)
+                else:
+                    waiter.future.cancel()
+                    queue.remove(guild_id, user_id, waiter)
+                if isinstance(e, asyncio.TimeoutError):
+                    raise QueueTimeoutError(
+                        "Sorry, I couldn't get to your request in time. Please try again!"
+                    ) from None
+                raise
+        try:
+            yield
+        finally:
+            self._release(model)
@@ -0,0 +1,63 @@
+"""Routes component interactions to handlers by custom_id prefix"""
+import discord
+
+SEPARATOR = ':'
+
+
+class InteractionRouter:
+    """One dict lookup per interaction, on the part of the custom_id before the first ':'
+
+    custom_ids are built by custom_id() as 'prefix:arg:arg' and the args
+    are passed to the handler as strings. All state a handler needs is in
+    the custom_id or looked up from it, so buttons keep working after a
+    restart and no View objects are kept in memory. Interactions without
+    a custom_id, or with a prefix nobody registered (such as the buttons
+    of ordinary in-memory views), are ignored.
+    """
+
+    def __init__(self):
+        self.handlers = {}      # prefix -> async handler(interaction, *args)
+
+    def route(self, prefix):
+        """Decorator registering a handler for a custom_id prefix"""
+        if SEPARATOR in prefix:
+            raise ValueError(f'Route prefixes cannot contain {SEPARATOR!r}: {prefix}')
+
+        def register(handler):
+            if prefix in self.handlers:
+                raise ValueError(f'Route {prefix} is already registered')
+            self.handlers[prefix] = handler
+            return handler
+        return register
+
+    def custom_id(self, prefix, *args):
+        """custom_id for a component that should be routed to prefix"""
+        return SEPARATOR.join((prefix, *map(str, args)))
+
+    def button(self, prefix, *args, **kwargs):
+        return discord.ui.Button(custom_id=self.custom_id(prefix, *args), **kwargs)
+
+    def view(self, *items):
+        """A View to send routed components with
+
+        It is stopped straight away, so discord.py doesn't keep it in its
+        view store for the lifetime of the message.
+        """
+        view = discord.ui.View(timeout=None)
+        for item in items:
+            view.add_item(item)
+        view.stop()
+        return view
+
+    async def dispatch(self, interaction):
+        """Run the handler for an interaction, returning whether there was one"""
+        custom_id = (interaction.data or {}).get('custom_id')
+        if not custom_id:
+            return False
+        prefix, _, rest = custom_id.partition(SEPARATOR)
+        handler = self.handlers.get(prefix)
+        if handler is None:
+            return False
+        args = rest.split(SEPARATOR) if rest else ()
+        await handler(interaction, *args)
+        return True
@@ -0,0 +1,49 @@
+"""Debounced background saving of JSON snapshots"""
+import asyncio
+import json
+import os
+
+
+def write_json(path, data):
+    """Write data to path through a temporary file, so a crash never leaves half a file"""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temporary = f'{path}.tmp'
+    with open(temporary, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(temporary, path)
+
+
+class JSONSaver:
+    """Writes snapshot() to a JSON file in a worker thread
+
+    schedule() is cheap enough to call on every change: while a write is
+    running further calls only mark the data dirty, and one more write
+    with the latest snapshot follows it.
+    """
+
+    def __init__(self, path, snapshot, description):
+        self.path = path
+        self.snapshot = snapshot        # Called on the event loop, returns a copy safe to write
+        self.description = description
+        self._task = None
+        self._dirty = False
+
+    def schedule(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._save_soon())
+        else:
+            self._dirty = True
+
+    async def _save_soon(self):
+        self._dirty = True
+        while self._dirty:
+            self._dirty = False
+            try:
+                await asyncio.to_thread(write_json, self.path, self.snapshot())
+            except OSError as e:
+                print(f'Could not save {self.description}: {e}')
+                return
+
+    def save(self):
+        """Write now (blocking), for shutdown"""
+        write_json(self.path, self.snapshot())
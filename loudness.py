@@ -0,0 +1,110 @@
+"""EBU R128 loudness analysis with a persistent per-track gain cache"""
+import asyncio
+import json
+import re
+from collections import OrderedDict
+
+from config import Config
+from json_saver import JSONSaver
+
+_INTEGRATED = re.compile(rb'I:\s+(-?[\d.]+|-inf) LUFS')
+
+
+async def measure_loudness(stream_url, timeout=None):
+    """Integrated loudness of a stream or local file in LUFS, measured by FFmpeg's ebur128 filter"""
+    # Reconnecting is an HTTP input option, local files (the audio cache) take none
+    reconnect = ('-reconnect', '1', '-reconnect_streamed', '1', '-reconnect_delay_max', '5')
+    process = await asyncio.create_subprocess_exec(
+        'ffmpeg', '-nostdin', '-hide_banner',
+        *(reconnect if stream_url.startswith(('http://', 'https://')) else ()),
+        '-i', stream_url, '-vn', '-sn', '-dn',
+        # Per-frame readings go to the verbose level so only the summary is printed
+        '-af', 'ebur128=framelog=verbose', '-f', 'null', '-',
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        _, stderr = await asyncio.wait_for(
+            process.communicate(), timeout or Config.LOUDNESS_ANALYSIS_TIMEOUT
+        )
+    except BaseException:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+    readings = _INTEGRATED.findall(stderr)
+    if process.returncode != 0 or not readings or readings[-1] == b'-inf':
+        raise RuntimeError('loudness analysis failed')
+    # The summary at the end repeats the final integrated reading
+    return float(readings[-1])
+
+
+class LoudnessCache:
+    """Normalization gain per track key, measured once and kept on disk
+
+    Tracks without a cached gain play unadjusted while they are analysed
+    in the background, and every later play uses the stored value.
+    """
+
+    def __init__(self, path=None, max_entries=None, workers=None):
+        self.path = path or Config.LOUDNESS_CACHE_PATH
+        self.max_entries = max_entries or Config.LOUDNESS_CACHE_SIZE
+        self.gains = OrderedDict()    # track key -> gain in dB
+        self.pending = {}             # track key -> analysis Task
+        self.failed = set()           # Don't retry tracks FFmpeg couldn't measure
+        self._limit = asyncio.Semaphore(workers or Config.LOUDNESS_ANALYSIS_WORKERS)
+        self._saver = JSONSaver(self.path, lambda: dict(self.gains), 'loudness cache')
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                self.gains.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+
+    def gain(self, track):
+        """Cached gain in dB for a track, or None if it hasn't been measured"""
+        gain = self.gains.get(track.key)
+        if gain is not None:
+            self.gains.move_to_end(track.key)
+        return gain
+
+    def analyze(self, track, url=None):
+        """Measure a track in the background unless it is known or in progress
+
+        url overrides the track's stream URL, e.g. with a local copy.
+        """
+        key = track.key
+        url = url or track.stream_url
+        if key in self.gains or key in self.pending or key in self.failed:
+            return
+        if not url or not track.duration or track.duration > Config.LOUDNESS_MAX_DURATION:
+            # Live streams and very long mixes aren't worth a full pass
+            return
+        task = asyncio.create_task(self._analyze(key, url))
+        self.pending[key] = task
+        task.add_done_callback(lambda _: self.pending.pop(key, None))
+
+    async def _analyze(self, key, stream_url):
+        async with self._limit:
+            try:
+                loudness = await measure_loudness(stream_url)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed.add(key)
+                print(f'Loudness analysis failed for {key}: {e}')
+                return
+        gain = Config.LOUDNESS_TARGET - loudness
+        self.gains[key] = round(max(-Config.LOUDNESS_MAX_GAIN, min(gain, Config.LOUDNESS_MAX_GAIN)), 2)
+        while len(self.gains) > self.max_entries:
+            self.gains.popitem(last=False)
+        self._saver.schedule()
+
+    def close(self):
+        for task in self.pending.values():
+            task.cancel()
+        if self.gains:
+            self._saver.save()
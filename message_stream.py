@@ -0,0 +1,125 @@
+"""Helpers for sending long and progressively generated replies"""
+import asyncio
+
+from config import Config
+
+STREAM_CURSOR = ' ▌'
+
+
+def find_split(text, limit):
+    """Find a natural cut point at or before limit"""
+    if len(text) <= limit:
+        return len(text)
+    # Prefer paragraph, then line, then word boundaries in the back half
+    for separator in ('\n\n', '\n', ' '):
+        cut = text.rfind(separator, limit // 2, limit)
+        if cut != -1:
+            return cut + len(separator)
+    return limit
+
+
+def split_message(text, limit=None):
+    """Split text into chunks that fit in a Discord message"""
+    limit = limit or Config.DISCORD_MESSAGE_LIMIT
+    chunks = []
+    while len(text) > limit:
+        cut = find_split(text, limit)
+        chunks.append(text[:cut])
+        text = text[cut:]
+    if text or not chunks:
+        chunks.append(text)
+    return chunks
+
+
+async def send_long_reply(ctx, text, outbound=None):
+    """Reply with text, spilling over into follow-up messages when needed"""
+    chunks = split_message(text)
+    if outbound is not None:
+        # Queued together so nothing else lands between the pages
+        handles = [outbound.reply(ctx, chunks[0])] + [outbound.send(ctx, chunk) for chunk in chunks[1:]]
+        return await handles[-1]
+    message = await ctx.reply(chunks[0])
+    for chunk in chunks[1:]:
+        message = await ctx.send(chunk)
+    return message
+
+
+class StreamingReply:
+    """Reply that grows as tokens arrive, editing on a throttled cadence
+
+    With an OutboundDispatcher the messages are OutboundMessage handles
+    and edits aren't awaited, so an edit still waiting on the rate limit
+    is replaced by the next one instead of both being sent.
+    """
+
+    def __init__(self, ctx, interval=None, limit=None, outbound=None):
+        self.ctx = ctx
+        self.outbound = outbound
+        self.interval = interval if interval is not None else Config.STREAM_EDIT_INTERVAL
+        self.limit = limit or Config.DISCORD_MESSAGE_LIMIT
+        self.messages = []
+        self._parts = []
+        self._text = ''
+        self._start = 0          # Offset of the current message in the full text
+        self._current = None     # Message currently being edited
+        self._shown = None       # Content last sent to the current message
+        self._last_edit = 0.0
+        self._edit = None        # Latest queued edit when using the dispatcher
+
+    @property
+    def text(self):
+        if self._parts:
+            self._text += ''.join(self._parts)
+            self._parts.clear()
+        return self._text
+
+    async def feed(self, chunk):
+        """Add generated text, flushing if the edit interval has elapsed"""
+        if not chunk:
+            return
+        self._parts.append(chunk)
+        now = asyncio.get_running_loop().time()
+        # The first token is shown immediately, later ones are batched
+        if not self.messages or now - self._last_edit >= self.interval:
+            await self.flush()
+
+    async def flush(self, final=False):
+        """Push the buffered text to Discord"""
+        text = self.text
+        room = self.limit if final else self.limit - len(STREAM_CURSOR)
+        # Roll completed pages over into follow-up messages
+        while len(text) - self._start > room:
+            cut = find_split(text[self._start:], self.limit)
+            await self._show(text[self._start:self._start + cut])
+            self._start += cut
+            self._current = None
+            self._shown = None
+        pending = text[self._start:]
+        if pending.strip():
+            await self._show(pending if final else pending + STREAM_CURSOR)
+        self._last_edit = asyncio.get_running_loop().time()
+
+    async def finish(self, fallback="I don't have anything to say to that."):
+        """Send the final state of the reply"""
+        if not self.text.strip():
+            self._parts.append(fallback)
+        await self.flush(final=True)
+        if self._edit is not None:
+            await self._edit
+        return self.messages
+
+    async def _show(self, content):
+        if self._current is None:
+            if self.outbound is not None:
+                self._current = self.outbound.send(self.ctx, content, reply=not self.messages)
+            elif self.messages:
+                self._current = await self.ctx.send(content)
+            else:
+                self._current = await self.ctx.reply(content)
+            self.messages.append(self._current)
+        elif content != self._shown:
+            if self.outbound is not None:
+                self._edit = self._current.edit(content=content)
+            else:
+                await self._current.edit(content=content)
+        self._shown = content
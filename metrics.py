@@ -0,0 +1,219 @@
+"""In-process metrics with an optional Prometheus text endpoint"""
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from config import Config
+
+# Seconds, from a cache hit up to a slow generation on CPU
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+RATE_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 50, 75, 100, 150, 250)
+
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self._children = {}
+        _registry.append(self)
+
+    def labels(self, *values):
+        """The series for a set of label values, created on first use"""
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+        for values, child in list(self._children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+
+class _Count:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        # Everything records from the event loop thread, plain adds are enough
+        self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(_Metric):
+    kind = 'counter'
+    _new_child = _Count
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def _render_child(self, values, child):
+        yield f'{self.name}{_format_labels(self.label_names, values)} {child.value}'
+
+
+class Gauge(_Metric):
+    """Set directly, or computed at scrape time by a collect callback
+
+    collect returns {label values tuple: value}.
+    """
+    kind = 'gauge'
+    _new_child = _Count
+
+    def __init__(self, name, description, labels=(), collect=None):
+        super().__init__(name, description, labels)
+        self.collect = collect
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def render(self):
+        if self.collect is not None:
+            try:
+                values = self.collect()
+            except Exception as e:
+                print(f'Metrics collection failed for {self.name}: {e}')
+                values = {}
+            self._children = {}
+            for label_values, value in values.items():
+                self.labels(*label_values).set(value)
+        return super().render()
+
+    def _render_child(self, values, child):
+        yield f'{self.name}{_format_labels(self.label_names, values)} {child.value}'
+
+
+class _Buckets:
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+
+class Histogram(_Metric):
+    """Fixed buckets chosen up front, so observing is a bisect and two adds"""
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, description, labels)
+
+    def _new_child(self):
+        return _Buckets(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def _render_child(self, values, child):
+        total = 0
+        for bound, count in zip((*self.buckets, '+Inf'), child.counts):
+            total += count
+            bucket = _format_labels(self.label_names, values, 'le="%s"' % bound)
+            yield f'{self.name}_bucket{bucket} {total}'
+        labels = _format_labels(self.label_names, values)
+        yield f'{self.name}_sum{labels} {child.sum}'
+        yield f'{self.name}_count{labels} {total}'
+
+
+def render():
+    """Every registered metric in the Prometheus text exposition format"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# Inference
+OLLAMA_REQUEST_SECONDS = Histogram(
+    'ollama_request_seconds', 'Ollama generation time, request to last token', ['model'])
+OLLAMA_FIRST_TOKEN_SECONDS = Histogram(
+    'ollama_time_to_first_token_seconds', 'Time from request to the first generated text', ['model'])
+OLLAMA_TOKENS_PER_SECOND = Histogram(
+    'ollama_tokens_per_second', 'Generation speed reported by Ollama', ['model'], buckets=RATE_BUCKETS)
+OLLAMA_ERRORS = Counter('ollama_errors_total', 'Failed Ollama requests', ['model'])
+AI_RESPONSE_SECONDS = Histogram(
+    'ai_response_seconds', 'Time to answer an AI request, including queueing and cache hits',
+    ['function', 'model'])
+AI_FIRST_TEXT_SECONDS = Histogram(
+    'ai_time_to_first_text_seconds', 'Time until an AI answer starts to show, including queueing and cache hits',
+    ['function', 'model'])
+
+# Extraction and playback
+EXTRACT_SECONDS = Histogram('ytdl_extract_seconds', 'yt-dlp extraction time', ['kind'])
+EXTRACT_FAILURES = Counter('ytdl_extract_failures_total', 'Failed yt-dlp extractions', ['reason'])
+FFMPEG_PROBE_SECONDS = Histogram('ffmpeg_probe_seconds', 'ffprobe time for streams without codec metadata')
+FFMPEG_STARTUP_SECONDS = Histogram('ffmpeg_startup_seconds', 'Time to spawn the FFmpeg process for a source')
+
+# Commands
+COMMANDS = Counter('bot_commands_total', 'Commands run', ['command', 'status'])
+COMMAND_SECONDS = Histogram('bot_command_seconds', 'Command run time', ['command'])
+
+
+class MetricsServer:
+    """Serves /metrics over HTTP for Prometheus to scrape"""
+
+    def __init__(self, host=None, port=None):
+        self.host = host or Config.METRICS_HOST
+        self.port = port or Config.METRICS_PORT
+        self._runner = None
+
+    @property
+    def running(self):
+        return self._runner is not None
+
+    async def start(self):
+        from aiohttp import web
+
+        async def handle(request):
+            return web.Response(text=render(), content_type='text/plain', charset='utf-8',
+                                headers={'Cache-Control': 'no-store'})
+
+        app = web.Application()
+        app.router.add_get('/metrics', handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, self.host, self.port).start()
+        self._runner = runner
+        print(f'Serving metrics on http://{self.host}:{self.port}/metrics')
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,1027 @@
+import time
+# Taken before anything else is imported so the startup report includes imports
+LAUNCHED_AT = time.perf_counter()
+
+import discord
+from discord.ext import commands
+import os
+from dotenv import load_dotenv
+from config import Config
+import random
+import asyncio
+import metrics
+from startup import ModelWarmup, StartupTimer
+from ollama_client import generation_options
+from ollama_pool import OllamaPool
+from message_stream import StreamingReply, send_long_reply
+from outbound import STATUS, OutboundDispatcher
+from inference_scheduler import InferenceScheduler, QueueFullError, QueueTimeoutError
+from response_cache import ResponseCache
+from conversation import ConversationStore
+from image_pipeline import ImageFetcher
+from tracks import TrackResolver
+from extractor import ExtractionEngine
+from stall_detector import StallDetector
+from state_store import StateStore
+from interactions import InteractionRouter
+from rps import CHOICES, PENDING, GameLimitError, RPSEngine
+from reclaimer import ReclaimStats, TimerWheel
+from player import (GuildPlayer, audio_cache, ffmpeg_reaper, is_cached, loudness_cache, search_index,
+                    stream_monitor)
+
+# Load environment variables
+load_dotenv()
+
+# Bot configuration
+DISCORD_TOKEN = os.getenv('DISCORD_TOKEN')
+
+# Create bot instance
+intents = discord.Intents.default()
+intents.message_content = True
+intents.voice_states = True  # Add voice state intent
+class OllamaBot(commands.Bot):
+    async def close(self):
+        # Runs on Ctrl+C and every other clean exit, while the cogs are still loaded
+        await shutdown()
+        await super().close()
+
+bot = OllamaBot(command_prefix=Config.COMMAND_PREFIX, intents=intents)
+
+# Music settings
+ytdl_format_options = {
+    # Prefer native Opus (WebM) so FFmpeg can copy packets instead of re-encoding
+    'format': 'bestaudio[acodec=opus][ext=webm]/bestaudio[acodec=opus]/bestaudio/best',
+    'restrictfilenames': True,
+    'noplaylist': True,
+    'nocheckcertificate': True,
+    'ignoreerrors': False,
+    'logtostderr': False,
+    'quiet': True,
+    'no_warnings': True,
+    'default_search': 'auto',
+    'source_address': '0.0.0.0',
+    'socket_timeout': Config.EXTRACTOR_SOCKET_TIMEOUT,
+}
+# yt-dlp runs in worker processes, one YoutubeDL per worker
+extraction_engine = ExtractionEngine(ytdl_format_options)
+
+# Shared async Ollama client, routing over every configured host
+ollama_client = OllamaPool()
+
+startup_timer = StartupTimer(LAUNCHED_AT)
+
+# Pulls and preloads the models in the background once the bot starts
+model_warmup = ModelWarmup(ollama_client, {
+    Config.CHAT_MODEL: Config.CHAT_KEEP_ALIVE,
+    Config.VISION_MODEL: Config.VISION_KEEP_ALIVE,
+}, startup_timer)
+
+async def model_ready(ctx, model):
+    """Make sure a model is loaded, telling the user if they have to wait"""
+    if not Config.MODEL_WARMUP or model_warmup.is_ready(model):
+        return True
+    outbound.reply(ctx, f"⏳ **{model}** is still warming up ({model_warmup.status[model]}), one moment...")
+    if await model_warmup.wait_ready(model):
+        return True
+    error = model_warmup.errors.get(model)
+    await outbound.reply(ctx, f"❌ **{model}** isn't available yet" + (f": {error}" if error else ", try again later"))
+    return False
+
+# Admission control in front of every Ollama request, its limits are per healthy host
+inference_scheduler = InferenceScheduler(hosts=lambda model=None: ollama_client.healthy_hosts(model))
+
+# Memory + SQLite cache of generated responses
+response_cache = ResponseCache()
+
+# Every message from the music and AI commands goes through per-channel rate limiting
+outbound = OutboundDispatcher()
+
+# Queues and games saved in the background so they survive a restart
+state_store = StateStore()
+
+# Buttons are dispatched on their custom_id prefix, see interactions.py
+interaction_router = InteractionRouter()
+
+# Rock Paper Scissors sessions, expired and capped
+rps_games = RPSEngine(state_store)
+
+# Leave timeouts and the periodic sweep for idle resources, see reclaimer.py
+idle_timers = TimerWheel()
+reclaimed = ReclaimStats()
+
+def inference_slot(lane, model, ctx=None):
+    """Wait for an inference slot on behalf of the command's author"""
+    guild_id = ctx.guild.id if ctx is not None and ctx.guild else None
+    user_id = ctx.author.id if ctx is not None else None
+
+    async def on_queued(position):
+        if ctx is not None:
+            outbound.send(ctx, f"⏳ You're #{position} in line, hang tight!", reply=True, priority=STATUS)
+
+    return inference_scheduler.slot(lane, model, guild_id, user_id, on_queued)
+
+async def stream_ollama_response(prompt, model=Config.CHAT_MODEL, ctx=None, cache=True,
+                                 on_done=None, **kwargs):
+    """Yield response text from Ollama model as it is generated
+
+    Extra keyword arguments (system, context, keep_alive) go to Ollama and
+    on_done is called with the final chunk of a fresh generation.
+    """
+    started = time.perf_counter()
+    first = True
+    async for text in _stream_ollama_response(prompt, model, ctx, cache, on_done, **kwargs):
+        if first:
+            # Cache hits and queueing included, this is what the user waits for
+            metrics.AI_FIRST_TEXT_SECONDS.labels('stream_ollama_response', model).observe(
+                time.perf_counter() - started)
+            first = False
+        yield text
+    metrics.AI_RESPONSE_SECONDS.labels('stream_ollama_response', model).observe(time.perf_counter() - started)
+
+async def _stream_ollama_response(prompt, model, ctx, cache, on_done, **kwargs):
+    options = generation_options()
+    key = None
+    if cache and response_cache.cacheable(options):
+        key = response_cache.make_key(model, prompt, options, system=kwargs.get('system'))
+        pending = response_cache.inflight(key)
+        if pending is None:
+            cached = await response_cache.get(key)
+            if cached is not None:
+                yield cached
+                return
+            pending = response_cache.inflight(key)
+        if pending is not None:
+            # Same prompt is already generating, share its result
+            yield await asyncio.shield(pending)
+            return
+        response_cache.begin(key)
+
+    parts = []
+    try:
+        async with inference_slot('text', model, ctx):
+            async for chunk in ollama_client.stream_generate(model, prompt, options=options, **kwargs):
+                text = chunk.get('response', '')
+                parts.append(text)
+                if chunk.get('done') and on_done is not None:
+                    on_done(chunk)
+                yield text
+    except BaseException as e:
+        if key is not None:
+            response_cache.fail(key, e if isinstance(e, Exception) else RuntimeError("Generation was cancelled"))
+        raise
+    if key is not None:
+        await response_cache.complete(key, model, ''.join(parts))
+
+async def summarize_conversation(transcript):
+    """Condense older conversation turns into a short summary"""
+    prompt = (
+        "Summarize the key facts, names, preferences and open questions from this "
+        f"conversation in a few sentences:\n\n{transcript}"
+    )
+    async with inference_slot('text', Config.CHAT_MODEL):
+        response = await ollama_client.generate(
+            Config.CHAT_MODEL,
+            prompt,
+            options=generation_options(temperature=0.2),
+            keep_alive=Config.CHAT_KEEP_ALIVE
+        )
+    return response['response']
+
+# Per-channel chat history
+conversations = ConversationStore(summarize=summarize_conversation)
+
+# Pooled image downloads for !analyze
+image_fetcher = ImageFetcher()
+
+async def get_llava_response(image, prompt, ctx=None):
+    """Get response from Llava model for a prepared image"""
+    with metrics.AI_RESPONSE_SECONDS.labels('get_llava_response', Config.VISION_MODEL).time():
+        return await _get_llava_response(image, prompt, ctx)
+
+async def _get_llava_response(image, prompt, ctx):
+    async def generate():
+        async with inference_slot('vision', Config.VISION_MODEL, ctx):
+            response = await ollama_client.generate(
+                Config.VISION_MODEL,
+                prompt,
+                images=[image.data],
+                keep_alive=Config.VISION_KEEP_ALIVE
+            )
+        return response['response']
+
+    try:
+        if response_cache.cacheable():
+            # Reposted images hash the same whatever their filename or URL
+            key = response_cache.make_key(Config.VISION_MODEL, prompt, image=image.digest)
+            return await response_cache.get_or_generate(key, Config.VISION_MODEL, generate)
+        return await generate()
+    except (QueueFullError, QueueTimeoutError) as e:
+        return str(e)
+    except Exception as e:
+        return f"Error processing image: {str(e)}"
+
+async def extract_info(query, guild_id=None, **kwargs):
+    """Run yt-dlp extraction without blocking the event loop"""
+    return await extraction_engine.extract(query, guild_id=guild_id, **kwargs)
+
+class QueueView(discord.ui.View):
+    """Paginated !queue embed with previous/next buttons"""
+
+    def __init__(self, player, author, page=0):
+        super().__init__(timeout=120)
+        self.player = player
+        self.author = author
+        self.page = page
+        self.message = None
+
+    def build_embed(self):
+        queue = self.player.queue
+        tracks, pages = queue.page(self.page, Config.QUEUE_PAGE_SIZE)
+        self.page = min(max(self.page, 0), pages - 1)
+        self.previous_page.disabled = self.page == 0
+        self.next_page.disabled = self.page >= pages - 1
+
+        embed = discord.Embed(title="Song Queue", color=discord.Color.blue())
+        current = self.player.current
+        if current:
+            embed.add_field(
+                name="Now Playing",
+                value=f"🎵 {current.title} `{current.display_duration}`",
+                inline=False
+            )
+            if current.thumbnail:
+                embed.set_thumbnail(url=current.thumbnail)
+
+        # Rendered from memory, no extraction
+        first = self.page * Config.QUEUE_PAGE_SIZE + 1
+        if tracks:
+            embed.add_field(
+                name="Up Next",
+                value="\n".join(
+                    f"{i}. {track.title} `{track.display_duration}`"
+                    for i, track in enumerate(tracks, first)
+                ),
+                inline=False
+            )
+        embed.set_footer(text=f"Page {self.page + 1}/{pages} • {len(queue)} songs")
+        return embed
+
+    async def interaction_check(self, interaction):
+        if interaction.user != self.author:
+            await interaction.response.send_message("Use `!queue` to get your own view!", ephemeral=True)
+            return False
+        return True
+
+    async def on_timeout(self):
+        if self.message:
+            try:
+                await self.message.edit(view=None)
+            except discord.HTTPException:
+                pass
+
+    @discord.ui.button(label="◀ Previous", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction, button):
+        self.page -= 1
+        await interaction.response.edit_message(embed=self.build_embed(), view=self)
+
+    @discord.ui.button(label="Next ▶", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction, button):
+        self.page += 1
+        await interaction.response.edit_message(embed=self.build_embed(), view=self)
+
+# Music-related commands
+class Music(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+        # One GuildPlayer per guild holds its queue, volume and playback task
+        self.players = {}
+        # Guilds whose saved state has already been looked up
+        self.restored = set()
+        # Tracks stored in the audio cache never need a fresh stream URL
+        self.resolver = TrackResolver(extract_info, is_local=is_cached)
+        self.checkpoint_task = None
+
+    async def cog_load(self):
+        self.checkpoint_task = asyncio.create_task(self.checkpoint())
+
+    async def cog_unload(self):
+        if self.checkpoint_task:
+            self.checkpoint_task.cancel()
+        idle_timers.close()
+
+    async def checkpoint(self):
+        """Save the playback position of playing guilds now and then"""
+        while True:
+            await asyncio.sleep(Config.STATE_CHECKPOINT_INTERVAL)
+            for player in self.players.values():
+                if player.is_active:
+                    player.save()
+
+    async def find_player(self, ctx):
+        """The guild's player, if it has one or had a queue before a restart"""
+        guild_id = ctx.guild.id
+        if guild_id not in self.restored:
+            # Saved state is only read when a guild is first touched
+            self.restored.add(guild_id)
+            state = await state_store.get('player', guild_id)
+            if state:
+                self._player(ctx).restore(state)
+        player = self.players.get(guild_id)
+        if player is not None:
+            # Announce in whichever channel the music was last controlled from
+            player.channel = ctx.channel
+        return player
+
+    async def get_player(self, ctx):
+        """Player for the context's guild, created on first use"""
+        return await self.find_player(ctx) or self._player(ctx)
+
+    def _player(self, ctx):
+        player = self.players.get(ctx.guild.id)
+        if player is None:
+            player = self.players[ctx.guild.id] = GuildPlayer(
+                self.bot, ctx.guild, self.resolver, extract_info, ctx.channel, state_store, outbound
+            )
+        return player
+
+    async def release_player(self, guild_id, keep_state=True):
+        """Close a guild's player, keeping its queue saved for next time unless keep_state is False"""
+        player = self.players.pop(guild_id, None)
+        state = player.snapshot() if player is not None and keep_state else None
+        if player is not None:
+            await player.close()
+            reclaimed.record('players')
+        if player is not None or not keep_state:
+            # close() empties the queue, so the snapshot taken before it is what's saved
+            state_store.put('player', guild_id, state)
+        # Read back from the store the next time the guild uses music
+        self.restored.discard(guild_id)
+        extraction_engine.cancel(guild_id)
+        idle_timers.cancel(('empty', guild_id))
+        idle_timers.cancel(('finished', guild_id))
+
+    async def destroy_player(self, guild_id):
+        await self.release_player(guild_id, keep_state=False)
+
+    @commands.Cog.listener()
+    async def on_voice_state_update(self, member, before, after):
+        guild = member.guild
+        if member.id == self.bot.user.id and after.channel is None:
+            # Disconnected by someone else or a dropped connection; !leave has already cleaned up
+            if guild.id in self.players:
+                await self.release_player(guild.id)
+            return
+        voice_client = guild.voice_client
+        if voice_client is None or not Config.LEAVE_ON_EMPTY:
+            return
+        key = ('empty', guild.id)
+        if any(not user.bot for user in voice_client.channel.members):
+            idle_timers.cancel(key)
+        elif key not in idle_timers:
+            idle_timers.schedule(key, Config.LEAVE_ON_EMPTY_DELAY, self.leave_idle, guild.id, 'empty')
+
+    @commands.Cog.listener()
+    async def on_player_idle(self, player):
+        if Config.LEAVE_ON_FINISH and player.voice_client is not None:
+            idle_timers.schedule(('finished', player.guild_id), Config.LEAVE_ON_FINISH_DELAY,
+                                 self.leave_idle, player.guild_id, 'finished')
+
+    async def leave_idle(self, guild_id, reason):
+        """Disconnect from a channel nobody is listening in, or that has nothing left to play"""
+        guild = self.bot.get_guild(guild_id)
+        voice_client = guild.voice_client if guild else None
+        if voice_client is None:
+            return
+        player = self.players.get(guild_id)
+        # Things may have changed since the timer was set
+        if reason == 'empty':
+            if any(not user.bot for user in voice_client.channel.members):
+                return
+            message = "👋 Left the voice channel since everyone else did"
+            if player is not None and not player.is_idle:
+                message += ", `!join` picks the queue back up"
+        else:
+            if player is not None and not player.is_idle:
+                return
+            message = "👋 Left the voice channel, nothing left to play"
+        if player is not None:
+            await player.send(message)
+        await self.release_player(guild_id)
+        await voice_client.disconnect()
+        reclaimed.record('voice sessions')
+
+    async def reclaim(self):
+        """Release players of guilds that stopped using music, and FFmpeg processes nothing plays from"""
+        now = self.bot.loop.time()
+        for guild_id, player in list(self.players.items()):
+            # Connected guilds are left to the leave timers
+            if player.voice_client is None and now - player.active_at > Config.GUILD_IDLE_TIMEOUT:
+                await self.release_player(guild_id)
+        in_use = {id(voice_client.source) for voice_client in self.bot.voice_clients
+                  if getattr(voice_client, 'source', None) is not None}
+        in_use.update(id(player.prepared[1]) for player in self.players.values() if player.prepared)
+        count, size = await ffmpeg_reaper.reap(in_use)
+        reclaimed.record('FFmpeg processes', count, size)
+
+    @commands.command(name='join')
+    async def join(self, ctx):
+        """Join the user's voice channel"""
+        if not ctx.author.voice:
+            return await outbound.send(ctx, "You need to be in a voice channel!")
+        
+        channel = ctx.author.voice.channel
+        if ctx.voice_client:
+            await ctx.voice_client.move_to(channel)
+        else:
+            await channel.connect()
+        
+        await outbound.send(ctx, f"Joined {channel.name}!")
+
+        # Pick up a queue saved before a restart
+        player = await self.find_player(ctx)
+        if player and player.play_queue():
+            await outbound.send(ctx, f"▶️ Picking up where we left off ({len(player.queue)} songs queued)")
+
+    @commands.command(name='play')
+    async def play(self, ctx, *, query):
+        """Play a song or add it to queue"""
+        if not ctx.voice_client:
+            await ctx.invoke(self.join)
+            if not ctx.voice_client:
+                return
+
+        player = await self.get_player(ctx)
+        async with ctx.typing():
+            # Edited into the result, or replaced outright if it hasn't gone out yet
+            processing_msg = outbound.status(ctx, "🔍 Searching for the song...")
+            try:
+                # Extract song info (served from the track cache when possible)
+                track, playlist = await player.resolve_query(query)
+                
+                # The player starts it right away if nothing is playing
+                position = player.enqueue(track, announce=False)
+                if position == 0:
+                    processing_msg.edit(content=f'🎵 Now playing: **{track.title}**')
+                else:
+                    processing_msg.edit(content=f'📝 Added to queue (Position {position}): **{track.title}**')
+
+                if playlist:
+                    # The rest of the playlist streams into the queue in the background
+                    player.start_playlist(query, playlist)
+                    
+            except Exception as e:
+                processing_msg.edit(content=f"❌ An error occurred: {str(e)}")
+
+    @commands.command(name='stop')
+    async def stop(self, ctx):
+        """Stop playing"""
+        if not ctx.voice_client:
+            return await outbound.send(ctx, "I'm not playing anything!")
+            
+        if ctx.voice_client.is_playing() or ctx.voice_client.is_paused():
+            player = await self.get_player(ctx)
+            player.stop()
+            await outbound.send(ctx, "⏹️ Stopped playing")
+        else:
+            await outbound.send(ctx, "Nothing is playing right now!")
+
+    @commands.command(name='pause')
+    async def pause(self, ctx):
+        """Pause the currently playing song"""
+        if ctx.voice_client and ctx.voice_client.is_playing():
+            player = await self.get_player(ctx)
+            player.pause()
+            await outbound.send(ctx, "⏸️ Paused")
+        else:
+            await outbound.send(ctx, "Nothing is playing right now!")
+
+    @commands.command(name='resume')
+    async def resume(self, ctx):
+        """Resume the currently paused song"""
+        if ctx.voice_client and ctx.voice_client.is_paused():
+            player = await self.get_player(ctx)
+            player.resume()
+            await outbound.send(ctx, "▶️ Resumed")
+        else:
+            await outbound.send(ctx, "Nothing is paused right now!")
+
+    @commands.command(name='leave')
+    async def leave(self, ctx):
+        """Leave the voice channel"""
+        if ctx.voice_client:
+            await self.destroy_player(ctx.guild.id)
+            await ctx.voice_client.disconnect()
+            await outbound.send(ctx, "👋 Left the voice channel")
+        else:
+            await outbound.send(ctx, "I'm not in a voice channel!")
+
+    @commands.command(name='volume')
+    async def volume(self, ctx, volume: int):
+        """Change volume (0-200)"""
+        if not ctx.voice_client:
+            return await outbound.send(ctx, "Not connected to a voice channel!")
+
+        if not 0 <= volume <= 200:
+            return await outbound.send(ctx, "Volume must be between 0 and 200!")
+
+        # Applied by FFmpeg, so the current song restarts at the same spot
+        player = await self.get_player(ctx)
+        player.set_volume(volume)
+        await outbound.send(ctx, f"🔊 Volume set to {volume}%")
+
+    @commands.command(name='queue', aliases=['q'])
+    async def queue(self, ctx, page: int = 1):
+        """Show the current queue"""
+        player = await self.find_player(ctx)
+        if player is None or not player.queue:
+            return await outbound.send(ctx, "Queue is empty!")
+
+        view = QueueView(player, ctx.author, page - 1)
+        view.message = await outbound.send(ctx, embed=view.build_embed(), view=view)
+
+    @commands.command(name='remove')
+    async def remove(self, ctx, position: int):
+        """Remove a song from the queue"""
+        player = await self.find_player(ctx)
+        if player is None or not 1 <= position <= len(player.queue):
+            return await outbound.send(ctx, "There's no song at that position!")
+        track = player.queue.pop(position - 1)
+        player.queue_changed()
+        await outbound.send(ctx, f"🗑️ Removed **{track.title}** from the queue")
+
+    @commands.command(name='move')
+    async def move(self, ctx, source: int, destination: int):
+        """Move a song to another position in the queue"""
+        player = await self.find_player(ctx)
+        if player is None or not 1 <= source <= len(player.queue):
+            return await outbound.send(ctx, "There's no song at that position!")
+        destination = max(1, min(destination, len(player.queue)))
+        track = player.queue.move(source - 1, destination - 1)
+        player.queue_changed()
+        await outbound.send(ctx, f"↕️ Moved **{track.title}** to position {destination}")
+
+    @commands.command(name='shuffle')
+    async def shuffle(self, ctx):
+        """Shuffle the queue"""
+        player = await self.find_player(ctx)
+        if player is None or len(player.queue) < 2:
+            return await outbound.send(ctx, "Not enough songs in the queue to shuffle!")
+        player.queue.shuffle()
+        player.queue_changed()
+        await outbound.send(ctx, f"🔀 Shuffled {len(player.queue)} songs (`!unshuffle` to undo)")
+
+    @commands.command(name='unshuffle')
+    async def unshuffle(self, ctx):
+        """Undo the last shuffle"""
+        player = await self.find_player(ctx)
+        if player is None or not player.queue.unshuffle():
+            return await outbound.send(ctx, "Nothing to unshuffle!")
+        player.queue_changed()
+        await outbound.send(ctx, "↩️ Restored the queue order")
+
+    @commands.command(name='jump')
+    async def jump(self, ctx, position: int):
+        """Skip ahead to a position in the queue"""
+        player = await self.find_player(ctx)
+        if player is None or not 1 <= position <= len(player.queue):
+            return await outbound.send(ctx, "There's no song at that position!")
+        if not player.is_active:
+            # Nothing to skip, the songs would be dropped without a jump
+            return await outbound.send(ctx, "Nothing is playing!")
+        player.queue.drop(position - 1)
+        player.queue_changed()
+        player.skip()
+        await outbound.send(ctx, f"⏭️ Jumping to **{player.queue[0].title}**")
+
+    @commands.command(name='skip')
+    async def skip(self, ctx):
+        """Skip the current song"""
+        if not ctx.voice_client or not (ctx.voice_client.is_playing() or ctx.voice_client.is_paused()):
+            return await outbound.send(ctx, "Nothing is playing!")
+            
+        player = await self.get_player(ctx)
+        player.skip()
+        await outbound.send(ctx, "⏭️ Skipped the current song")
+
+    @commands.command(name='clear')
+    async def clear(self, ctx):
+        """Clear the queue"""
+        player = await self.find_player(ctx)
+        if player:
+            player.clear()
+        await outbound.send(ctx, "🗑️ Queue cleared!")
+
+    @commands.command(name='musicstats')
+    async def musicstats(self, ctx):
+        """Show how long the gaps between tracks are"""
+        player = await self.find_player(ctx)
+        if player is None or not player.gaps:
+            return await outbound.send(ctx, "No track transitions measured yet!")
+        await outbound.send(
+            ctx,
+            f"⏱️ Track-to-track gap: last **{player.gaps[-1] * 1000:.0f}ms**, "
+            f"average **{player.track_gap() * 1000:.0f}ms** over {len(player.gaps)} transitions"
+        )
+
+    @commands.command(name='streamstats')
+    async def streamstats(self, ctx):
+        """Show FFmpeg CPU use per voice stream"""
+        stream_monitor.sample()
+        capacity = stream_monitor.estimated_capacity()
+        lines = []
+        for mode, stats in stream_monitor.summary().items():
+            cpu = f"{stats['cpu_percent']:.1f}% CPU/stream" if stats['cpu_percent'] is not None else "no data yet"
+            line = f"**{mode}**: {stats['active']} active, {stats['finished']} finished, {cpu}"
+            if mode in capacity:
+                line += f" (~{capacity[mode]} streams per host)"
+            lines.append(line)
+        if audio_cache is not None:
+            stats = audio_cache.stats()
+            lines.append(
+                f"**audio cache**: {stats['tracks']} songs, {stats['bytes'] / 1024 ** 2:.0f} MB, "
+                f"{stats['hits']} local plays, {stats['filling']} downloading"
+            )
+        await outbound.send(ctx, "📊 " + "\n".join(lines))
+
+# Scrape-time gauges, nothing is recorded on the hot path
+def collect_queue_depths():
+    music = bot.get_cog('Music')
+    if music is None:
+        return {}
+    return {(str(guild_id),): len(player.queue) for guild_id, player in music.players.items()}
+
+metrics.Gauge('music_queue_depth', 'Songs waiting in each guild queue', ['guild'],
+              collect=collect_queue_depths)
+metrics.Gauge('voice_sessions', 'Connected voice clients',
+              collect=lambda: {(): len(bot.voice_clients)})
+metrics.Gauge('inference_queue_depth', 'AI requests waiting for a slot', ['lane'],
+              collect=lambda: {(lane,): inference_scheduler.queue_depth(lane)
+                               for lane in inference_scheduler.lanes})
+metrics.Gauge('ytdl_extractions', 'yt-dlp jobs by state', ['state'],
+              collect=lambda: {('queued',): extraction_engine.queued,
+                               ('running',): extraction_engine.running})
+
+metrics.Gauge('ollama_host_up', 'Whether each Ollama host passed its last check', ['host'],
+              collect=lambda: {(host['host'],): int(host['healthy']) for host in ollama_client.status()})
+metrics.Gauge('ollama_model_loaded', 'Models resident on each Ollama host', ['host', 'model'],
+              collect=lambda: {(host['host'], model): 1 for host in ollama_client.status()
+                               for model in host['loaded']})
+
+metrics_server = metrics.MetricsServer()
+
+# Watchdog for code that blocks the event loop
+stall_detector = StallDetector()
+
+@bot.before_invoke
+async def start_command_timer(ctx):
+    ctx.started_at = time.perf_counter()
+    stall_detector.label(f'!{ctx.command.qualified_name}')
+
+@bot.after_invoke
+async def record_command(ctx):
+    # Runs after every invoked command, failed or not
+    name = ctx.command.qualified_name
+    metrics.COMMANDS.labels(name, 'error' if ctx.command_failed else 'ok').inc()
+    metrics.COMMAND_SECONDS.labels(name).observe(time.perf_counter() - ctx.started_at)
+    startup_timer.mark('first command')
+
+async def reclaim_idle():
+    """Release whatever has gone idle, then check again after RECLAIM_INTERVAL"""
+    try:
+        music = bot.get_cog('Music')
+        if music is not None:
+            await music.reclaim()
+        for host, model, size in await ollama_client.unload_idle(Config.MODEL_IDLE_UNLOAD):
+            print(f'Unloaded idle {model} from {host}')
+            reclaimed.record('models', 1, size)
+    finally:
+        idle_timers.schedule('reclaim', Config.RECLAIM_INTERVAL, reclaim_idle)
+
+@bot.event
+async def setup_hook():
+    """One-time initialization, before the gateway connects"""
+    # Add music cog
+    await bot.add_cog(Music(bot))
+
+    if Config.STALL_DETECTOR_ENABLED:
+        stall_detector.start()
+
+    if Config.METRICS_ENABLED:
+        try:
+            await metrics_server.start()
+        except OSError as e:
+            print(f"Couldn't start the metrics endpoint: {e}")
+
+    # Slow work runs in the background so commands are answered right away
+    ollama_client.start()
+    idle_timers.schedule('reclaim', Config.RECLAIM_INTERVAL, reclaim_idle)
+    if Config.MODEL_WARMUP:
+        model_warmup.start()
+    asyncio.create_task(search_index.load_async())
+    startup_timer.mark('setup')
+
+_shut_down = False
+
+async def shutdown():
+    """Write out pending state and close every cache and connection"""
+    global _shut_down
+    if _shut_down:
+        return
+    _shut_down = True
+    idle_timers.close()
+    model_warmup.stop()
+    music = bot.get_cog('Music')
+    if music is not None:
+        for player in music.players.values():
+            # Latest playback position, not the last checkpoint
+            player.save()
+    await state_store.close()
+    await search_index.close()
+    loudness_cache.close()
+    if audio_cache is not None:
+        audio_cache.close()
+    response_cache.close()
+    await image_fetcher.close()
+    await ollama_client.close()
+    extraction_engine.shutdown()
+    stall_detector.stop()
+    await metrics_server.stop()
+
+@bot.event
+async def on_ready():
+    # Runs again after every reconnect, so nothing here should only happen once
+    print(f'{bot.user} has connected to Discord!')
+    startup_timer.mark('connected')
+    await bot.change_presence(activity=discord.Game(name=Config.PLAYING_STATUS))
+
+@bot.command(name='ask')
+async def ask(ctx, *, question):
+    """Command to ask a question to the Ollama model"""
+    if not await model_ready(ctx, Config.CHAT_MODEL):
+        return
+    reply = StreamingReply(ctx, outbound=outbound)
+    conversation = conversations.get(ctx.channel.id)
+    prompt, kwargs = conversation.request(question)
+    # Only a brand new conversation gives an answer worth sharing via the cache
+    fresh = conversation.context is None and not conversation.turns and not conversation.summary
+    final = {}
+    parts = []
+    async with ctx.typing():
+        try:
+            async for text in stream_ollama_response(prompt, ctx=ctx, cache=fresh,
+                                                     on_done=final.update, **kwargs):
+                parts.append(text)
+                await reply.feed(text)
+        except (QueueFullError, QueueTimeoutError) as e:
+            return await outbound.reply(ctx, str(e))
+        except Exception as e:
+            await reply.feed(f"\n\nError: {str(e)}")
+        else:
+            conversations.record(conversation, question, ''.join(parts), final.get('context'))
+        await reply.finish()
+
+@bot.command(name='forget')
+async def forget(ctx):
+    """Clear the AI's memory of this channel's conversation"""
+    conversations.forget(ctx.channel.id)
+    await outbound.reply(ctx, "🧹 Okay, I've forgotten our conversation here!")
+
+@bot.command(name='analyze')
+async def analyze(ctx, *, prompt=None):
+    """Analyze attached images using Llava"""
+    if not ctx.message.attachments:
+        await outbound.reply(ctx, "Please attach an image to analyze!")
+        return
+
+    attachments = [
+        attachment for attachment in ctx.message.attachments
+        if (attachment.content_type or '').startswith('image/')
+    ][:Config.IMAGE_MAX_ATTACHMENTS]
+    if not attachments:
+        await outbound.reply(ctx, "Please provide a valid image file!")
+        return
+
+    # Default prompt if none provided
+    if not prompt:
+        prompt = "Describe this image in detail."
+
+    if not await model_ready(ctx, Config.VISION_MODEL):
+        return
+
+    async with ctx.typing():
+        try:
+            # Send initial response to let user know processing has started
+            outbound.send(ctx, "Processing your image... This may take a minute.", reply=True, priority=STATUS)
+
+            # Download and downscale every image at once
+            images = await image_fetcher.fetch_all([attachment.url for attachment in attachments])
+
+            async def describe(image):
+                if isinstance(image, Exception):
+                    return f"Error: {str(image)}"
+                return await get_llava_response(image, prompt, ctx=ctx)
+
+            responses = await asyncio.gather(*(describe(image) for image in images))
+            if len(responses) == 1:
+                response = responses[0]
+            else:
+                response = "\n\n".join(
+                    f"**Image {i}:** {text}" for i, text in enumerate(responses, 1)
+                )
+            await send_long_reply(ctx, response, outbound)
+        except Exception as e:
+            await outbound.reply(ctx, f"Error: {str(e)}")
+
+@bot.command(name='status')
+async def status(ctx):
+    """Show model readiness, Ollama hosts and startup timings"""
+    lines = []
+    for model, state in model_warmup.status.items():
+        icon = '✅' if state == 'ready' else '⏳' if state != 'failed' else '❌'
+        lines.append(f"{icon} **{model}**: {state}")
+    for host in ollama_client.status():
+        state = ', '.join(host['loaded']) or 'nothing loaded'
+        if not host['healthy']:
+            state = f"down ({host['error']})"
+        lines.append(f"{'🟢' if host['healthy'] else '🔴'} {host['host']}: {state}")
+    lines.append(f"🚀 Startup: {startup_timer.summary() or 'in progress'}")
+    lines.append(f"♻️ Reclaimed: {reclaimed.summary() or 'nothing yet'}")
+    await ctx.send("\n".join(lines))
+
+@bot.command(name='stalls')
+async def stalls(ctx, top: int = 5):
+    """Show the code that blocked the event loop the longest"""
+    report = stall_detector.report(top)
+    if not report:
+        return await ctx.send("✅ No event loop stalls recorded")
+    lines = [
+        f"🐢 {stall_detector.stalls} stalls, {stall_detector.total_blocked:.1f}s blocked "
+        f"(threshold {stall_detector.threshold * 1000:.0f}ms)"
+    ]
+    for i, entry in enumerate(report, 1):
+        activities = ', '.join(f"{name} ×{count}" for name, count in entry['activities'])
+        lines.append(
+            f"**{i}.** `{entry['site']}`\n"
+            f"    {entry['count']}× · {entry['blocked']:.2f}s total · longest {entry['longest'] * 1000:.0f}ms · {activities}"
+        )
+    await send_long_reply(ctx, "\n".join(lines))
+
+@bot.command(name='aihelp')
+async def aihelp(ctx):
+    """Custom help command"""
+    help_text = """
+    **Available Commands:**
+    
+    AI Commands:
+    `!ask [question]` - Ask a question to the AI
+    `!analyze [prompt]` - Analyze an attached image (optional prompt)
+    `!forget` - Clear the AI's memory of this channel
+    
+    Music Commands:
+    `!join` - Join your voice channel
+    `!play [song]` - Play a song (URL or search term)
+    `!queue [page]` or `!q` - Show the queue
+    `!remove [position]` - Remove a song from the queue
+    `!move [from] [to]` - Move a song in the queue
+    `!shuffle` / `!unshuffle` - Shuffle the queue or undo it
+    `!jump [position]` - Skip ahead to a song in the queue
+    `!skip` - Skip the current song
+    `!pause` / `!resume` - Pause or resume the music
+    `!volume [0-200]` - Change the volume
+    `!stop` - Stop playing music
+    `!clear` - Clear the queue
+    `!musicstats` - Show the gaps between songs
+    `!streamstats` - Show FFmpeg CPU use per stream
+    `!leave` - Leave the voice channel
+    
+    Game Commands:
+    `!rps @user` - Challenge someone to Rock Paper Scissors
+    
+    Other Commands:
+    `!status` - Show model warm-up, Ollama hosts and startup timings
+    `!stalls [top]` - Show code that blocked the event loop
+    `!aihelp` - Show this help message
+    
+    **Examples:**
+    `!ask What is artificial intelligence?`
+    `!analyze What objects are in this image?` (with attached image)
+    `!play Despacito`
+    `!rps @friend`
+    """
+    await ctx.send(help_text)
+
+@bot.command(name='rps')
+async def rps(ctx, opponent: discord.Member):
+    """Challenge someone to Rock Paper Scissors"""
+    if opponent.bot:
+        await ctx.send("You can't challenge a bot!")
+        return
+    
+    if opponent == ctx.author:
+        await ctx.send("You can't challenge yourself!")
+        return
+
+    try:
+        game = rps_games.create(ctx.message.id, ctx.author, opponent)
+    except GameLimitError as e:
+        await ctx.send(f"❌ {e}")
+        return
+
+    view = interaction_router.view(
+        # The players are in the custom_ids too, for when the game has expired
+        interaction_router.button('rps-accept', game.id, game.opponent,
+                                  style=discord.ButtonStyle.primary, label="Accept Challenge"),
+        interaction_router.button('rps-decline', game.id, *game.players,
+                                  style=discord.ButtonStyle.secondary, label="Decline"),
+    )
+    await ctx.send(f"{opponent.mention}, {ctx.author.name} challenges you to Rock Paper Scissors!", view=view)
+
+async def game_user(game, user_id, interaction):
+    """A player's User, from the game or the cache before asking the API"""
+    user = game.users.get(user_id)
+    if user is None and interaction.guild is not None:
+        user = interaction.guild.get_member(user_id)
+    if user is None:
+        user = bot.get_user(user_id) or await bot.fetch_user(user_id)
+    game.users[user_id] = user
+    return user
+
+async def close_challenge(interaction, user_ids, **changes):
+    """Take the buttons off a challenge that is over, if the user was part of it"""
+    if str(interaction.user.id) not in user_ids:
+        await interaction.response.send_message("This challenge isn't for you!", ephemeral=True)
+        return
+    await interaction.response.edit_message(view=None, **changes)
+
+@interaction_router.route('rps-accept')
+async def accept_rps(interaction, game_id, opponent_id=None):
+    game = await rps_games.get(game_id)
+    if game is None:
+        await close_challenge(interaction, (opponent_id,), content="This challenge has expired!")
+        return
+    if interaction.user.id != game.opponent:
+        await interaction.response.send_message("This challenge isn't for you!", ephemeral=True)
+        return
+    if game.state != PENDING:
+        await interaction.response.send_message("This game has already started!", ephemeral=True)
+        return
+
+    rps_games.accept(game)
+    # Choice buttons for both players
+    choice_view = interaction_router.view(*(
+        interaction_router.button('rps', game.id, letter, style=discord.ButtonStyle.secondary, label=label)
+        for letter, label in CHOICES.items()
+    ))
+    await interaction.response.edit_message(content="Game started! Check your DMs to make your choice.", view=None)
+    for player_id in game.players:
+        player = await game_user(game, player_id, interaction)
+        await player.send("Make your choice:", view=choice_view)
+
+@interaction_router.route('rps-decline')
+async def decline_rps(interaction, game_id, *player_ids):
+    game = await rps_games.get(game_id)
+    if game is None or game.state != PENDING:
+        await close_challenge(interaction, player_ids)
+        return
+    if interaction.user.id not in game.players:
+        await interaction.response.send_message("This challenge isn't for you!", ephemeral=True)
+        return
+    rps_games.cancel(game)
+    await interaction.response.edit_message(content=f"{interaction.user.name} called off the challenge.", view=None)
+
+@interaction_router.route('rps')
+async def choose_rps(interaction, game_id, choice):
+    game = await rps_games.get(game_id)
+    if game is None:
+        await interaction.response.send_message("This game has expired!", ephemeral=True)
+        return
+        
+    player_id = interaction.user.id
+    if player_id not in game.players:
+        await interaction.response.send_message("This isn't your game!", ephemeral=True)
+        return
+        
+    if player_id in game.choices:
+        await interaction.response.send_message("You've already made your choice!", ephemeral=True)
+        return
+        
+    game.users[player_id] = interaction.user
+    finished = rps_games.choose(game, player_id, choice)
+    await interaction.response.send_message(f"You chose {CHOICES[choice]}!", ephemeral=True)
+    
+    if finished:
+        # Both players have made their choices
+        result_message = game.result()
+        for user_id in game.players:
+            player = await game_user(game, user_id, interaction)
+            await player.send(result_message)
+
+@bot.event
+async def on_interaction(interaction):
+    await interaction_router.dispatch(interaction)
+
+startup_timer.mark('imported')
+
+def main():
+    # Started from discord_ollama_bot.py
+    bot.run(DISCORD_TOKEN)
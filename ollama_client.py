@@ -0,0 +1,156 @@
+"""Async streaming client for the Ollama HTTP API"""
+import json
+import time
+
+import aiohttp
+
+import metrics
+from config import Config
+
+
+class OllamaError(Exception):
+    """Raised when the Ollama server reports an error"""
+
+
+def full_model_name(model):
+    """Model name with the implicit :latest tag Ollama reports"""
+    return model if ':' in model else f'{model}:latest'
+
+
+def generation_options(**overrides):
+    """Build the Ollama generation options from the config"""
+    options = {
+        'temperature': Config.TEMPERATURE,
+        'top_p': Config.TOP_P,
+        'top_k': Config.TOP_K,
+        'num_predict': Config.MAX_TOKENS,
+    }
+    options.update(overrides)
+    return options
+
+
+class OllamaClient:
+    """Talks to Ollama over a single pooled HTTP session"""
+
+    def __init__(self, host=None):
+        self.host = (host or Config.OLLAMA_HOST).rstrip('/')
+        self._session = None
+
+    def _get_session(self):
+        """Create the shared session on first use"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=Config.OLLAMA_POOL_SIZE,
+                keepalive_timeout=Config.OLLAMA_KEEPALIVE_TIMEOUT
+            )
+            timeout = aiohttp.ClientTimeout(
+                total=None,
+                sock_connect=Config.OLLAMA_CONNECT_TIMEOUT,
+                sock_read=Config.OLLAMA_READ_TIMEOUT
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self._session
+
+    async def stream_generate(self, model, prompt, **kwargs):
+        """Yield /api/generate chunks as soon as Ollama emits them"""
+        payload = {'model': model, 'prompt': prompt, 'stream': True}
+        payload.update(kwargs)
+        session = self._get_session()
+        started = time.perf_counter()
+        first_token = False
+        try:
+            async with session.post(f'{self.host}/api/generate', json=payload) as response:
+                if response.status != 200:
+                    raise OllamaError(f"Ollama returned HTTP {response.status}: {await response.text()}")
+
+                # Ollama streams newline-delimited JSON. The final chunk carries the
+                # whole context array, so lines are split by hand instead of relying
+                # on readline() and its 64KB line limit.
+                buffer = b''
+                async for data in response.content.iter_any():
+                    buffer += data
+                    *lines, buffer = buffer.split(b'\n')
+                    for line in lines:
+                        chunk = _parse_chunk(line)
+                        if chunk is None:
+                            continue
+                        if not first_token and chunk.get('response'):
+                            first_token = True
+                            metrics.OLLAMA_FIRST_TOKEN_SECONDS.labels(model).observe(time.perf_counter() - started)
+                        if chunk.get('done'):
+                            _record_generation(model, started, chunk)
+                        yield chunk
+                        if chunk.get('done'):
+                            return
+                chunk = _parse_chunk(buffer)
+                if chunk is not None:
+                    yield chunk
+        except Exception:
+            metrics.OLLAMA_ERRORS.labels(model).inc()
+            raise
+
+    async def generate(self, model, prompt, **kwargs):
+        """Run a generation to completion and return the final chunk with the full response"""
+        return await collect_response(self.stream_generate(model, prompt, **kwargs))
+
+    async def list_models(self):
+        """Names of the models installed on the server"""
+        async with self._get_session().get(f'{self.host}/api/tags') as response:
+            if response.status != 200:
+                raise OllamaError(f"Ollama returned HTTP {response.status}: {await response.text()}")
+            data = await response.json()
+        return [model['name'] for model in data.get('models', [])]
+
+    async def running_models(self):
+        """Models currently loaded in memory, by name, with the bytes each takes up"""
+        async with self._get_session().get(f'{self.host}/api/ps') as response:
+            if response.status != 200:
+                raise OllamaError(f"Ollama returned HTTP {response.status}: {await response.text()}")
+            data = await response.json()
+        return {model['name']: model.get('size', 0) for model in data.get('models', [])}
+
+    async def pull(self, model):
+        """Download a model, returning once Ollama reports it is complete"""
+        payload = {'model': model, 'stream': True}
+        async with self._get_session().post(f'{self.host}/api/pull', json=payload) as response:
+            if response.status != 200:
+                raise OllamaError(f"Ollama returned HTTP {response.status}: {await response.text()}")
+            # Progress lines are small, readline is fine here
+            async for line in response.content:
+                _parse_chunk(line)
+
+    async def close(self):
+        """Close the pooled session"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+
+async def collect_response(chunks):
+    """Read a stream of /api/generate chunks into the final one with the full response"""
+    parts = []
+    final = {}
+    async for chunk in chunks:
+        parts.append(chunk.get('response', ''))
+        if chunk.get('done'):
+            final = dict(chunk)
+    final['response'] = ''.join(parts)
+    return final
+
+
+def _record_generation(model, started, chunk):
+    metrics.OLLAMA_REQUEST_SECONDS.labels(model).observe(time.perf_counter() - started)
+    # Ollama reports eval_duration in nanoseconds
+    if chunk.get('eval_count') and chunk.get('eval_duration'):
+        rate = chunk['eval_count'] / (chunk['eval_duration'] / 1e9)
+        metrics.OLLAMA_TOKENS_PER_SECOND.labels(model).observe(rate)
+
+
+def _parse_chunk(line):
+    """Decode one NDJSON line, raising on server-side errors"""
+    line = line.strip()
+    if not line:
+        return None
+    chunk = json.loads(line)
+    if 'error' in chunk:
+        raise OllamaError(chunk['error'])
+    return chunk
@@ -0,0 +1,241 @@
+"""Routes Ollama requests across several hosts by which models they have loaded"""
+import asyncio
+import time
+
+import aiohttp
+
+import metrics
+from config import Config
+from ollama_client import OllamaClient, OllamaError, collect_response, full_model_name
+
+OLLAMA_FAILOVERS = metrics.Counter('ollama_failovers_total', 'Requests retried on another Ollama host', ['host'])
+
+# Errors that say nothing about the request itself, so another host may succeed
+_HOST_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, OSError)
+
+
+class _Host:
+    __slots__ = ('client', 'url', 'healthy', 'loaded', 'installed', 'in_flight', 'error', 'sizes', 'used')
+
+    def __init__(self, url):
+        self.client = OllamaClient(url)
+        self.url = self.client.host
+        self.healthy = True         # Assumed until a check or request says otherwise
+        self.loaded = set()         # Models in memory, from /api/ps
+        self.installed = set()      # Models on disk, from /api/tags
+        self.in_flight = 0
+        self.error = None
+        self.sizes = {}             # Model -> bytes in memory, from /api/ps
+        self.used = {}              # Model -> when it last answered a request here
+
+
+class OllamaPool:
+    """Drop-in replacement for OllamaClient that spreads work over several hosts
+
+    Each request goes to the healthy host that already has its model in
+    memory, so chat and vision traffic stop evicting each other when there
+    is more than one GPU. Hosts pinned to a model are tried before the
+    rest. A background task polls /api/ps and /api/tags on every host, and
+    a request whose host can't be reached, times out or errors before the
+    first chunk is retried on the next candidate.
+    """
+
+    def __init__(self, hosts=None, pins=None):
+        if pins is None:
+            pins = {Config.CHAT_MODEL: Config.OLLAMA_CHAT_HOSTS, Config.VISION_MODEL: Config.OLLAMA_VISION_HOSTS}
+        urls = list(hosts or Config.OLLAMA_HOSTS)
+        for pinned in pins.values():
+            urls.extend(pinned)
+        self.hosts = {}
+        for url in urls:
+            host = _Host(url)
+            self.hosts.setdefault(host.url, host)
+        self.pins = {
+            full_model_name(model): {url.rstrip('/') for url in pinned}
+            for model, pinned in pins.items() if pinned
+        }
+        self._checking = None
+
+    def start(self):
+        """Start the background health checks"""
+        if self._checking is None:
+            self._checking = asyncio.create_task(self._check_loop())
+
+    async def _check_loop(self):
+        while True:
+            try:
+                await self.check()
+            except Exception as e:
+                # _check handles each host, this only keeps the loop alive whatever happens
+                print(f'Ollama health check failed: {e}')
+            await asyncio.sleep(Config.OLLAMA_HEALTH_INTERVAL)
+
+    async def check(self):
+        """Refresh the health and loaded models of every host"""
+        await asyncio.gather(*(self._check(host) for host in self.hosts.values()))
+
+    async def _check(self, host):
+        try:
+            loaded, installed = await asyncio.wait_for(
+                asyncio.gather(host.client.running_models(), host.client.list_models()),
+                Config.OLLAMA_HEALTH_TIMEOUT)
+            sizes = {full_model_name(name): size for name, size in loaded.items()}
+            installed = {full_model_name(name) for name in installed}
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Anything, including an unexpected response body, only takes this host out
+            if host.healthy:
+                print(f'Ollama host {host.url} is unavailable: {e or type(e).__name__}')
+            host.healthy = False
+            host.error = str(e) or type(e).__name__
+            return
+        if not host.healthy:
+            print(f'Ollama host {host.url} is back')
+        host.healthy = True
+        host.error = None
+        host.loaded = set(sizes)
+        host.sizes = sizes
+        # Anything loaded by someone else counts as idle from when it was first seen
+        now = time.monotonic()
+        host.used = {name: host.used.get(name, now) for name in host.loaded}
+        host.installed = installed
+
+    def candidates(self, model):
+        """Hosts to try for a model, best first"""
+        name = full_model_name(model)
+        pinned = self.pins.get(name, ())
+
+        def rank(host):
+            return (
+                not host.healthy,
+                bool(pinned) and host.url not in pinned,
+                name not in host.loaded,
+                name not in host.installed,
+                # A model that has to be loaded goes where it will evict the least
+                0 if name in host.loaded else len(host.loaded),
+                host.in_flight,
+            )
+        return sorted(self.hosts.values(), key=rank)
+
+    def healthy_hosts(self, model=None):
+        """How many healthy hosts can serve model (any model if None), at least one
+
+        A pinned model only counts the hosts it is pinned to.
+        """
+        hosts = [host for host in self.hosts.values() if host.healthy]
+        pinned = self.pins.get(full_model_name(model)) if model else None
+        if pinned:
+            hosts = [host for host in hosts if host.url in pinned]
+        return max(1, len(hosts))
+
+    async def stream_generate(self, model, prompt, **kwargs):
+        """Yield /api/generate chunks from the best host, failing over until the first one arrives"""
+        name = full_model_name(model)
+        last_error = None
+        for host in self.candidates(model):
+            if last_error is not None:
+                OLLAMA_FAILOVERS.labels(host.url).inc()
+                print(f'Retrying {model} on {host.url}: {last_error}')
+            started = False
+            host.in_flight += 1
+            try:
+                async for chunk in host.client.stream_generate(model, prompt, **kwargs):
+                    started = True
+                    yield chunk
+            except OllamaError as e:
+                # The host answered, it just couldn't run this model
+                host.loaded.discard(name)
+                if started:
+                    raise
+                last_error = e
+                continue
+            except _HOST_ERRORS as e:
+                host.healthy = False
+                host.error = str(e) or type(e).__name__
+                host.loaded.discard(name)
+                if started:
+                    raise
+                last_error = e
+                continue
+            finally:
+                host.in_flight -= 1
+                host.used[name] = time.monotonic()
+            # keep_alive=0 asks Ollama to unload the model once it answers
+            if kwargs.get('keep_alive') in (0, '0'):
+                host.loaded.discard(name)
+            else:
+                host.loaded.add(name)
+                host.installed.add(name)
+            host.healthy = True
+            return
+        raise last_error or OllamaError('No Ollama hosts configured')
+
+    async def generate(self, model, prompt, **kwargs):
+        """Run a generation to completion and return the final chunk with the full response"""
+        return await collect_response(self.stream_generate(model, prompt, **kwargs))
+
+    async def list_models(self):
+        """Models installed on any reachable host"""
+        await self.check()
+        reachable = [host for host in self.hosts.values() if host.healthy]
+        if not reachable:
+            raise OllamaError('No Ollama host is reachable: ' + ', '.join(
+                f'{host.url} ({host.error})' for host in self.hosts.values()))
+        return sorted(set().union(*(host.installed for host in reachable)))
+
+    async def pull(self, model):
+        """Download a model onto the best host for it"""
+        name = full_model_name(model)
+        last_error = None
+        for host in self.candidates(model):
+            try:
+                await host.client.pull(model)
+            except (OllamaError, *_HOST_ERRORS) as e:
+                last_error = e
+                continue
+            host.installed.add(name)
+            return
+        raise last_error or OllamaError('No Ollama hosts configured')
+
+    async def unload_idle(self, windows):
+        """Unload models not used on a host for their window in seconds
+
+        windows maps model -> seconds, None or other models are left alone
+        (Ollama still unloads them after their keep_alive). Returns
+        (host, model, bytes) for everything unloaded.
+        """
+        now = time.monotonic()
+        unloaded = []
+        for model, window in windows.items():
+            if window is None:
+                continue
+            name = full_model_name(model)
+            for host in self.hosts.values():
+                if name not in host.loaded or host.in_flight or now - host.used.get(name, now) < window:
+                    continue
+                try:
+                    # An empty prompt with keep_alive=0 makes Ollama unload the model
+                    await host.client.generate(model, '', keep_alive=0)
+                except (OllamaError, *_HOST_ERRORS) as e:
+                    print(f'Could not unload {model} from {host.url}: {e or type(e).__name__}')
+                    continue
+                host.loaded.discard(name)
+                unloaded.append((host.url, name, host.sizes.pop(name, 0)))
+        return unloaded
+
+    def status(self):
+        """Per-host health, load and resident models"""
+        return [
+            {'host': host.url, 'healthy': host.healthy, 'in_flight': host.in_flight,
+             'loaded': sorted(host.loaded), 'error': host.error}
+            for host in self.hosts.values()
+        ]
+
+    async def close(self):
+        """Stop the health checks and close every host's session"""
+        if self._checking is not None:
+            self._checking.cancel()
+            self._checking = None
+        for host in self.hosts.values():
+            await host.client.close()
@@ -0,0 +1,230 @@
+"""Per-channel outbound message queue with priorities and coalescing"""
+import asyncio
+import time
+from collections import deque
+
+import metrics
+from config import Config
+
+# Priorities, lowest first
+REPLY = 0       # Direct answers to a command
+STATUS = 1      # Progress messages that are usually edited later
+NOTICE = 2      # Announcements nobody is waiting on, merged when they pile up
+
+_PRIORITY_NAMES = ('reply', 'status', 'notice')
+
+OUTBOUND_SENT = metrics.Counter('outbound_messages_total', 'Messages sent and edited', ['priority', 'action'])
+OUTBOUND_MERGED = metrics.Counter(
+    'outbound_merged_total', 'Edits and notices folded into one already queued', ['action'])
+OUTBOUND_WAIT_SECONDS = metrics.Histogram(
+    'outbound_wait_seconds', 'Time a message waited for the channel rate limit', ['priority'])
+
+
+class OutboundMessage:
+    """Handle for a message sent through the dispatcher
+
+    Await it for the discord.Message. edit() can be called before the
+    message has even gone out: the new content replaces whatever is still
+    waiting, so only the latest version is sent.
+    """
+
+    def __init__(self, dispatcher, channel, priority):
+        self.dispatcher = dispatcher
+        self.channel = channel
+        self.priority = priority
+        self.message = None
+        self.sent = asyncio.get_running_loop().create_future()
+        self._waiting = None    # Queued op for this message that hasn't started
+
+    def __await__(self):
+        return self.sent.__await__()
+
+    def edit(self, **kwargs):
+        """Change the message, merging with an edit still in the queue"""
+        op = self._waiting
+        if op is not None:
+            op.kwargs.update(kwargs)
+            OUTBOUND_MERGED.labels('edit').inc()
+            return op.future
+        op = self._waiting = _Op('edit', self.priority, kwargs, handle=self)
+        self.dispatcher._queue(self.channel, op)
+        return op.future
+
+
+class _Op:
+    __slots__ = ('action', 'priority', 'kwargs', 'handle', 'target', 'reply', 'lines',
+                 'future', 'queued_at', 'ready_at')
+
+    def __init__(self, action, priority, kwargs, handle=None, target=None, reply=False, ready_at=0.0):
+        self.action = action            # 'send', 'edit' or 'notice'
+        self.priority = priority
+        self.kwargs = kwargs
+        self.handle = handle
+        self.target = target
+        self.reply = reply
+        self.lines = []
+        self.future = asyncio.get_running_loop().create_future()
+        self.queued_at = time.monotonic()
+        self.ready_at = ready_at
+
+
+class _Channel:
+    __slots__ = ('id', 'queues', 'tokens', 'refilled_at', 'worker', 'wakeup')
+
+    def __init__(self, channel_id):
+        self.id = channel_id
+        self.queues = tuple(deque() for _ in _PRIORITY_NAMES)
+        self.tokens = float(Config.OUTBOUND_BURST)
+        self.refilled_at = time.monotonic()
+        self.worker = None
+        self.wakeup = asyncio.Event()
+
+    def refill(self, now):
+        rate = Config.OUTBOUND_BURST / Config.OUTBOUND_WINDOW
+        self.tokens = min(Config.OUTBOUND_BURST, self.tokens + (now - self.refilled_at) * rate)
+        self.refilled_at = now
+
+    def next_op(self, now):
+        """Highest priority op that may go out now, or the time the first one may"""
+        wake = None
+        for queue in self.queues:
+            if queue:
+                if queue[0].ready_at <= now:
+                    return queue.popleft(), None
+                wake = queue[0].ready_at if wake is None else min(wake, queue[0].ready_at)
+        return None, wake
+
+
+class OutboundDispatcher:
+    """Sends bot messages through one queue per channel
+
+    Each channel has a token bucket sized to Discord's per-channel limit
+    (OUTBOUND_BURST messages per OUTBOUND_WINDOW seconds), so the bot
+    waits in its own queue, where it can reorder, rather than in
+    discord.py's rate limiter, where it can't. Replies go before status
+    messages, which go before notices. Queued edits of the same message
+    collapse into one, and notices queued for a channel merge into a
+    single message. A channel's worker task only exists while it has
+    messages waiting.
+    """
+
+    def __init__(self):
+        self.channels = {}      # channel id -> _Channel
+
+    def send(self, target, content=None, *, reply=False, priority=REPLY, **kwargs):
+        """Queue a message; await the result for the discord.Message
+
+        target is a channel or a command context. With reply=True the
+        message replies to the context's command.
+        """
+        channel_id = _channel_id(target)
+        handle = OutboundMessage(self, channel_id, priority)
+        kwargs['content'] = content
+        op = handle._waiting = _Op('send', priority, kwargs, handle=handle, target=target, reply=reply)
+        self._queue(channel_id, op)
+        return handle
+
+    def reply(self, ctx, content=None, **kwargs):
+        return self.send(ctx, content, reply=True, **kwargs)
+
+    def status(self, target, content, **kwargs):
+        """A progress message that will most likely be edited"""
+        return self.send(target, content, priority=STATUS, **kwargs)
+
+    def notice(self, target, line):
+        """Announce something, merged with other notices still waiting for the channel"""
+        channel_id = _channel_id(target)
+        state = self.channels.get(channel_id)
+        if state is not None and state.queues[NOTICE]:
+            op = state.queues[NOTICE][-1]
+            op.lines.append(line)
+            OUTBOUND_MERGED.labels('notice').inc()
+            return op.future
+        op = _Op('notice', NOTICE, {}, target=target, ready_at=time.monotonic() + Config.OUTBOUND_NOTICE_DELAY)
+        op.lines.append(line)
+        self._queue(channel_id, op)
+        return op.future
+
+    def _queue(self, channel_id, op):
+        state = self.channels.get(channel_id)
+        if state is None:
+            state = self.channels[channel_id] = _Channel(channel_id)
+        state.queues[op.priority].append(op)
+        state.wakeup.set()
+        if state.worker is None:
+            state.worker = asyncio.create_task(self._drain(state))
+
+    async def _drain(self, state):
+        try:
+            while True:
+                now = time.monotonic()
+                op, wake = state.next_op(now)
+                if op is None:
+                    if wake is None:
+                        return
+                    # Only notices wait, and anything newly queued may go first
+                    state.wakeup.clear()
+                    try:
+                        await asyncio.wait_for(state.wakeup.wait(), wake - now)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                state.refill(now)
+                if state.tokens < 1:
+                    # Put it back, something more urgent may arrive while we wait
+                    state.queues[op.priority].appendleft(op)
+                    await asyncio.sleep((1 - state.tokens) * Config.OUTBOUND_WINDOW / Config.OUTBOUND_BURST)
+                    continue
+                state.tokens -= 1
+                await self._run(state.id, op)
+        finally:
+            state.worker = None
+            # The bucket has to be remembered until it has refilled
+            asyncio.get_running_loop().call_later(Config.OUTBOUND_WINDOW, self._forget, state)
+
+    def _forget(self, state):
+        if state.worker is None and not any(state.queues) and self.channels.get(state.id) is state:
+            del self.channels[state.id]
+
+    async def _run(self, channel_id, op):
+        handle = op.handle
+        if handle is not None and handle._waiting is op:
+            handle._waiting = None
+        OUTBOUND_WAIT_SECONDS.labels(_PRIORITY_NAMES[op.priority]).observe(time.monotonic() - op.queued_at)
+        OUTBOUND_SENT.labels(_PRIORITY_NAMES[op.priority], op.action).inc()
+        try:
+            if op.action == 'edit':
+                message = handle.message or await handle.sent
+                result = await message.edit(**op.kwargs)
+            elif op.action == 'notice':
+                result = await op.target.send(_summarize(op.lines))
+            else:
+                send = op.target.reply if op.reply else op.target.send
+                result = await send(**op.kwargs)
+                handle.message = result
+                if not handle.sent.done():
+                    handle.sent.set_result(result)
+        except Exception as e:
+            print(f'Could not {op.action} a message in channel {channel_id}: {e}')
+            for future in (op.future, handle.sent if handle is not None and op.action == 'send' else None):
+                if future is not None and not future.done():
+                    future.set_exception(e)
+                    # Nobody has to be waiting on a fire-and-forget message
+                    future.exception()
+            return
+        if not op.future.done():
+            op.future.set_result(result)
+
+
+def _channel_id(target):
+    channel = getattr(target, 'channel', target)
+    return channel.id
+
+
+def _summarize(lines):
+    """One message for notices that piled up"""
+    shown = lines[:Config.OUTBOUND_NOTICE_LINES]
+    text = '\n'.join(shown)
+    if len(lines) > len(shown):
+        text += f'\n…and {len(lines) - len(shown)} more'
+    return text[:Config.DISCORD_MESSAGE_LIMIT]
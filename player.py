@@ -0,0 +1,592 @@
+"""Per-guild music player driven by an event queue"""
+import asyncio
+from collections import deque
+from functools import partial
+
+import discord
+
+import metrics
+from audio_cache import AudioCache
+from config import Config
+from loudness import LoudnessCache
+from reclaimer import FFmpegReaper
+from search_index import SearchIndex
+from song_queue import QueueLimitError, SongQueue
+from stream_monitor import StreamMonitor
+from tracks import Track
+
+ffmpeg_options = {
+    'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
+    'options': '-vn'
+}
+
+# Player events
+ENQUEUE = 'enqueue'
+FINISHED = 'finished'
+SKIP = 'skip'
+STOP = 'stop'
+VOLUME = 'volume'
+
+# Overrides for flat (entries only) playlist extraction
+FLAT_PLAYLIST = {
+    'extract_flat': 'in_playlist',
+    'noplaylist': Config.PLAYLIST_REQUIRE_LIST_URL,
+}
+
+
+def is_url(query):
+    return query.startswith(('http://', 'https://'))
+
+
+# Shared CPU accounting for every guild's FFmpeg processes
+stream_monitor = StreamMonitor()
+
+# Every playback FFmpeg process, so ones nothing plays from can be killed
+ffmpeg_reaper = FFmpegReaper()
+
+# Measured normalization gains, shared by every guild
+loudness_cache = LoudnessCache()
+
+# Local copies of frequently played tracks (optional)
+audio_cache = AudioCache() if Config.AUDIO_CACHE_ENABLED else None
+
+
+# Past tracks, searched before asking YouTube
+search_index = SearchIndex()
+
+
+def is_cached(track):
+    return audio_cache is not None and audio_cache.has(track)
+
+
+def is_passthrough(track):
+    """Whether the stream is already Opus and can be copied without re-encoding"""
+    return track.codec in ('opus', 'libopus')
+
+
+async def describe_stream(track):
+    """Fill in the track's codec and bitrate, running ffprobe only as a last resort"""
+    if track.probed:
+        return
+    acodec = (track.acodec or '').lower()
+    if acodec and acodec != 'none':
+        # The extraction metadata already says what the stream is
+        track.codec = 'opus' if acodec.startswith('opus') else acodec
+        track.bitrate = min(int(track.abr or Config.TRANSCODE_BITRATE), Config.TRANSCODE_BITRATE)
+    else:
+        with metrics.FFMPEG_PROBE_SECONDS.time():
+            track.codec, track.bitrate = await discord.FFmpegOpusAudio.probe(track.stream_url)
+
+
+def volume_filter(volume=100, gain=None):
+    """FFmpeg volume filter for a volume percentage plus a loudness gain in dB
+
+    None when the audio would pass through unchanged.
+    """
+    factor = volume / 100 * 10 ** ((gain or 0) / 20)
+    if abs(factor - 1) < 0.005:
+        return None
+    return f'volume={factor:.4f}'
+
+
+async def create_source(track, volume=100, gain=None, start=0):
+    """Create an audio source, copying Opus packets through whenever possible
+
+    Volume and loudness are applied by FFmpeg, which means re-encoding, so
+    Opus is only passed through untouched when neither changes the level.
+    start seeks into the track, in seconds. Cached tracks play from disk.
+    """
+    local = audio_cache.path(track) if audio_cache is not None else None
+    if local:
+        # Always stored as Opus
+        url, codec, bitrate = local, 'opus', track.bitrate or Config.TRANSCODE_BITRATE
+        before_options = ''
+    else:
+        await describe_stream(track)
+        url, codec, bitrate = track.stream_url, track.codec, track.bitrate
+        before_options = ffmpeg_options['before_options']
+    if start:
+        before_options += f' -ss {start:.2f}'
+    options = ffmpeg_options['options']
+    audio_filter = volume_filter(volume, gain)
+    if audio_filter:
+        options += f' -af {audio_filter}'
+    # FFmpegOpusAudio uses '-c:a copy' for opus and libopus encoding for anything else
+    with metrics.FFMPEG_STARTUP_SECONDS.time():
+        source = discord.FFmpegOpusAudio(
+            url,
+            codec=None if audio_filter else codec,
+            bitrate=bitrate,
+            before_options=before_options.strip(),
+            options=options
+        )
+    source.passthrough = audio_filter is None and codec in ('opus', 'libopus')
+    source.local = local
+    return source
+
+
+class GuildPlayer:
+    """Owns all playback state for one guild
+
+    A single long-lived task consumes player events. The voice client's
+    after-callback only posts an event, so discord.py's audio thread never
+    waits on extraction or probing, and a failing track moves on to the
+    next one in a loop instead of recursing.
+    """
+
+    def __init__(self, bot, guild, resolver, extract, channel=None, store=None, outbound=None):
+        self.bot = bot
+        self.guild = guild
+        self.resolver = resolver
+        self.extract = extract
+        self.channel = channel          # Text channel for announcements
+        self.store = store              # StateStore the queue is saved to
+        self.outbound = outbound        # OutboundDispatcher for announcements
+        self.queue = SongQueue()
+        self.current = None
+        self.volume = Config.DEFAULT_VOLUME
+        self.events = asyncio.Queue()
+        # Look-ahead state: background resolve/probe tasks and a ready-to-play source
+        self.lookahead = {}             # id(track) -> Task
+        self.prepared = None            # (Track, FFmpegOpusAudio)
+        self.started_at = None          # Loop time the current source started
+        self.offset = 0.0               # Position in the track the current source started at
+        self.paused_at = None           # Loop time playback was paused
+        self.paused_for = 0.0           # Seconds spent paused since the source started
+        self.finished_at = None         # Loop time the last track ended
+        self.gaps = deque(maxlen=50)    # Recent track-to-track gaps in seconds
+        self.playlist_task = None
+        self.resume_at = None           # (Track, seconds) a restored song picks up from
+        self.active_at = bot.loop.time()  # Loop time of the last event, for idle reclamation
+        # Bumped whenever playback is interrupted so stale after-callbacks are ignored
+        self._token = 0
+        self._advancing = False
+        self._task = asyncio.create_task(self._run())
+
+    @property
+    def guild_id(self):
+        return self.guild.id
+
+    @property
+    def voice_client(self):
+        return self.guild.voice_client
+
+    @property
+    def is_active(self):
+        return self.current is not None
+
+    @property
+    def is_idle(self):
+        """Nothing playing, starting or queued"""
+        return self.current is None and not self._advancing and not self.queue
+
+    def post(self, kind, payload=None):
+        """Queue an event for the player task"""
+        self.active_at = self.bot.loop.time()
+        self.events.put_nowait((kind, payload))
+
+    def enqueue(self, track, announce=True):
+        """Add a track, returning its queue position (0 if it starts right away)
+
+        Raises QueueLimitError when the queue is full.
+        """
+        position = self.queue.append(track)
+        idle = self.current is None and not self._advancing
+        if idle and position == 1:
+            position = 0
+        self.post(ENQUEUE, announce)
+        self.save()
+        return position
+
+    def play_queue(self):
+        """Start a queue that isn't playing, such as one restored after a restart"""
+        if self.queue and self.current is None and not self._advancing:
+            self.post(ENQUEUE, True)
+            return True
+        return False
+
+    def queue_changed(self):
+        """Call after editing the queue directly"""
+        self.save()
+        self.schedule_lookahead()
+
+    def skip(self):
+        self.post(SKIP)
+
+    def stop(self):
+        self.post(STOP)
+
+    def set_volume(self, volume):
+        """Change the volume, restarting the current song where it is"""
+        self.volume = volume
+        self.post(VOLUME)
+        self.save()
+
+    def pause(self):
+        self.voice_client.pause()
+        self.paused_at = self.bot.loop.time()
+
+    def resume(self):
+        self.voice_client.resume()
+        if self.paused_at is not None:
+            self.paused_for += self.bot.loop.time() - self.paused_at
+            self.paused_at = None
+
+    def position(self):
+        """Seconds into the current track"""
+        if self.started_at is None:
+            return 0.0
+        now = self.paused_at if self.paused_at is not None else self.bot.loop.time()
+        return self.offset + now - self.started_at - self.paused_for
+
+    def gain(self, track):
+        """Loudness normalization gain for a track in dB, if it has been measured"""
+        if not Config.LOUDNESS_NORMALIZATION:
+            return None
+        return loudness_cache.gain(track)
+
+    def clear(self):
+        """Empty the queue and drop anything prepared from it"""
+        self.queue.clear()
+        self.resume_at = None
+        self.cancel_playlist()
+        self.reset_lookahead()
+        self.save()
+
+    def save(self):
+        """Have the state store write this player's state soon"""
+        if self.store is not None:
+            # Snapshotted at write time, so a burst of changes is saved once
+            self.store.put('player', self.guild_id, self.snapshot)
+
+    def snapshot(self):
+        """Queue, current song and position as saved in the state store"""
+        queue = list(self.queue)
+        current, position = self.current, self.position()
+        if current is None and self.resume_at and queue and queue[0] is self.resume_at[0]:
+            # Restored and not started again yet
+            current, position = queue.pop(0), self.resume_at[1]
+        if current is None and not queue:
+            return None
+        return {
+            'current': current.to_record() if current else None,
+            'position': round(position, 1) if current and current.duration else 0.0,
+            'queue': [track.to_record() for track in queue],
+            'volume': self.volume,
+        }
+
+    def restore(self, state):
+        """Take back a saved queue, with the saved current song first"""
+        tracks = [Track.from_record(record) for record in state.get('queue', ())]
+        if state.get('current'):
+            current = Track.from_record(state['current'])
+            tracks.insert(0, current)
+            if state.get('position'):
+                self.resume_at = (current, state['position'])
+        # Anything queued while the state was loading goes after it
+        self.queue = SongQueue(tracks + list(self.queue))
+        self.volume = state.get('volume', self.volume)
+
+    async def close(self):
+        """Stop the player task and release everything it holds"""
+        self.clear()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    def _after(self, token, error):
+        # Runs on discord.py's audio thread: hand off and return immediately
+        if error:
+            print(f'Player error in guild {self.guild_id}: {error}')
+        self.bot.loop.call_soon_threadsafe(self.post, FINISHED, (token, self.bot.loop.time()))
+
+    async def _run(self):
+        while True:
+            kind, payload = await self.events.get()
+            try:
+                if kind == ENQUEUE:
+                    if self.current is None:
+                        await self._advance(announce=payload)
+                    else:
+                        self.schedule_lookahead()
+                elif kind == FINISHED:
+                    token, finished_at = payload
+                    if token != self._token:
+                        continue
+                    self.finished_at = finished_at
+                    await self._advance()
+                elif kind == SKIP:
+                    if self.current is not None:
+                        self._interrupt()
+                        self.finished_at = self.bot.loop.time()
+                        await self._advance()
+                elif kind == STOP:
+                    self.clear()
+                    self._interrupt()
+                    self.current = None
+                    self._went_idle()
+                elif kind == VOLUME:
+                    # The prepared source has the old volume baked into its filter
+                    self.discard_prepared()
+                    if self.current is not None:
+                        await self._restart()
+                    self.schedule_lookahead()
+            except Exception as e:
+                print(f'Player error in guild {self.guild_id}: {e}')
+
+    def _interrupt(self):
+        """Stop the current source without triggering an advance"""
+        self._token += 1
+        voice_client = self.voice_client
+        if voice_client and (voice_client.is_playing() or voice_client.is_paused()):
+            voice_client.stop()
+
+    async def _advance(self, announce=True):
+        """Start the next playable track, skipping ones that fail"""
+        self._advancing = True
+        try:
+            await self._advance_queue(announce)
+        finally:
+            self._advancing = False
+
+    async def _advance_queue(self, announce):
+        # The last track is over whether or not another one starts
+        self.current = None
+        self.started_at = None
+        while self.queue:
+            voice_client = self.voice_client
+            if voice_client is None:
+                break
+            track = self.queue.popleft()
+            offset = 0.0
+            if self.resume_at and self.resume_at[0] is track:
+                offset, self.resume_at = self.resume_at[1], None
+            try:
+                source = await self._source_for(track, offset)
+            except Exception as e:
+                await self.send(f"❌ Couldn't play **{track.title}**: {str(e)}")
+                continue
+            try:
+                self._start(track, source, offset)
+            except Exception as e:
+                # Usually the voice connection dropping between songs
+                await self.send(f"❌ Couldn't play **{track.title}**: {str(e)}")
+                continue
+            if announce:
+                await self.send(f'🎵 Now playing: **{track.title}**')
+            return
+        self.reset_lookahead()
+        self.save()
+        self._went_idle()
+
+    def _went_idle(self):
+        # Listeners get on_player_idle(player), see Music.on_player_idle
+        self.active_at = self.bot.loop.time()
+        self.bot.dispatch('player_idle', self)
+
+    async def _restart(self):
+        """Start the current track again from where it is, picking up the new volume"""
+        track = self.current
+        paused = self.paused_at is not None
+        # Live streams can't seek, they pick up at the live edge instead
+        position = self.position() if track.duration else 0.0
+        self._interrupt()
+        try:
+            await self.resolver.ensure_stream(track, self.guild_id)
+            source = await self._create_source(track, start=position)
+            self._start(track, source, offset=position)
+        except Exception as e:
+            await self.send(f"❌ Couldn't restart **{track.title}**: {str(e)}")
+            await self._advance()
+            return
+        if paused:
+            self.pause()
+
+    async def _source_for(self, track, start=0.0):
+        prepared, self.prepared = self.prepared, None
+        if prepared and prepared[0] is track and not start:
+            # Resolved, probed and connected while the last song played
+            return prepared[1]
+        if prepared:
+            prepared[1].cleanup()
+        # Only extracts again if the stream URL is close to expiring
+        await self.resolver.ensure_stream(track, self.guild_id)
+        return await self._create_source(track, start=start)
+
+    async def _create_source(self, track, start=0.0):
+        source = await create_source(track, self.volume, self.gain(track), start=start)
+        ffmpeg_reaper.track(source)
+        return source
+
+    def _start(self, track, source, offset=0.0):
+        self._token += 1
+        try:
+            self.voice_client.play(source, after=partial(self._after, self._token))
+        except Exception:
+            # Never played, so discord.py won't clean it up
+            source.cleanup()
+            raise
+        now = self.bot.loop.time()
+        if self.finished_at is not None:
+            self.gaps.append(now - self.finished_at)
+            self.finished_at = None
+        self.started_at = now
+        self.offset = offset
+        self.paused_at = None
+        self.paused_for = 0.0
+        self.current = track
+        stream_monitor.register(self.guild_id, source, 'copy' if source.passthrough else 'transcode')
+        if Config.LOUDNESS_NORMALIZATION:
+            # Measured now so the next play of this song is normalized
+            # From the cached file the source plays, path() already counted the hit
+            loudness_cache.analyze(track, source.local)
+        if audio_cache is not None:
+            audio_cache.record_play(track)
+        search_index.add(track, played=True)
+        self.save()
+        self.schedule_lookahead()
+
+    async def send(self, content):
+        if self.channel is None:
+            return
+        if self.outbound is not None:
+            # Announcements wait behind replies and merge when they pile up
+            self.outbound.notice(self.channel, content)
+        else:
+            await self.channel.send(content)
+
+    def track_gap(self):
+        """Average of the recent gaps between tracks, in seconds"""
+        if not self.gaps:
+            return None
+        return sum(self.gaps) / len(self.gaps)
+
+    def schedule_lookahead(self):
+        """Resolve and probe the next few tracks while the current one plays"""
+        upcoming = self.queue[:Config.LOOKAHEAD_TRACKS]
+        wanted = {id(track) for track in upcoming}
+
+        # Anything no longer coming up (skipped, removed, reordered, cleared) is stale
+        for key in [key for key in self.lookahead if key not in wanted]:
+            self.lookahead.pop(key).cancel()
+        if self.prepared and (not upcoming or self.prepared[0] is not upcoming[0]):
+            self.discard_prepared()
+
+        for track in upcoming:
+            task = self.lookahead.get(id(track))
+            if task is None or (task.done() and track is upcoming[0] and self.prepared is None):
+                self.lookahead[id(track)] = asyncio.create_task(self._prefetch(track))
+
+    async def _prefetch(self, track):
+        try:
+            if not is_cached(track):
+                await self.resolver.ensure_stream(track, self.guild_id)
+                await describe_stream(track)
+                if Config.LOUDNESS_NORMALIZATION:
+                    loudness_cache.analyze(track)
+
+            # Only the very next track gets an FFmpeg process, started shortly
+            # before the current song ends so its connection is still warm
+            if not self.queue or self.queue[0] is not track:
+                return
+            current = self.current
+            if current and current.duration and self.started_at is not None:
+                delay = current.duration - self.position() - Config.LOOKAHEAD_SPAWN_LEAD
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            playable = is_cached(track) or track.stream_fresh()
+            if self.queue and self.queue[0] is track and self.prepared is None and playable:
+                self.prepared = (track, await self._create_source(track))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Not fatal, the player resolves the track itself when it comes up
+            print(f"Look-ahead failed for {track.title}: {e}")
+
+    def discard_prepared(self):
+        prepared, self.prepared = self.prepared, None
+        if prepared:
+            prepared[1].cleanup()
+
+    def reset_lookahead(self):
+        """Cancel all look-ahead work"""
+        for task in self.lookahead.values():
+            task.cancel()
+        self.lookahead.clear()
+        self.discard_prepared()
+
+    async def resolve_query(self, query):
+        """Resolve a query to its first track, plus the playlist title if it is one"""
+        if not is_url(query):
+            return await self.search(query), None
+        if self.resolver.cache.get(query) is not None:
+            return await self.resolver.resolve(query, self.guild_id), None
+
+        # Flat extraction of just the first entry: playlists come back as
+        # lightweight entries, single videos come back fully resolved
+        info = await self.extract(query, self.guild_id, overrides=dict(FLAT_PLAYLIST, playlistend=1))
+        if info.get('_type') != 'playlist':
+            return self.resolver.cache.put(Track.from_info(info), query), None
+        entries = [entry for entry in info.get('entries') or [] if entry]
+        if not entries:
+            raise Exception("That playlist is empty!")
+        return Track.from_entry(entries[0]), info.get('title') or 'playlist'
+
+    async def search(self, query):
+        """Resolve a search query, trying songs played before the remote search"""
+        match = None if self.resolver.cache.get(query) else search_index.lookup(query)
+        if match is None:
+            track = await self.resolver.resolve(query, self.guild_id)
+        else:
+            track = self.resolver.cache.get(match.key)
+            if track is None:
+                # Extracting the known URL directly skips the search step
+                track = Track(match.key, match.webpage_url, match.title, match.duration,
+                              uploader=match.uploader)
+            track = await self.resolver.ensure_stream(track, self.guild_id)
+            self.resolver.cache.put(track, query)
+        search_index.add(track, query)
+        return track
+
+    def start_playlist(self, query, title):
+        """Stream the remaining playlist entries into the queue"""
+        self.cancel_playlist()
+        self.playlist_task = asyncio.create_task(self._enqueue_playlist(query, title))
+
+    def cancel_playlist(self):
+        task, self.playlist_task = self.playlist_task, None
+        if task:
+            task.cancel()
+
+    async def _enqueue_playlist(self, query, title):
+        """Add playlist entries page by page as placeholder tracks"""
+        added = 0
+        start = 2
+        try:
+            while start <= Config.PLAYLIST_MAX_TRACKS:
+                end = min(start + Config.PLAYLIST_PAGE_SIZE - 1, Config.PLAYLIST_MAX_TRACKS)
+                info = await self.extract(query, self.guild_id, overrides=dict(
+                    FLAT_PLAYLIST, playliststart=start, playlistend=end
+                ))
+                entries = [entry for entry in info.get('entries') or [] if entry]
+                for entry in entries:
+                    # Placeholders are resolved by the look-ahead just before they play
+                    self.enqueue(Track.from_entry(entry))
+                    added += 1
+                if len(entries) < end - start + 1:
+                    break
+                start = end + 1
+        except asyncio.CancelledError:
+            raise
+        except QueueLimitError as e:
+            await self.send(f"📝 Added {added + 1} songs from **{title}**. {str(e)}")
+            return
+        except Exception as e:
+            await self.send(f"❌ Stopped loading **{title}** after {added} more songs: {str(e)}")
+            return
+        finally:
+            if self.playlist_task is asyncio.current_task():
+                self.playlist_task = None
+        await self.send(f"📝 Added {added + 1} songs from **{title}** to the queue")
@@ -0,0 +1,222 @@
+"""Idle resource reclamation: timers, orphaned FFmpeg processes and accounting"""
+import asyncio
+import inspect
+import math
+import os
+import time
+import weakref
+from functools import partial
+
+import metrics
+
+RECLAIMED = metrics.Counter('reclaimed_total', 'Idle resources released', ['kind'])
+RECLAIMED_BYTES = metrics.Counter('reclaimed_bytes_total', 'Memory released with idle resources', ['kind'])
+
+try:
+    _PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):
+    _PAGE_SIZE = 4096
+
+
+def process_rss(pid='self'):
+    """Resident memory of a process in bytes, or None if unavailable
+
+    Reads /proc, so this only reports on Linux.
+    """
+    try:
+        with open(f'/proc/{pid}/statm', 'rb') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def format_bytes(size):
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return f'{size:.0f} {unit}'
+        size /= 1024
+    return f'{size:.1f} GB'
+
+
+class _Timer:
+    __slots__ = ('key', 'rounds', 'callback', 'args')
+
+    def __init__(self, key, rounds, callback, args):
+        self.key = key
+        self.rounds = rounds
+        self.callback = callback
+        self.args = args
+
+
+class TimerWheel:
+    """Hashed timer wheel for the many per-guild timeouts
+
+    Timers are keyed, so scheduling one again replaces it, and both
+    scheduling and cancelling are a dict operation however many timers
+    are pending. A timer lands in the slot its delay ends in, counting a
+    round for every full turn of the wheel. A single task sleeps until the
+    next occupied slot and only exists while there are timers, so the
+    wheel costs nothing when the bot is idle. Timers fire within one tick
+    of their delay; callbacks may be plain functions or coroutines.
+    """
+
+    def __init__(self, tick=1.0, slots=64):
+        self.tick = tick
+        self.slots = [{} for _ in range(slots)]
+        self.timers = {}        # key -> slot index
+        self._origin = time.monotonic()
+        self._processed = 0     # Last tick whose slot has fired
+        self._wake_at = None
+        self._task = None
+
+    def __len__(self):
+        return len(self.timers)
+
+    def __contains__(self, key):
+        return key in self.timers
+
+    def _now(self):
+        return int((time.monotonic() - self._origin) / self.tick)
+
+    def schedule(self, key, delay, callback, *args):
+        """Call callback(*args) after delay seconds, replacing any timer with the same key"""
+        self.cancel(key)
+        idle = self._task is None or self._task.done()
+        if idle:
+            # Nothing is pending, so there are no skipped ticks to catch up on
+            self._processed = self._now()
+        due = self._now() + max(1, math.ceil(delay / self.tick))
+        size = len(self.slots)
+        first_visit = self._processed + (due - self._processed - 1) % size + 1
+        self.slots[due % size][key] = _Timer(key, (due - first_visit) // size, callback, args)
+        self.timers[key] = due % size
+        if idle or (self._wake_at is not None and self._origin + first_visit * self.tick < self._wake_at
+                    and asyncio.current_task() is not self._task):
+            # Started, or restarted because it is sleeping past the new timer's slot
+            if not idle:
+                self._task.cancel()
+            self._wake_at = None
+            self._task = asyncio.create_task(self._run())
+
+    def cancel(self, key):
+        index = self.timers.pop(key, None)
+        if index is not None:
+            del self.slots[index][key]
+
+    def _next_occupied(self):
+        """Ticks after the last processed one until a slot with a timer in it"""
+        for ticks in range(1, len(self.slots) + 1):
+            if self.slots[(self._processed + ticks) % len(self.slots)]:
+                return ticks
+        return len(self.slots)
+
+    async def _run(self):
+        while self.timers:
+            self._wake_at = self._origin + (self._processed + self._next_occupied()) * self.tick
+            await asyncio.sleep(max(0.0, self._wake_at - time.monotonic()))
+            # Catch up on every tick that passed, a blocked loop can't make timers skip a turn
+            current = self._now()
+            while self._processed < current:
+                self._processed += 1
+                self._fire(self.slots[self._processed % len(self.slots)])
+
+    def _fire(self, slot):
+        for key, timer in list(slot.items()):
+            if timer.rounds:
+                timer.rounds -= 1
+                continue
+            del slot[key]
+            del self.timers[key]
+            try:
+                result = timer.callback(*timer.args)
+                if inspect.isawaitable(result):
+                    asyncio.ensure_future(result).add_done_callback(partial(_report, key))
+            except Exception as e:
+                print(f'Timer {key} failed: {e}')
+
+    def close(self):
+        for slot in self.slots:
+            slot.clear()
+        self.timers.clear()
+        if self._task is not None:
+            self._task.cancel()
+
+
+def _report(key, task):
+    if not task.cancelled() and task.exception() is not None:
+        print(f'Timer {key} failed: {task.exception()}')
+
+
+class ReclaimStats:
+    """What the idle reclamation has released so far, by kind"""
+
+    def __init__(self):
+        self.counts = {}
+        self.bytes = {}
+
+    def record(self, kind, count=1, size=0):
+        if not count:
+            return
+        self.counts[kind] = self.counts.get(kind, 0) + count
+        RECLAIMED.labels(kind).inc(count)
+        if size:
+            self.bytes[kind] = self.bytes.get(kind, 0) + size
+            RECLAIMED_BYTES.labels(kind).inc(size)
+
+    def summary(self):
+        parts = []
+        for kind, count in self.counts.items():
+            size = self.bytes.get(kind)
+            parts.append(f'{count} {kind}' + (f' ({format_bytes(size)})' if size else ''))
+        rss = process_rss()
+        if rss is not None:
+            parts.append(f'bot now uses {format_bytes(rss)}')
+        return ', '.join(parts)
+
+
+class FFmpegReaper:
+    """Kills playback FFmpeg processes that nothing plays from any more
+
+    discord.py cleans up a source when it finishes playing, but one that
+    was prepared and dropped, or whose voice connection went away
+    mid-song, keeps its FFmpeg process until the source object is garbage
+    collected, if ever. Every playback source is tracked here, and reap()
+    kills the ones not in use, waiting on processes that already exited so
+    they don't stay behind as zombies.
+    """
+
+    def __init__(self, grace=5.0):
+        self.grace = grace      # seconds a new source has to start playing
+        self.processes = {}     # pid -> (Popen, weakref to the source, started)
+
+    def track(self, source):
+        process = getattr(source, '_process', None)
+        if process is not None:
+            self.processes[process.pid] = (process, weakref.ref(source), time.monotonic())
+
+    async def reap(self, in_use):
+        """Kill tracked processes whose source isn't in in_use, returning (count, bytes freed)"""
+        now = time.monotonic()
+        count = size = 0
+        for pid, (process, source_ref, started) in list(self.processes.items()):
+            if process.poll() is not None:
+                # Exited on its own, poll() has collected it
+                del self.processes[pid]
+                continue
+            source = source_ref()
+            if source is not None and (id(source) in in_use or now - started < self.grace):
+                continue
+            del self.processes[pid]
+            size += process_rss(pid) or 0
+            count += 1
+            # Both wait for the process to exit, which must not block the loop
+            await asyncio.to_thread(source.cleanup if source is not None else partial(_kill, process))
+        return count, size
+
+
+def _kill(process):
+    try:
+        process.kill()
+    except ProcessLookupError:
+        pass
+    process.wait()
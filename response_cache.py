@@ -0,0 +1,250 @@
+"""Two-tier cache for LLM responses with in-flight request coalescing"""
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from config import Config
+
+
+def normalize_prompt(prompt):
+    """Collapse whitespace and case so trivially different prompts share an entry"""
+    return ' '.join(prompt.split()).casefold()
+
+
+class MemoryLRU:
+    """Small in-process LRU with per-entry expiry and a byte budget"""
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()  # key -> (value, expires_at)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at < time.time():
+            self.pop(key)
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value, expires_at):
+        self.pop(key)
+        self._entries[key] = (value, expires_at)
+        self.size += len(value)
+        while self._entries and (len(self._entries) > self.max_entries or self.size > self.max_bytes):
+            _, (old, _) = self._entries.popitem(last=False)
+            self.size -= len(old)
+
+    def pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[0])
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+
+class SQLiteTier:
+    """On-disk tier that survives restarts, evicted by TTL and total size"""
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                ' key TEXT PRIMARY KEY,'
+                ' model TEXT NOT NULL,'
+                ' response TEXT NOT NULL,'
+                ' size INTEGER NOT NULL,'
+                ' expires_at REAL NOT NULL,'
+                ' last_access REAL NOT NULL)'
+            )
+            self._conn.execute(
+                'CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)'
+            )
+        return self._conn
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                'SELECT response, expires_at FROM responses WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                conn.commit()
+                return None
+            conn.execute('UPDATE responses SET last_access = ? WHERE key = ?', (now, key))
+            conn.commit()
+            return row[0], row[1]
+
+    def put(self, key, model, response, expires_at):
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                (key, model, response, len(response.encode('utf-8')), expires_at, now)
+            )
+            self._evict(conn, now)
+            conn.commit()
+
+    def _evict(self, conn, now):
+        conn.execute('DELETE FROM responses WHERE expires_at < ?', (now,))
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        stale = []
+        for key, size in conn.execute('SELECT key, size FROM responses ORDER BY last_access'):
+            if total <= self.max_bytes:
+                break
+            stale.append((key,))
+            total -= size
+        conn.executemany('DELETE FROM responses WHERE key = ?', stale)
+
+    def clear(self):
+        with self._lock:
+            conn = self._connect()
+            conn.execute('DELETE FROM responses')
+            conn.commit()
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class ResponseCache:
+    """Caches generated responses in memory and on disk
+
+    Identical requests that arrive while a generation is running wait on
+    that generation instead of starting a new one.
+    """
+
+    def __init__(self, path=None, ttl=None, memory_entries=None, memory_bytes=None,
+                 disk_bytes=None, max_temperature=None, enabled=None):
+        self.ttl = ttl or Config.RESPONSE_CACHE_TTL
+        self.max_temperature = (max_temperature if max_temperature is not None
+                                else Config.RESPONSE_CACHE_MAX_TEMPERATURE)
+        self.enabled = enabled if enabled is not None else Config.RESPONSE_CACHE_ENABLED
+        self.memory = MemoryLRU(
+            memory_entries or Config.RESPONSE_CACHE_MEMORY_ENTRIES,
+            memory_bytes or Config.RESPONSE_CACHE_MEMORY_BYTES
+        )
+        disk_path = path if path is not None else Config.RESPONSE_CACHE_PATH
+        self.disk = SQLiteTier(disk_path, disk_bytes or Config.RESPONSE_CACHE_DISK_BYTES) if disk_path else None
+        self._inflight = {}
+
+    @staticmethod
+    def make_key(model, prompt, options=None, **extra):
+        """Key on the model, normalized prompt and generation options"""
+        material = json.dumps(
+            [model, normalize_prompt(prompt), options or {}, extra],
+            sort_keys=True,
+            separators=(',', ':')
+        )
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def cacheable(self, options=None):
+        """Whether responses generated with these options should be cached"""
+        if not self.enabled:
+            return False
+        temperature = (options or {}).get('temperature', 0)
+        return temperature <= self.max_temperature
+
+    async def get(self, key):
+        value = self.memory.get(key)
+        if value is not None or self.disk is None:
+            return value
+        row = await asyncio.to_thread(self.disk.get, key)
+        if row is None:
+            return None
+        value, expires_at = row
+        self.memory.put(key, value, expires_at)
+        return value
+
+    async def put(self, key, model, value):
+        expires_at = time.time() + self.ttl
+        self.memory.put(key, value, expires_at)
+        if self.disk is not None:
+            await asyncio.to_thread(self.disk.put, key, model, value, expires_at)
+
+    def inflight(self, key):
+        """Future for a generation of key that is already running, if any"""
+        return self._inflight.get(key)
+
+    def begin(self, key):
+        """Mark key as being generated so duplicates can wait for it"""
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        return future
+
+    async def complete(self, key, model, value):
+        future = self._inflight.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(value)
+        await self.put(key, model, value)
+
+    def fail(self, key, error):
+        future = self._inflight.pop(key, None)
+        if future is not None and not future.done():
+            future.set_exception(error)
+            # Mark the exception retrieved when nobody was waiting on it
+            future.exception()
+
+    async def get_or_generate(self, key, model, generate):
+        """Return a cached response or run generate() once for all concurrent callers"""
+        pending = self.inflight(key)
+        if pending is None:
+            value = await self.get(key)
+            if value is not None:
+                return value
+            # Another caller may have started while we checked the disk tier
+            pending = self.inflight(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        self.begin(key)
+        try:
+            value = await generate()
+        except BaseException as e:
+            self.fail(key, e if isinstance(e, Exception) else RuntimeError("Generation was cancelled"))
+            raise
+        await self.complete(key, model, value)
+        return value
+
+    def clear(self):
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def close(self):
+        if self.disk is not None:
+            self.disk.close()
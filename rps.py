@@ -0,0 +1,147 @@
+"""Rock Paper Scissors game sessions with expiry and a concurrency cap"""
+import time
+from collections import OrderedDict
+
+from config import Config
+
+CHOICES = {'r': '🪨 Rock', 'p': '📄 Paper', 's': '✂️ Scissors'}
+# (a - b) % 3: 0 is a tie, 1 means a wins
+_VALUES = {'r': 0, 'p': 1, 's': 2}
+
+# Game states
+PENDING = 'pending'
+ACTIVE = 'active'
+
+
+class GameLimitError(Exception):
+    """Raised when the concurrent game cap is reached"""
+
+
+class RPSGame:
+    __slots__ = ('id', 'challenger', 'opponent', 'names', 'state', 'choices', 'expires_at', 'users')
+
+    def __init__(self, game_id, challenger, opponent, names, state=PENDING, choices=None, expires_at=0.0):
+        self.id = game_id
+        self.challenger = challenger        # user ids
+        self.opponent = opponent
+        self.names = names                  # [challenger name, opponent name]
+        self.state = state
+        self.choices = choices or {}        # user id -> choice letter
+        self.expires_at = expires_at
+        self.users = {}                     # user id -> User, while the game is in memory
+
+    @property
+    def players(self):
+        return (self.challenger, self.opponent)
+
+    def record(self):
+        # JSON object keys are strings, so choices are stored as pairs
+        return {'c': self.challenger, 'o': self.opponent, 'n': self.names, 's': self.state,
+                'x': list(self.choices.items()), 'e': self.expires_at}
+
+    @classmethod
+    def from_record(cls, game_id, record):
+        return cls(game_id, record['c'], record['o'], record['n'], record['s'],
+                   dict(record['x']), record['e'])
+
+    def result(self):
+        """Result message once both players have chosen"""
+        challenger_choice = self.choices[self.challenger]
+        opponent_choice = self.choices[self.opponent]
+        message = (
+            f"**Results:**\n"
+            f"{self.names[0]}: {CHOICES[challenger_choice]}\n"
+            f"{self.names[1]}: {CHOICES[opponent_choice]}\n\n"
+        )
+        diff = (_VALUES[challenger_choice] - _VALUES[opponent_choice]) % 3
+        if diff == 0:
+            return message + "It's a tie!"
+        if diff == 1:
+            return message + f"{self.names[0]} wins!"
+        return message + f"{self.names[1]} wins!"
+
+
+class RPSEngine:
+    """All running games, oldest activity first
+
+    Every move pushes a game's expiry out by RPS_GAME_TTL and moves it to
+    the end, so expired games are always at the front and are dropped
+    without scanning. Games are saved to the state store and read back
+    the first time one is touched after a restart.
+    """
+
+    def __init__(self, store=None, ttl=None, max_games=None):
+        self.store = store
+        self.ttl = ttl or Config.RPS_GAME_TTL
+        self.max_games = max_games or Config.RPS_MAX_GAMES
+        self.games = OrderedDict()      # game id -> RPSGame
+
+    def __len__(self):
+        self.expire()
+        return len(self.games)
+
+    def expire(self):
+        now = time.time()
+        while self.games:
+            game = next(iter(self.games.values()))
+            if game.expires_at > now:
+                break
+            self._drop(game)
+
+    def create(self, game_id, challenger, opponent):
+        """Start a challenge between two users; raises GameLimitError at the cap"""
+        self.expire()
+        if len(self.games) >= self.max_games:
+            raise GameLimitError("Too many games are running right now, try again in a few minutes!")
+        game = RPSGame(str(game_id), challenger.id, opponent.id, [challenger.name, opponent.name])
+        game.users = {challenger.id: challenger, opponent.id: opponent}
+        self._touch(game)
+        return game
+
+    async def get(self, game_id):
+        """A running game, or None if it finished or expired"""
+        self.expire()
+        if game_id not in self.games and self.store is not None:
+            record = await self.store.get('rps', game_id)
+            if record is not None and game_id not in self.games:
+                self._restore(RPSGame.from_record(game_id, record))
+        game = self.games.get(game_id)
+        if game is not None and game.expires_at <= time.time():
+            self._drop(game)
+            return None
+        return game
+
+    def accept(self, game):
+        game.state = ACTIVE
+        self._touch(game)
+
+    def choose(self, game, user_id, choice):
+        """Record a move, returning True once both players have chosen"""
+        game.choices[user_id] = choice
+        if len(game.choices) == 2:
+            self._drop(game)
+            return True
+        self._touch(game)
+        return False
+
+    def cancel(self, game):
+        self._drop(game)
+
+    def _touch(self, game):
+        game.expires_at = time.time() + self.ttl
+        self.games[game.id] = game
+        self.games.move_to_end(game.id)
+        if self.store is not None:
+            self.store.put('rps', game.id, game.record)
+
+    def _restore(self, game):
+        """Put a game read back from the store in its place by expiry"""
+        later = [key for key, other in self.games.items() if other.expires_at > game.expires_at]
+        self.games[game.id] = game
+        for key in later:
+            self.games.move_to_end(key)
+
+    def _drop(self, game):
+        self.games.pop(game.id, None)
+        if self.store is not None:
+            self.store.delete('rps', game.id)
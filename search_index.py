@@ -0,0 +1,247 @@
+"""Local fuzzy search over tracks the bot has already played"""
+import asyncio
+import heapq
+import json
+import os
+import re
+import unicodedata
+from collections import Counter
+
+from config import Config
+
+_NON_WORD = re.compile(r'[\W_]+')
+
+
+def normalize(text):
+    """Lowercase words without accents or punctuation"""
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return ' '.join(_NON_WORD.sub(' ', text.casefold()).split())
+
+
+def trigrams(text):
+    """Character trigrams of each word, padded so short words still count"""
+    grams = set()
+    for word in text.split():
+        padded = f'  {word} '
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class _Entry:
+    __slots__ = ('key', 'webpage_url', 'title', 'uploader', 'duration', 'aliases', 'plays', 'grams')
+
+    def __init__(self, key, webpage_url, title, uploader=None, duration=None, aliases=(), plays=0):
+        self.key = key
+        self.webpage_url = webpage_url
+        self.title = title
+        self.uploader = uploader
+        self.duration = duration
+        self.aliases = list(aliases)
+        self.plays = plays
+        self.grams = frozenset()
+
+    def text(self):
+        return normalize(' '.join([self.title or '', self.uploader or '', *self.aliases]))
+
+    def record(self):
+        return {'k': self.key, 'u': self.webpage_url, 't': self.title, 'a': self.uploader,
+                'd': self.duration, 'q': self.aliases, 'p': self.plays}
+
+
+class SearchIndex:
+    """Trigram index over the titles, uploaders and past queries of played tracks
+
+    Kept on disk as an append-only JSON lines log, one record per change
+    with the latest record for a track winning, and rewritten at startup
+    once stale records dominate. A query matches when enough of its
+    trigrams appear in a track; exact repeats of a past query always do.
+    """
+
+    def __init__(self, path=None, threshold=None, max_tracks=None):
+        self.path = path or Config.SEARCH_INDEX_PATH
+        self.threshold = threshold or Config.SEARCH_INDEX_THRESHOLD
+        self.max_tracks = max_tracks or Config.SEARCH_INDEX_MAX_TRACKS
+        self.entries = {}       # track key -> _Entry
+        self.postings = {}      # trigram -> set of track keys
+        self.aliases = {}       # normalized query -> track key
+        self.hits = 0
+        self.misses = 0
+        self._pending = []      # Records not yet appended to the log
+        self._writing = None
+        self._backlog = []      # add() calls made before the index finished loading
+        self._recent = set()    # Keys added while over max_tracks, spared by the next trim
+        self._trimming = False
+        self.ready = False
+
+    def load(self):
+        """Read the log from disk (blocking)"""
+        self._load()
+        self.ready = True
+
+    async def load_async(self):
+        """Read the log in a worker thread, then apply anything added meanwhile"""
+        # Nothing else touches the index until ready is set
+        await asyncio.to_thread(self._load)
+        self.ready = True
+        backlog, self._backlog = self._backlog, []
+        for args in backlog:
+            self.add(*args)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _load(self):
+        lines = 0
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A torn final line from a crash, everything before it is fine
+                        continue
+                    self._index(_Entry(record['k'], record['u'], record['t'], record.get('a'),
+                                       record.get('d'), record.get('q', ()), record.get('p', 0)))
+        except OSError:
+            return
+        if len(self.entries) > self.max_tracks:
+            for entry in sorted(self.entries.values(), key=lambda entry: entry.plays)[:-self.max_tracks]:
+                self._unindex(entry)
+        if lines > 2 * len(self.entries):
+            self._rewrite()
+
+    def _index(self, entry):
+        old = self.entries.get(entry.key)
+        if old is not None:
+            self._unindex(old)
+        entry.grams = frozenset(trigrams(entry.text()))
+        self.entries[entry.key] = entry
+        for gram in entry.grams:
+            self.postings.setdefault(gram, set()).add(entry.key)
+        for alias in entry.aliases:
+            self.aliases[normalize(alias)] = entry.key
+
+    def _unindex(self, entry):
+        del self.entries[entry.key]
+        for gram in entry.grams:
+            keys = self.postings.get(gram)
+            if keys is not None:
+                keys.discard(entry.key)
+                if not keys:
+                    del self.postings[gram]
+        for alias in entry.aliases:
+            if self.aliases.get(normalize(alias)) == entry.key:
+                del self.aliases[normalize(alias)]
+
+    def lookup(self, query):
+        """Best indexed match for a search query, or None below the threshold"""
+        text = normalize(query)
+        if not self.ready or len(text) < Config.SEARCH_INDEX_MIN_QUERY:
+            return None
+        key = self.aliases.get(text)
+        if key is None:
+            key = self._best_match(text)
+        if key is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self.entries[key]
+
+    def _best_match(self, text):
+        grams = trigrams(text)
+        words = [trigrams(word) for word in set(text.split())]
+        counts = Counter()
+        for gram in grams:
+            counts.update(self.postings.get(gram, ()))
+        best, best_score = None, None
+        for key, shared in counts.items():
+            coverage = shared / len(grams)
+            if coverage < self.threshold:
+                continue
+            entry = self.entries[key]
+            # Every word has to roughly appear, so 'part 1' never matches 'part 2'
+            if any(len(word & entry.grams) < len(word) * Config.SEARCH_INDEX_WORD_MATCH for word in words):
+                continue
+            # Among tracks containing the query, prefer the closest overall fit
+            dice = 2 * shared / (len(grams) + len(entry.grams))
+            score = (coverage, dice, entry.plays)
+            if best_score is None or score > best_score:
+                best, best_score = key, score
+        return best
+
+    def add(self, track, query=None, played=False):
+        """Index or update a resolved track, optionally with the query that found it"""
+        if not track.webpage_url or not track.title:
+            return
+        if not self.ready:
+            self._backlog.append((track, query, played))
+            return
+        entry = self.entries.get(track.key)
+        aliases = list(entry.aliases) if entry else []
+        if query and not query.startswith(('http://', 'https://')) and query not in aliases:
+            aliases = (aliases + [query])[-Config.SEARCH_INDEX_MAX_ALIASES:]
+        changed = (
+            entry is None or played or aliases != entry.aliases or entry.title != track.title
+            or entry.uploader != track.uploader
+        )
+        if not changed:
+            return
+        entry = _Entry(track.key, track.webpage_url, track.title, track.uploader,
+                       track.duration, aliases, (entry.plays if entry else 0) + (1 if played else 0))
+        self._index(entry)
+        self._pending.append(entry.record())
+        if len(self.entries) > self.max_tracks:
+            self._recent.add(entry.key)
+            # Trimmed in batches, so adds near the cap don't each scan the whole index
+            if not self._trimming and len(self.entries) > self.max_tracks + max(1, self.max_tracks // 100):
+                self._trimming = True
+                asyncio.get_running_loop().call_soon(self._trim)
+        if self._writing is None or self._writing.done():
+            self._writing = asyncio.create_task(self._flush())
+
+    def _trim(self):
+        """Drop the least played tracks past max_tracks, sparing the ones just added"""
+        self._trimming = False
+        recent, self._recent = self._recent, set()
+        excess = len(self.entries) - self.max_tracks
+        if excess <= 0:
+            return
+        candidates = (entry for entry in self.entries.values() if entry.key not in recent)
+        evicted = {entry.key for entry in heapq.nsmallest(excess, candidates, key=lambda entry: entry.plays)}
+        for key in evicted:
+            self._unindex(self.entries[key])
+        # Not written yet, so they don't come back on the next load
+        self._pending = [record for record in self._pending if record['k'] not in evicted]
+
+    async def _flush(self):
+        while self._pending:
+            records, self._pending = self._pending, []
+            try:
+                await asyncio.to_thread(self._append, records)
+            except OSError as e:
+                print(f'Could not save the search index: {e}')
+                return
+
+    async def close(self):
+        """Write out anything not appended to the log yet"""
+        if self._writing is not None:
+            await self._writing
+        await self._flush()
+
+    def _append(self, records):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.writelines(json.dumps(record, separators=(',', ':')) + '\n' for record in records)
+
+    def _rewrite(self):
+        """Replace the log with one record per track"""
+        temporary = f'{self.path}.tmp'
+        try:
+            with open(temporary, 'w', encoding='utf-8') as f:
+                for entry in self.entries.values():
+                    f.write(json.dumps(entry.record(), separators=(',', ':')) + '\n')
+            os.replace(temporary, self.path)
+        except OSError as e:
+            print(f'Could not compact the search index: {e}')
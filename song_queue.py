@@ -0,0 +1,238 @@
+"""Indexed song queue for the music player"""
+import random
+from collections import Counter, deque
+from itertools import islice
+
+from config import Config
+
+
+class QueueLimitError(Exception):
+    """Raised when a guild's queue is already at its length cap"""
+
+
+class SongQueue:
+    """Sequence of tracks stored as a row of small blocks
+
+    Tracks live in deques of up to ~block_size items, and a Fenwick tree
+    over the block lengths maps a position to its block in O(log n).
+    Enqueue and dequeue only touch the end blocks (plus a short walk up the
+    tree), positional insert/remove/move find their block through the tree
+    and shift at most one block, and slices walk blocks from the first hit.
+    """
+
+    def __init__(self, items=(), max_length=None, block_size=None):
+        self.max_length = max_length or Config.MAX_QUEUE_LENGTH
+        self.block_size = block_size or Config.QUEUE_BLOCK_SIZE
+        self._history = deque(maxlen=Config.QUEUE_SHUFFLE_HISTORY)
+        self._load(list(items))
+
+    # Internal block bookkeeping
+
+    def _load(self, items):
+        size = self.block_size
+        self._blocks = [deque(items[i:i + size]) for i in range(0, len(items), size)]
+        self._first = 0
+        self._length = len(items)
+        self._reindex()
+
+    def _reindex(self):
+        """Drop empty blocks and rebuild the Fenwick tree over block lengths"""
+        self._blocks = [block for block in self._blocks[self._first:] if block]
+        self._first = 0
+        capacity = 8
+        while capacity < 2 * len(self._blocks):
+            capacity *= 2
+        self._capacity = capacity
+        tree = [0] * (capacity + 1)
+        for i, block in enumerate(self._blocks, 1):
+            tree[i] = len(block)
+        for i in range(1, capacity + 1):
+            parent = i + (i & -i)
+            if parent <= capacity:
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _add(self, block_index, delta):
+        i = block_index + 1
+        tree = self._tree
+        while i <= self._capacity:
+            tree[i] += delta
+            i += i & -i
+
+    def _locate(self, index):
+        """Block number and offset within it for a queue position"""
+        position = 0
+        remaining = index
+        tree = self._tree
+        step = self._capacity
+        while step:
+            following = position + step
+            if following <= self._capacity and tree[following] <= remaining:
+                position = following
+                remaining -= tree[following]
+            step >>= 1
+        return position, remaining
+
+    def _normalize(self, index):
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError('queue index out of range')
+        return index
+
+    # Sequence protocol
+
+    def __len__(self):
+        return self._length
+
+    def __bool__(self):
+        return self._length > 0
+
+    def __iter__(self):
+        for block in islice(self._blocks, self._first, None):
+            yield from block
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._length)
+            if step != 1:
+                return list(self)[index]
+            return self.slice(start, stop)
+        block, offset = self._locate(self._normalize(index))
+        return self._blocks[block][offset]
+
+    def slice(self, start, stop):
+        """Tracks from start up to (not including) stop"""
+        if start >= stop:
+            return []
+        block, offset = self._locate(start)
+        items = []
+        wanted = stop - start
+        while wanted > 0 and block < len(self._blocks):
+            chunk = list(islice(self._blocks[block], offset, offset + wanted))
+            items.extend(chunk)
+            wanted -= len(chunk)
+            block += 1
+            offset = 0
+        return items
+
+    def page(self, number, per_page=10):
+        """Tracks on a 0-based page, and how many pages there are"""
+        pages = max(1, -(-self._length // per_page))
+        number = max(0, min(number, pages - 1))
+        start = number * per_page
+        return self.slice(start, start + per_page), pages
+
+    # Queue operations
+
+    def _check_room(self, count=1):
+        if self._length + count > self.max_length:
+            raise QueueLimitError(f"The queue is full (max {self.max_length} songs)!")
+
+    def append(self, track):
+        """Add a track to the end, returning its 1-based position"""
+        self._check_room()
+        self._length += 1
+        if len(self._blocks) > self._first and len(self._blocks[-1]) < self.block_size:
+            self._blocks[-1].append(track)
+            self._add(len(self._blocks) - 1, 1)
+        else:
+            self._blocks.append(deque([track]))
+            if len(self._blocks) > self._capacity:
+                self._reindex()
+            else:
+                self._add(len(self._blocks) - 1, 1)
+        return self._length
+
+    def popleft(self):
+        """Remove and return the next track"""
+        if not self._length:
+            raise IndexError('pop from an empty queue')
+        block = self._blocks[self._first]
+        track = block.popleft()
+        self._add(self._first, -1)
+        self._length -= 1
+        if not block:
+            self._first += 1
+            # Compact once the dead blocks at the front dominate
+            if self._first > 8 and self._first * 2 > len(self._blocks):
+                self._reindex()
+        return track
+
+    def insert(self, index, track):
+        """Insert a track at a 0-based position"""
+        if index >= self._length:
+            self.append(track)
+            return
+        self._check_room()
+        block, offset = self._locate(max(0, index))
+        self._blocks[block].insert(offset, track)
+        self._add(block, 1)
+        self._length += 1
+        if len(self._blocks[block]) > 2 * self.block_size:
+            # Split the overgrown block in two
+            items = list(self._blocks[block])
+            half = len(items) // 2
+            self._blocks[block:block + 1] = [deque(items[:half]), deque(items[half:])]
+            self._reindex()
+
+    def pop(self, index=0):
+        """Remove and return the track at a 0-based position"""
+        index = self._normalize(index)
+        if index == 0:
+            return self.popleft()
+        block, offset = self._locate(index)
+        items = self._blocks[block]
+        track = items[offset]
+        del items[offset]
+        self._add(block, -1)
+        self._length -= 1
+        if not items:
+            self._reindex()
+        return track
+
+    def move(self, source, destination):
+        """Move the track at source to destination (both 0-based)"""
+        track = self.pop(source)
+        self.insert(min(destination, self._length), track)
+        return track
+
+    def drop(self, count):
+        """Remove the first count tracks (for jumping ahead in the queue)"""
+        count = min(count, self._length)
+        for _ in range(count):
+            self.popleft()
+        return count
+
+    def clear(self):
+        self._history.clear()
+        self._load([])
+
+    def shuffle(self):
+        """Shuffle in place, remembering the previous order for unshuffle()"""
+        items = list(self)
+        self._history.append(items[:])
+        random.shuffle(items)
+        self._load(items)
+
+    def unshuffle(self):
+        """Restore the order from before the last shuffle
+
+        Tracks played or removed since are left out and tracks added since
+        stay at the end. Returns False when there is nothing to undo.
+        """
+        if not self._history:
+            return False
+        previous = self._history.pop()
+        remaining = Counter(id(track) for track in self)
+        restored = []
+        for track in previous:
+            if remaining[id(track)] > 0:
+                remaining[id(track)] -= 1
+                restored.append(track)
+        for track in self:
+            if remaining[id(track)] > 0:
+                remaining[id(track)] -= 1
+                restored.append(track)
+        self._load(restored)
+        return True
@@ -0,0 +1,185 @@
+"""Event-loop stall watchdog with stack sampling from a sidecar thread"""
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+
+import metrics
+from config import Config
+
+_PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+LOOP_LAG_SECONDS = metrics.Histogram(
+    'event_loop_lag_seconds', 'How late the event loop ran a scheduled heartbeat',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+LOOP_STALLS = metrics.Counter('event_loop_stalls_total', 'Heartbeats delayed past the stall threshold')
+
+
+def _describe(frame):
+    return f'{os.path.relpath(frame.filename, _PROJECT_DIR)}:{frame.lineno} in {frame.name}'
+
+
+def _call_site(stack):
+    """Innermost frame of our own code plus the innermost frame overall"""
+    own = None
+    for frame in reversed(stack):
+        if frame.filename.startswith(_PROJECT_DIR) and not frame.filename.endswith('stall_detector.py'):
+            own = frame
+            break
+    innermost = stack[-1] if stack else None
+    if own is None:
+        return _describe(innermost) if innermost else 'unknown'
+    if own is innermost:
+        return _describe(own)
+    return f'{_describe(own)} -> {_describe(innermost)}'
+
+
+class _Site:
+    __slots__ = ('count', 'blocked', 'longest', 'activities', 'stack')
+
+    def __init__(self, stack):
+        self.count = 0
+        self.blocked = 0.0
+        self.longest = 0.0
+        self.activities = Counter()
+        self.stack = stack
+
+
+class StallDetector:
+    """Finds code that blocks the event loop
+
+    A heartbeat scheduled on the loop records when it last ran. A daemon
+    thread watches it, and while the heartbeat is overdue by more than
+    threshold it samples the loop thread's stack with sys._current_frames().
+    Each stall is charged to the call site seen most often while it lasted
+    and to the command or event whose task was running.
+    """
+
+    def __init__(self, threshold=None, interval=None):
+        self.threshold = threshold or Config.STALL_THRESHOLD
+        self.interval = interval or Config.STALL_CHECK_INTERVAL
+        self.sites = {}             # call site -> _Site
+        self.stalls = 0
+        self.total_blocked = 0.0
+        self._labels = {}           # Task -> command name
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._loop = None
+        self._loop_thread = None
+        self._handle = None
+        self._thread = None
+        self._expected = 0.0        # When the next heartbeat should run
+        self._stall = None          # (started, activity, Counter of sites, {site: stack})
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        """Start watching the running loop (call from the loop thread)"""
+        if self._thread is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._stop.clear()
+        self._expected = time.perf_counter() + self.interval
+        self._handle = self._loop.call_later(self.interval, self._beat)
+        self._thread = threading.Thread(target=self._watch, name='stall-detector', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        self._thread = None
+
+    def label(self, name):
+        """Name the current task, so stalls inside it are charged to name"""
+        task = asyncio.current_task()
+        if task is None:
+            return
+        self._labels[task] = name
+        task.add_done_callback(self._unlabel)
+
+    def _unlabel(self, task):
+        self._labels.pop(task, None)
+
+    def _beat(self):
+        now = time.perf_counter()
+        LOOP_LAG_SECONDS.observe(max(0.0, now - self._expected))
+        self._expected = now + self.interval
+        self._handle = self._loop.call_later(self.interval, self._beat)
+
+    def _activity(self):
+        # Read from another thread; a stale answer only mislabels one sample
+        current = getattr(asyncio.tasks, '_current_tasks', {}).get(self._loop)
+        if current is None:
+            return 'loop callback'
+        return self._labels.get(current) or current.get_name()
+
+    def _watch(self):
+        poll = self.interval / 2
+        while not self._stop.wait(poll):
+            overdue = time.perf_counter() - self._expected
+            if overdue > self.threshold:
+                self._sample()
+            elif self._stall is not None:
+                self._finish()
+
+    def _sample(self):
+        frame = sys._current_frames().get(self._loop_thread)
+        if frame is None:
+            return
+        stack = traceback.extract_stack(frame)
+        del frame
+        site = _call_site(stack)
+        if self._stall is None:
+            self._stall = (self._expected, self._activity(), Counter(), {})
+        _, _, sites, stacks = self._stall
+        sites[site] += 1
+        stacks.setdefault(site, stack[-Config.STALL_STACK_DEPTH:])
+
+    def _finish(self):
+        started, activity, sites, stacks = self._stall
+        self._stall = None
+        # The heartbeat ran again, so the stall lasted until just before it
+        blocked = max(0.0, self._expected - self.interval - started)
+        site = sites.most_common(1)[0][0]
+        LOOP_STALLS.inc()
+        with self._lock:
+            self.stalls += 1
+            self.total_blocked += blocked
+            entry = self.sites.get(site)
+            if entry is None:
+                entry = self.sites[site] = _Site(stacks[site])
+            entry.count += 1
+            entry.blocked += blocked
+            entry.longest = max(entry.longest, blocked)
+            entry.activities[activity] += 1
+        print(f'Event loop blocked for {blocked * 1000:.0f}ms in {activity}: {site}')
+
+    def report(self, top=None):
+        """Worst call sites by total blocked time"""
+        with self._lock:
+            ranked = sorted(self.sites.items(), key=lambda item: item[1].blocked, reverse=True)
+            return [
+                {
+                    'site': site,
+                    'count': entry.count,
+                    'blocked': entry.blocked,
+                    'longest': entry.longest,
+                    'activities': entry.activities.most_common(3),
+                    'stack': ''.join(traceback.format_list(entry.stack)),
+                }
+                for site, entry in ranked[:top or Config.STALL_REPORT_TOP]
+            ]
+
+    def reset(self):
+        with self._lock:
+            self.sites.clear()
+            self.stalls = 0
+            self.total_blocked = 0.0
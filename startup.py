@@ -0,0 +1,104 @@
+"""Background model warm-up and startup timing"""
+import asyncio
+import time
+
+import metrics
+from config import Config
+from ollama_client import full_model_name
+
+STARTUP_SECONDS = metrics.Gauge('bot_startup_seconds', 'Seconds from launch to each startup milestone', ['phase'])
+
+# Ollama model states
+PENDING = 'pending'
+PULLING = 'pulling'
+LOADING = 'loading'
+READY = 'ready'
+FAILED = 'failed'
+
+
+class StartupTimer:
+    """Records how long after launch each startup milestone was reached"""
+
+    def __init__(self, started=None):
+        self.started = started if started is not None else time.perf_counter()
+        self.phases = {}
+
+    def mark(self, phase):
+        """Record a milestone the first time it is reached"""
+        if phase in self.phases:
+            return
+        elapsed = time.perf_counter() - self.started
+        self.phases[phase] = elapsed
+        STARTUP_SECONDS.labels(phase).set(round(elapsed, 3))
+        print(f'Startup: {phase} after {elapsed:.2f}s')
+
+    def summary(self):
+        return ', '.join(f'{phase} {elapsed:.2f}s' for phase, elapsed in self.phases.items())
+
+
+class ModelWarmup:
+    """Pulls missing models and loads them into memory without blocking startup
+
+    Each model gets a background task that pulls it if the server doesn't
+    have it, then sends an empty prompt so Ollama loads it with the given
+    keep_alive. Commands check is_ready() or wait_ready() before using a
+    model. Failures are retried after MODEL_WARMUP_RETRY seconds.
+    """
+
+    def __init__(self, client, models, timer=None):
+        self.client = client
+        self.models = dict(models)     # model -> keep_alive
+        self.timer = timer
+        self.status = dict.fromkeys(self.models, PENDING)
+        self.errors = {}
+        self._ready = {}
+        self._tasks = []
+
+    def start(self):
+        if self._tasks:
+            return
+        for model in self.models:
+            self._ready[model] = asyncio.Event()
+            self._tasks.append(asyncio.create_task(self._prepare(model)))
+
+    async def _prepare(self, model):
+        while True:
+            try:
+                installed = {full_model_name(name) for name in await self.client.list_models()}
+                if full_model_name(model) not in installed:
+                    self.status[model] = PULLING
+                    await self.client.pull(model)
+                self.status[model] = LOADING
+                await self.client.generate(model, '', keep_alive=self.models[model])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.status[model] = FAILED
+                self.errors[model] = str(e)
+                print(f'Warming up {model} failed, retrying in {Config.MODEL_WARMUP_RETRY}s: {e}')
+                await asyncio.sleep(Config.MODEL_WARMUP_RETRY)
+                continue
+            self.status[model] = READY
+            self.errors.pop(model, None)
+            self._ready[model].set()
+            if self.timer is not None:
+                self.timer.mark(f'{model} ready')
+            return
+
+    def is_ready(self, model):
+        # Models we don't manage are assumed to be usable
+        return self.status.get(model, READY) == READY
+
+    async def wait_ready(self, model, timeout=None):
+        """Wait until a model is loaded, returning False on timeout"""
+        if self.is_ready(model) or model not in self._ready:
+            return self.is_ready(model)
+        try:
+            await asyncio.wait_for(self._ready[model].wait(), timeout or Config.MODEL_READY_TIMEOUT)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
@@ -0,0 +1,189 @@
+"""Crash-safe storage for runtime state with write-behind batching"""
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from config import Config
+
+
+def _encode(value):
+    return json.dumps(value, separators=(',', ':'))
+
+
+class MemoryBackend:
+    """Keeps state in a dict, for tests and the benchmark
+
+    Values still go through JSON so anything that wouldn't survive the
+    SQLite backend fails here too.
+    """
+
+    def __init__(self):
+        self._rows = {}     # (namespace, key) -> (json, updated_at)
+
+    def load(self, namespace, key, max_age=None):
+        row = self._rows.get((namespace, key))
+        if row is None or (max_age and row[1] < time.time() - max_age):
+            return None
+        return json.loads(row[0])
+
+    def write(self, batch, max_age=None):
+        now = time.time()
+        for namespace, key, value in batch:
+            if value is None:
+                self._rows.pop((namespace, key), None)
+            else:
+                self._rows[(namespace, key)] = (_encode(value), now)
+        if max_age:
+            for entry in [entry for entry, row in self._rows.items() if row[1] < now - max_age]:
+                del self._rows[entry]
+
+    def close(self):
+        pass
+
+
+class SQLiteBackend:
+    """One row per (namespace, key) in a WAL-mode SQLite database
+
+    WAL with synchronous=NORMAL keeps every committed batch across a
+    process crash, and readers never wait on the writer.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS state ('
+                ' namespace TEXT NOT NULL,'
+                ' key TEXT NOT NULL,'
+                ' value TEXT NOT NULL,'
+                ' updated_at REAL NOT NULL,'
+                ' PRIMARY KEY (namespace, key)) WITHOUT ROWID'
+            )
+        return self._conn
+
+    def load(self, namespace, key, max_age=None):
+        with self._lock:
+            row = self._connect().execute(
+                'SELECT value, updated_at FROM state WHERE namespace = ? AND key = ?', (namespace, key)
+            ).fetchone()
+        if row is None or (max_age and row[1] < time.time() - max_age):
+            return None
+        return json.loads(row[0])
+
+    def write(self, batch, max_age=None):
+        """Apply a batch of (namespace, key, value or None), dropping rows older than max_age"""
+        now = time.time()
+        upserts = [(namespace, key, _encode(value), now) for namespace, key, value in batch if value is not None]
+        deletes = [(namespace, key) for namespace, key, value in batch if value is None]
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.executemany('INSERT OR REPLACE INTO state VALUES (?, ?, ?, ?)', upserts)
+                conn.executemany('DELETE FROM state WHERE namespace = ? AND key = ?', deletes)
+                if max_age:
+                    # Never loaded again, so they would otherwise stay forever
+                    conn.execute('DELETE FROM state WHERE updated_at < ?', (now - max_age,))
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+def open_backend(kind=None, path=None):
+    """The backend named by STATE_BACKEND"""
+    kind = kind or Config.STATE_BACKEND
+    if kind == 'memory':
+        return MemoryBackend()
+    if kind == 'sqlite':
+        return SQLiteBackend(path or Config.STATE_DB_PATH)
+    raise ValueError(f'Unknown state backend: {kind}')
+
+
+class StateStore:
+    """Write-behind key/value store for state that should outlive a restart
+
+    put() only records the change, so callers on the hot path never touch
+    the disk. A background task waits flush_interval, then writes every
+    change since in one transaction, keeping only the latest value per
+    key. A value may be a callable, which is called at flush time, so
+    state that changes many times a second is serialized once per flush.
+    Rows older than max_age are ignored when read and deleted when a
+    batch is written.
+    """
+
+    def __init__(self, backend=None, flush_interval=None, max_age=None):
+        self.backend = backend or open_backend()
+        self.flush_interval = flush_interval if flush_interval is not None else Config.STATE_FLUSH_INTERVAL
+        self.max_age = max_age if max_age is not None else Config.STATE_MAX_AGE
+        self.writes = 0
+        self._dirty = {}        # (namespace, key) -> value, callable or None to delete
+        self._writing = {}      # The batch currently being written
+        self._flushing = None
+        self._lock = asyncio.Lock()
+
+    async def get(self, namespace, key):
+        """Latest value for a key, including changes not written yet"""
+        key = str(key)
+        for pending in (self._dirty, self._writing):
+            if (namespace, key) in pending:
+                value = pending[(namespace, key)]
+                return value() if callable(value) else value
+        return await asyncio.to_thread(self.backend.load, namespace, key, self.max_age)
+
+    def put(self, namespace, key, value):
+        """Record a new value (or a callable producing it) to write soon"""
+        self._dirty[(namespace, str(key))] = value
+        if self._flushing is None or self._flushing.done():
+            self._flushing = asyncio.create_task(self._flush_later())
+
+    def delete(self, namespace, key):
+        self.put(namespace, key, None)
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        await self.flush()
+
+    async def flush(self):
+        """Write everything pending now"""
+        async with self._lock:
+            while self._dirty:
+                self._writing, self._dirty = self._dirty, {}
+                batch = []
+                for (namespace, key), value in self._writing.items():
+                    try:
+                        batch.append((namespace, key, value() if callable(value) else value))
+                    except Exception as e:
+                        print(f'Could not snapshot {namespace} {key}: {e}')
+                try:
+                    await asyncio.to_thread(self.backend.write, batch, self.max_age)
+                except (OSError, sqlite3.Error) as e:
+                    print(f'Could not save state: {e}')
+                    # Retried with the next change, newer values win
+                    for entry, value in self._writing.items():
+                        self._dirty.setdefault(entry, value)
+                    self._writing = {}
+                    return
+                self.writes += len(batch)
+                self._writing = {}
+
+    async def close(self):
+        """Write pending changes and close the backend"""
+        await self.flush()
+        if self._flushing is not None and not self._flushing.done():
+            self._flushing.cancel()
+        await asyncio.to_thread(self.backend.close)
@@ -0,0 +1,110 @@
+"""CPU accounting for the FFmpeg processes behind voice streams"""
+import asyncio
+import os
+import time
+
+from config import Config
+
+try:
+    _CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+except (AttributeError, ValueError, OSError):
+    _CLOCK_TICKS = 100
+
+
+def process_cpu_time(pid):
+    """CPU seconds (user + system) used by a process, or None if unavailable
+
+    Reads /proc, so this only reports on Linux.
+    """
+    try:
+        with open(f'/proc/{pid}/stat', 'rb') as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # The command name may contain spaces, fields are counted after its ')'
+    fields = stat[stat.rfind(b')') + 2:].split()
+    try:
+        return (int(fields[11]) + int(fields[12])) / _CLOCK_TICKS
+    except (IndexError, ValueError):
+        return None
+
+
+class _Stream:
+    __slots__ = ('guild_id', 'mode', 'pid', 'started', 'cpu', 'percent')
+
+    def __init__(self, guild_id, mode, pid):
+        self.guild_id = guild_id
+        self.mode = mode
+        self.pid = pid
+        self.started = time.monotonic()
+        self.cpu = 0.0
+        self.percent = 0.0
+
+
+class StreamMonitor:
+    """Samples CPU use of live FFmpeg streams, split by playback mode
+
+    Modes are 'copy' (Opus passed straight through) and 'transcode'.
+    """
+
+    def __init__(self, interval=None):
+        self.interval = interval or Config.STREAM_SAMPLE_INTERVAL
+        self.streams = {}       # pid -> _Stream
+        # mode -> [finished streams, CPU seconds, wall seconds]
+        self.totals = {'copy': [0, 0.0, 0.0], 'transcode': [0, 0.0, 0.0]}
+        self._task = None
+        self._last_sample = time.monotonic()
+
+    def register(self, guild_id, source, mode):
+        """Start accounting for an audio source's FFmpeg process"""
+        process = getattr(source, '_process', None)
+        if process is None:
+            return
+        self.streams[process.pid] = _Stream(guild_id, mode, process.pid)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while self.streams:
+            await asyncio.sleep(self.interval)
+            self.sample()
+
+    def sample(self):
+        """Refresh per-stream CPU use and retire streams whose process exited"""
+        now = time.monotonic()
+        elapsed = max(now - self._last_sample, 1e-6)
+        self._last_sample = now
+        for pid, stream in list(self.streams.items()):
+            cpu = process_cpu_time(pid)
+            if cpu is None:
+                totals = self.totals.setdefault(stream.mode, [0, 0.0, 0.0])
+                totals[0] += 1
+                totals[1] += stream.cpu
+                totals[2] += now - stream.started
+                del self.streams[pid]
+                continue
+            stream.percent = 100 * (cpu - stream.cpu) / elapsed
+            stream.cpu = cpu
+
+    def summary(self):
+        """Active streams and average CPU percent per stream for each mode"""
+        result = {}
+        for mode, (finished, cpu, wall) in self.totals.items():
+            active = [stream for stream in self.streams.values() if stream.mode == mode]
+            cpu += sum(stream.cpu for stream in active)
+            wall += sum(time.monotonic() - stream.started for stream in active)
+            result[mode] = {
+                'active': len(active),
+                'finished': finished,
+                'cpu_percent': 100 * cpu / wall if wall else None,
+            }
+        return result
+
+    def estimated_capacity(self):
+        """Concurrent streams one host could sustain at the observed CPU cost"""
+        cores = os.cpu_count() or 1
+        capacity = {}
+        for mode, stats in self.summary().items():
+            if stats['cpu_percent']:
+                capacity[mode] = int(cores * 100 * Config.STREAM_CPU_BUDGET / stats['cpu_percent'])
+        return capacity
@@ -0,0 +1,40 @@
+"""Worker-side extraction keeps each job's overrides to itself"""
+import extract_worker
+
+
+class FakeYoutubeDL:
+    def __init__(self, params):
+        self.params = params
+        self.seen = []
+
+    def extract_info(self, query, download=False, process=True):
+        # yt-dlp's PlaylistEntries reads these with a default, so None would break it
+        self.seen.append((self.params.get('playliststart', 1), self.params.get('playlistend')))
+        return {'id': query}
+
+    def sanitize_info(self, info):
+        return info
+
+
+def test_overrides_do_not_leak_into_the_next_job(monkeypatch):
+    ytdl = FakeYoutubeDL({'quiet': True, 'noplaylist': True})
+    monkeypatch.setattr(extract_worker, 'ytdl', ytdl)
+
+    extract_worker.extract('playlist', overrides={'playliststart': 101, 'playlistend': 200, 'noplaylist': False})
+    extract_worker.extract('ytsearch:song')
+
+    assert ytdl.seen == [(101, 200), (1, None)]
+    assert ytdl.params == {'quiet': True, 'noplaylist': True}
+
+
+def test_overrides_are_removed_when_the_job_fails(monkeypatch):
+    ytdl = FakeYoutubeDL({'quiet': True})
+    ytdl.extract_info = lambda *args, **kwargs: (_ for _ in ()).throw(ValueError('boom'))
+    monkeypatch.setattr(extract_worker, 'ytdl', ytdl)
+
+    try:
+        extract_worker.extract('playlist', overrides={'playliststart': 2})
+    except ValueError:
+        pass
+
+    assert ytdl.params == {'quiet': True}
@@ -0,0 +1,233 @@
+"""Track records and the shared metadata cache for the music player"""
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qs, urlparse
+
+from config import Config
+
+
+def stream_expiry(stream_url, default_ttl=None):
+    """When a direct stream URL stops working
+
+    YouTube (googlevideo) URLs carry their expiry in the 'expire' query
+    parameter; anything else gets the configured default lifetime.
+    """
+    try:
+        expire = parse_qs(urlparse(stream_url).query).get('expire')
+        if expire:
+            return float(expire[0])
+    except ValueError:
+        pass
+    return time.time() + (default_ttl or Config.STREAM_URL_TTL)
+
+
+def format_duration(seconds):
+    if not seconds:
+        return 'live'
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    if hours:
+        return f'{hours}:{minutes:02d}:{seconds:02d}'
+    return f'{minutes}:{seconds:02d}'
+
+
+class Track:
+    """Everything the player needs to know about one song"""
+    __slots__ = (
+        'key', 'webpage_url', 'title', 'duration', 'thumbnail', 'uploader',
+        'stream_url', 'expires_at', 'acodec', 'abr', 'ext', 'codec', 'bitrate',
+    )
+
+    def __init__(self, key, webpage_url, title, duration=None, thumbnail=None, uploader=None,
+                 stream_url=None, expires_at=0.0, acodec=None, abr=None, ext=None):
+        self.key = key
+        self.webpage_url = webpage_url
+        self.title = title
+        self.duration = duration
+        self.thumbnail = thumbnail
+        self.uploader = uploader
+        self.stream_url = stream_url
+        self.expires_at = expires_at
+        self.acodec = acodec
+        self.abr = abr
+        self.ext = ext
+        # Codec and bitrate for FFmpeg, from the metadata or ffprobe
+        self.codec = None
+        self.bitrate = None
+
+    @classmethod
+    def from_info(cls, info):
+        """Build a track from a yt-dlp info dict"""
+        if 'entries' in info:
+            info = next(entry for entry in info['entries'] if entry)
+        stream_url = info.get('url')
+        return cls(
+            key=track_key(info),
+            webpage_url=info.get('webpage_url') or info.get('original_url') or stream_url,
+            title=info.get('title', 'Unknown Title'),
+            duration=info.get('duration'),
+            thumbnail=info.get('thumbnail'),
+            uploader=info.get('uploader') or info.get('channel'),
+            stream_url=stream_url,
+            expires_at=stream_expiry(stream_url) if stream_url else 0.0,
+            acodec=info.get('acodec'),
+            abr=info.get('abr'),
+            ext=info.get('ext'),
+        )
+
+    @classmethod
+    def from_entry(cls, entry):
+        """Build a placeholder from a flat playlist entry, resolved just before it plays"""
+        url = entry.get('webpage_url') or entry.get('url')
+        if url and not url.startswith(('http://', 'https://')) and entry.get('ie_key') == 'Youtube':
+            url = f'https://www.youtube.com/watch?v={url}'
+        return cls(
+            key=track_key(entry),
+            webpage_url=url,
+            title=entry.get('title') or 'Unknown Title',
+            duration=entry.get('duration'),
+            uploader=entry.get('uploader') or entry.get('channel'),
+        )
+
+    def to_record(self):
+        """JSON-friendly copy for the state store"""
+        return {
+            'key': self.key, 'webpage_url': self.webpage_url, 'title': self.title,
+            'duration': self.duration, 'thumbnail': self.thumbnail, 'uploader': self.uploader,
+            'stream_url': self.stream_url, 'expires_at': self.expires_at,
+            'acodec': self.acodec, 'abr': self.abr, 'ext': self.ext,
+        }
+
+    @classmethod
+    def from_record(cls, record):
+        """Rebuild a track saved with to_record(), re-extracted later if its stream expired"""
+        return cls(**record)
+
+    @property
+    def display_duration(self):
+        return format_duration(self.duration)
+
+    def stream_fresh(self, margin=None):
+        """Whether the stream URL will still be valid for the whole song"""
+        if not self.stream_url:
+            return False
+        margin = margin if margin is not None else Config.STREAM_URL_MARGIN
+        needed = margin + (self.duration or 0)
+        return self.expires_at - time.time() > needed
+
+    def fill_metadata(self, other):
+        """Complete a placeholder's details from a full extraction"""
+        self.title = other.title
+        self.duration = other.duration or self.duration
+        self.thumbnail = other.thumbnail or self.thumbnail
+        self.uploader = other.uploader or self.uploader
+
+    def update_stream(self, other):
+        """Take the stream details of a freshly resolved copy of this track"""
+        self.stream_url = other.stream_url
+        self.expires_at = other.expires_at
+        self.acodec = other.acodec
+        self.abr = other.abr
+        self.ext = other.ext
+        self.codec = other.codec
+        self.bitrate = other.bitrate
+
+    @property
+    def probed(self):
+        return self.codec is not None
+
+    def __repr__(self):
+        return f'<Track {self.key} {self.title!r}>'
+
+
+def track_key(info):
+    """Stable identity for a track across extractions"""
+    extractor = info.get('extractor_key') or info.get('ie_key') or 'generic'
+    ident = info.get('id') or info.get('webpage_url') or info.get('url')
+    return f'{extractor.lower()}:{ident}'
+
+
+class TrackCache:
+    """LRU of resolved tracks with a metadata TTL
+
+    Tracks are indexed by their key, webpage URL and any search query that
+    resolved to them, so repeat !play requests skip extraction entirely.
+    """
+
+    def __init__(self, max_entries=None, ttl=None):
+        self.max_entries = max_entries or Config.TRACK_CACHE_SIZE
+        self.ttl = ttl or Config.TRACK_CACHE_TTL
+        self._tracks = OrderedDict()   # key -> (track, cached_at)
+        self._aliases = {}             # url/query -> key
+        self._alias_keys = {}          # key -> aliases pointing at it
+
+    def __len__(self):
+        return len(self._tracks)
+
+    def get(self, lookup):
+        key = self._aliases.get(lookup, lookup)
+        entry = self._tracks.get(key)
+        if entry is None:
+            return None
+        track, cached_at = entry
+        if time.time() - cached_at > self.ttl:
+            self._drop(key)
+            return None
+        self._tracks.move_to_end(key)
+        return track
+
+    def put(self, track, *aliases):
+        existing = self._tracks.get(track.key)
+        if existing is not None and existing[0] is not track:
+            # Keep a single shared record so queued copies see stream refreshes
+            existing[0].update_stream(track)
+            track = existing[0]
+        self._tracks[track.key] = (track, time.time())
+        self._tracks.move_to_end(track.key)
+        for alias in (track.webpage_url, *aliases):
+            if alias and alias != track.key:
+                self._aliases[alias] = track.key
+                self._alias_keys.setdefault(track.key, set()).add(alias)
+        while len(self._tracks) > self.max_entries:
+            old_key, _ = self._tracks.popitem(last=False)
+            self._drop_aliases(old_key)
+        return track
+
+    def _drop(self, key):
+        self._tracks.pop(key, None)
+        self._drop_aliases(key)
+
+    def _drop_aliases(self, key):
+        for alias in self._alias_keys.pop(key, ()):
+            if self._aliases.get(alias) == key:
+                del self._aliases[alias]
+
+
+class TrackResolver:
+    """Turns queries into tracks, extracting only when the cache can't answer"""
+
+    def __init__(self, extract, cache=None, is_local=None):
+        self.extract = extract   # async callable: (query, guild_id=None) -> yt-dlp info dict
+        self.cache = cache or TrackCache()
+        self.is_local = is_local  # callable: track -> True if its audio is stored locally
+
+    async def resolve(self, query, guild_id=None):
+        """Resolve a URL or search query to a track with a usable stream URL"""
+        track = self.cache.get(query)
+        if track is not None:
+            return await self.ensure_stream(track, guild_id)
+        info = await self.extract(query, guild_id=guild_id)
+        return self.cache.put(Track.from_info(info), query)
+
+    async def ensure_stream(self, track, guild_id=None):
+        """Re-resolve the stream URL only when it's missing or near expiry"""
+        if track.stream_fresh() or (self.is_local is not None and self.is_local(track)):
+            return track
+        info = await self.extract(track.webpage_url, guild_id=guild_id)
+        fresh = Track.from_info(info)
+        if track.thumbnail is None:
+            track.fill_metadata(fresh)
+        track.update_stream(fresh)
+        self.cache.put(track)
+        return track